@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark ToA calibration of 16-bit digital numbers: floating point
+arithmetic on every pixel (numpy) against an indexed gather from per-band
+lookup tables (lut), on a synthetic 4-band uint16 tile. Reports throughput
+in megapixels per second (of all bands).
+
+With --image and --metadata, a real image is also calibrated end to end
+with both engines of perusatproc.calibration.calibrate (including I/O),
+the OTB one only if otbcli_OpticalCalibration is on the PATH.
+
+Usage:
+
+    python benchmarks/bench_calibration.py [--size 4096] [--repeat 3]
+        [--image IMG_PHR.TIF --metadata DIM_PHR.XML] [--workdir /tmp]
+
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from perusatproc import calibration
+
+BANDS = 4
+
+# Parameters of a typical multispectral scene
+CALIB = dict(gains=[9.2, 8.9, 9.6, 11.3],
+             biases=[0.0, 0.0, 0.0, 0.0],
+             solar_irradiances=[1982.0, 1826.0, 1540.0, 1094.0],
+             year=2020,
+             month=3,
+             day=14,
+             sun_elev=63.2)
+
+
+def calibrate_numpy(data):
+    refl = np.rint(calibration.toa_reflectance(data, CALIB))
+    out = np.clip(refl, 0, calibration.MAX_REFLECTANCE).astype('uint16')
+    out[data == 0] = 0
+    return out
+
+
+def calibrate_lut(data, lut):
+    return calibration.apply_lut(lut, data)
+
+
+def best_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_arrays(size, repeat):
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 4096, size=(BANDS, size, size), dtype='uint16')
+    mpixels = data.size / 1e6
+
+    start = time.perf_counter()
+    lut = calibration.calibration_lut(CALIB)
+    print("lookup tables built in {:.1f} ms".format(
+        (time.perf_counter() - start) * 1000))
+
+    print("{:<8} {:>10} {:>10}".format("mode", "time (s)", "MP/s"))
+    for name, run in (('numpy', lambda: calibrate_numpy(data)),
+                      ('lut', lambda: calibrate_lut(data, lut))):
+        elapsed = best_time(run, repeat)
+        print("{:<8} {:>10.3f} {:>10.0f}".format(name, elapsed,
+                                                 mpixels / elapsed))
+
+
+def bench_image(image, metadata, workdir, repeat):
+    import rasterio
+
+    with rasterio.open(image) as src:
+        mpixels = src.width * src.height * src.count / 1e6
+    engines = [calibration.LUT]
+    if shutil.which('otbcli_OpticalCalibration'):
+        engines.insert(0, calibration.OTB)
+    else:
+        print("otbcli_OpticalCalibration not found, skip OTB")
+
+    print("{:<8} {:>10} {:>10}".format("engine", "time (s)", "MP/s"))
+    for engine in engines:
+        dst_path = os.path.join(workdir, 'calib_{}.tif'.format(engine))
+
+        def run():
+            calibration.calibrate(src_path=image,
+                                  dst_path=dst_path,
+                                  metadata_path=metadata,
+                                  create_options=['TILED=YES'],
+                                  engine=engine)
+
+        elapsed = best_time(run, repeat)
+        print("{:<8} {:>10.2f} {:>10.0f}".format(engine, elapsed,
+                                                 mpixels / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=4096)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--image", help="path to a Level 2A image")
+    parser.add_argument("--metadata", help="path to its DIMAP metadata file")
+    parser.add_argument("--workdir", default=tempfile.gettempdir())
+    args = parser.parse_args()
+
+    bench_arrays(args.size, args.repeat)
+    if args.image and args.metadata:
+        with tempfile.TemporaryDirectory(dir=args.workdir) as tmpdir:
+            bench_image(args.image, args.metadata, tmpdir, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
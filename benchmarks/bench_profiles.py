@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark output profiles: write a synthetic 4-band uint16 image with each
+analytic profile (and with a plain striped GeoTIFF, the previous default), then read
+it back using block-sized windows in random order, as windowed stages do.
+
+Usage:
+
+    python benchmarks/bench_profiles.py [--size 8192] [--workdir /tmp]
+
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from perusatproc.profiles import BLOCK_SIZE, PREVIEW, PROFILES, VISUAL, rasterio_options
+
+STRIPED = 'striped'
+
+# Profiles that do not fit a 4-band uint16 GeoTIFF: JPEG YCbCr (visual) and
+# COG driver options (preview)
+SKIPPED_PROFILES = (VISUAL, PREVIEW)
+
+
+def synthetic_block(height, width, count, seed):
+    # Smooth gradients plus noise, closer to real imagery than pure noise
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    base = (np.sin(x / 97.0) + np.cos(y / 53.0) + 2) * 2000
+    return np.stack([
+        base + rng.normal(0, 50, size=(height, width)) for _ in range(count)
+    ]).astype('uint16')
+
+
+def write_image(path, size, options):
+    profile = dict(driver='GTiff',
+                   width=size,
+                   height=size,
+                   count=4,
+                   dtype='uint16',
+                   **options)
+    with rasterio.open(path, 'w', **profile) as dst:
+        for i, row in enumerate(range(0, size, BLOCK_SIZE)):
+            height = min(BLOCK_SIZE, size - row)
+            data = synthetic_block(height, size, 4, seed=i)
+            dst.write(data, window=Window(0, row, size, height))
+
+
+def read_windows(path, size):
+    windows = [
+        Window(col, row, min(BLOCK_SIZE, size - col),
+               min(BLOCK_SIZE, size - row))
+        for row in range(0, size, BLOCK_SIZE)
+        for col in range(0, size, BLOCK_SIZE)
+    ]
+    random.Random(0).shuffle(windows)
+    with rasterio.open(path) as src:
+        for window in windows:
+            src.read(window=window)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=8192)
+    parser.add_argument("--workdir", default=None)
+    args = parser.parse_args()
+
+    profiles = {STRIPED: {}}
+    profiles.update({
+        name: rasterio_options(options)
+        for name, options in PROFILES.items()
+        if name not in SKIPPED_PROFILES
+    })
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as tmpdir:
+        print("{:<10} {:>10} {:>10} {:>10}".format("profile", "write (s)",
+                                                   "read (s)", "size (MB)"))
+        for name, options in profiles.items():
+            path = os.path.join(tmpdir, '{}.tif'.format(name))
+            start = time.perf_counter()
+            write_image(path, args.size, options)
+            write_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            read_windows(path, args.size)
+            read_time = time.perf_counter() - start
+
+            size_mb = os.path.getsize(path) / 2**20
+            print("{:<10} {:>10.2f} {:>10.2f} {:>10.1f}".format(
+                name, write_time, read_time, size_mb))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark tile hand-off to process pool workers: send synthetic 4-band uint16
+tiles to workers that apply a cheap in-place operation, either pickling the
+arrays both ways (naive) or through a shared memory TileBufferPool, passing
+only descriptors. Reports throughput in MB/s of tiles processed.
+
+Usage:
+
+    python benchmarks/bench_shm.py [--tile-size 2048] [--tiles 64] [--jobs 4]
+
+"""
+
+import argparse
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from perusatproc.shm import TileBufferPool, buffer_array
+
+BANDS = 4
+
+
+def process_array(data):
+    data += 1
+    return data
+
+
+def process_buffer(buf):
+    data = buffer_array(buf)
+    data += 1
+    return buf
+
+
+def run_naive(executor, tile, ntiles, inflight):
+    checksum = 0
+    running = set()
+    submitted = 0
+    while submitted < ntiles or running:
+        while submitted < ntiles and len(running) < inflight:
+            running.add(executor.submit(process_array, tile))
+            submitted += 1
+        done, running = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            checksum += int(future.result()[0, 0, 0])
+    return checksum
+
+
+def run_shared(executor, tile, ntiles, inflight):
+    checksum = 0
+    running = set()
+    submitted = 0
+    with TileBufferPool(inflight, tile.shape, tile.dtype) as pool:
+        while submitted < ntiles or running:
+            while submitted < ntiles and len(running) < inflight:
+                running.add(executor.submit(process_buffer, pool.put(tile)))
+                submitted += 1
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                buf = future.result()
+                checksum += int(pool.array(buf.slot, buf.shape)[0, 0, 0])
+                pool.release(buf.slot)
+    return checksum
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tile-size", type=int, default=2048)
+    parser.add_argument("--tiles", type=int, default=64)
+    parser.add_argument("--jobs", type=int, default=4)
+    parser.add_argument("--inflight",
+                        type=int,
+                        help="tiles in flight (defaults to 2 per job)")
+    args = parser.parse_args()
+    inflight = args.inflight or 2 * args.jobs
+
+    rng = np.random.default_rng(0)
+    tile = rng.integers(0,
+                        4096,
+                        size=(BANDS, args.tile_size, args.tile_size),
+                        dtype='uint16')
+    total_mb = args.tiles * tile.nbytes / 2**20
+
+    print("{} tiles of {:.0f} MB, {} jobs, {} in flight".format(
+        args.tiles, tile.nbytes / 2**20, args.jobs, inflight))
+    print("{:<8} {:>10} {:>10}".format("mode", "time (s)", "MB/s"))
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        # Start workers before timing
+        list(executor.map(int, range(args.jobs)))
+        for name, run in (('naive', run_naive), ('shared', run_shared)):
+            start = time.perf_counter()
+            checksum = run(executor, tile, args.tiles, inflight)
+            elapsed = time.perf_counter() - start
+            assert checksum == args.tiles * (int(tile[0, 0, 0]) + 1)
+            print("{:<8} {:>10.2f} {:>10.0f}".format(name, elapsed,
+                                                     total_mb / elapsed))
+
+
+if __name__ == "__main__":
+    main()
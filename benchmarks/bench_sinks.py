@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark feeding sinks (statistics) of a volume that fits in a single tile,
+on a synthetic 4-band uint16 image:
+
+* direct: the final image is written once (as OTB does when pansharpening
+  without tiles), then read back block by block for the sinks
+  (checkpoint.scan_image).
+* merge: a scratch image is written, then copied block by block into the
+  final image, feeding the sinks on the way (checkpoint.merge_tiles), as
+  for images computed in several tiles.
+
+Both read the image once for the sinks. Direct reads the compressed final
+image, while merge writes and reads an uncompressed scratch copy.
+
+Usage:
+
+    python benchmarks/bench_sinks.py [--size 8192] [--workdir /tmp]
+
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+from perusatproc import checkpoint, stats
+from perusatproc.profiles import BLOCK_SIZE, FINAL, SCRATCH, creation_options, rasterio_options
+
+
+def synthetic_block(height, width, count, seed):
+    # Smooth gradients plus noise, closer to real imagery than pure noise
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    base = (np.sin(x / 97.0) + np.cos(y / 53.0) + 2) * 2000
+    return np.stack([
+        base + rng.normal(0, 50, size=(height, width)) for _ in range(count)
+    ]).astype('uint16')
+
+
+def write_image(path, size, profile):
+    options = rasterio_options(creation_options(profile))
+    with rasterio.open(path,
+                       'w',
+                       driver='GTiff',
+                       width=size,
+                       height=size,
+                       count=4,
+                       dtype='uint16',
+                       crs='EPSG:32718',
+                       transform=from_origin(280000, 8680000, 0.7, 0.7),
+                       **options) as dst:
+        for i, row in enumerate(range(0, size, BLOCK_SIZE)):
+            height = min(BLOCK_SIZE, size - row)
+            data = synthetic_block(height, size, 4, seed=i)
+            dst.write(data, window=Window(0, row, size, height))
+
+
+def run_direct(tmpdir, size):
+    path = os.path.join(tmpdir, 'direct.tif')
+    start = time.perf_counter()
+    write_image(path, size, FINAL)
+    written = time.perf_counter()
+    checkpoint.scan_image(path, [stats.RasterStats.for_dataset])
+    return written - start, time.perf_counter() - written
+
+
+def run_merge(tmpdir, size):
+    scratch_path = os.path.join(tmpdir, 'scratch.tif')
+    start = time.perf_counter()
+    write_image(scratch_path, size, SCRATCH)
+    written = time.perf_counter()
+    checkpoint.merge_tiles([scratch_path], [(0, 0, size, size)],
+                           os.path.join(tmpdir, 'merge.tif'),
+                           size,
+                           size,
+                           create_options=creation_options(FINAL),
+                           sinks=[stats.RasterStats.for_dataset])
+    return written - start, time.perf_counter() - written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=8192)
+    parser.add_argument("--workdir", default=None)
+    args = parser.parse_args()
+
+    print("{:<8} {:>10} {:>10} {:>10}".format("mode", "write (s)",
+                                              "sinks (s)", "total (s)"))
+    for name, run in (('direct', run_direct), ('merge', run_merge)):
+        with tempfile.TemporaryDirectory(dir=args.workdir) as tmpdir:
+            write_time, sinks_time = run(tmpdir, args.size)
+        print("{:<8} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+            name, write_time, sinks_time, write_time + sinks_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark CLI startup time: run short invocations (--help/--version) of each
+command through the `perusatproc` entry point several times and report the
+mean and minimum wall time.
+
+Usage:
+
+    python benchmarks/bench_startup.py [--repeat 20]
+
+Use `python -X importtime -m perusatproc <command> --help` to see which
+imports dominate.
+
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+INVOCATIONS = [
+    ['--version'],
+    ['calibrate', '--help'],
+    ['orthorectify', '--help'],
+    ['pansharpen', '--help'],
+    ['process', '--help'],
+    ['catalog', '--help'],
+]
+
+
+def time_invocation(args, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-m', 'perusatproc'] + args,
+                       stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL,
+                       check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        subprocess.run([sys.executable, '-c', 'pass'], check=True)
+    interpreter = (time.perf_counter() - start) / args.repeat
+
+    print("Python interpreter startup: {:.1f} ms".format(interpreter * 1000))
+    print("{:<28} {:>10} {:>10}".format("invocation", "mean (ms)", "min (ms)"))
+    for invocation in INVOCATIONS:
+        times = time_invocation(invocation, args.repeat)
+        print("{:<28} {:>10.1f} {:>10.1f}".format(' '.join(invocation),
+                                                  statistics.mean(times) * 1000,
+                                                  min(times) * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,27 @@
 # -*- coding: utf-8 -*-
+"""
+Top-of-Atmosphere (ToA) optical calibration of Level 2A images.
 
+Images are calibrated to ToA reflectance in thousandths, stored as 16-bit
+integers, either with OTB (``otbcli_OpticalCalibration``) or with a lookup
+table. As digital numbers are 16-bit integers and calibration parameters
+are constant per band, the calibrated value of every possible digital number
+of each band is computed once per scene (see :func:`calibration_lut`), and
+images are then calibrated block by block with an indexed gather instead of
+floating point arithmetic on every pixel.
+
+"""
+
+import functools
 import logging
+import math
 import os
 import tempfile
 
+from perusatproc import gdal_config
 from perusatproc.metadata import extract_calibration_metadata
-from perusatproc.util import run_otb_command
+from perusatproc.profiles import rasterio_options
+from perusatproc.util import otb_output_path, run_otb_command
 
 __author__ = "Damián Silvani"
 __copyright__ = "Dymaxion Labs"
@@ -13,15 +29,144 @@ __license__ = "mit"
 
 _logger = logging.getLogger(__name__)
 
+# Calibration engines
+OTB = 'otb'
+LUT = 'lut'
+ENGINES = [OTB, LUT]
+
+# Number of values of 16-bit digital numbers
+LUT_SIZE = 2**16
+
+# Reflectances are clamped to [0, 1] (thousandths with -milli), as with
+# ``otbcli_OpticalCalibration -clamp true``
+MAX_REFLECTANCE = 1000
+
+
+def toa_reflectance(dn, calib, milli=True):
+    """Calibrate digital numbers (bands, ...) to top of atmosphere
+    reflectance, with the parameters of
+    :func:`perusatproc.metadata.extract_calibration_metadata` (one per band
+    of *dn*)"""
+    import numpy as np
+
+    gains = np.asarray(calib['gains'])
+    biases = np.asarray(calib['biases'])
+    irradiances = np.asarray(calib['solar_irradiances'])
+    shape = (-1, ) + (1, ) * (dn.ndim - 1)
+
+    # Earth-Sun distance (in AU) correction from the day of year
+    doy = _day_of_year(calib)
+    d = 1 - 0.01673 * math.cos(0.0172 * (doy - 4))
+    zenith = math.radians(90 - calib['sun_elev'])
+
+    radiance = dn / gains.reshape(shape) + biases.reshape(shape)
+    refl = math.pi * radiance * d**2 / (irradiances.reshape(shape) *
+                                        math.cos(zenith))
+    return refl * 1000 if milli else refl
+
+
+def _day_of_year(calib):
+    from datetime import date
+
+    return date(calib['year'], calib['month'],
+                calib['day']).timetuple().tm_yday
+
+
+def calibration_lut(calib):
+    """Return a (bands, LUT_SIZE) uint16 lookup table of the calibrated value
+    of each digital number of each band, with the parameters of
+    :func:`perusatproc.metadata.extract_calibration_metadata`
+
+    Reflectances are rounded to the nearest thousandth and clamped to
+    [0, MAX_REFLECTANCE], and digital number 0 (i.e. nodata) stays 0.
+    """
+    import numpy as np
+
+    dn = np.broadcast_to(np.arange(LUT_SIZE, dtype='float64'),
+                         (len(calib['gains']), LUT_SIZE))
+    lut = np.clip(np.rint(toa_reflectance(dn, calib)), 0, MAX_REFLECTANCE)
+    lut = lut.astype('uint16')
+    lut[:, 0] = 0
+    return lut
+
+
+@functools.lru_cache(maxsize=16)
+def _scene_lut(metadata_path):
+    # Tiles of the same scene are calibrated with the same table
+    return calibration_lut(extract_calibration_metadata(metadata_path))
+
+
+def apply_lut(lut, data, out=None):
+    """Calibrate (bands, ...) integer *data* with a lookup table of
+    :func:`calibration_lut`"""
+    import numpy as np
+
+    if out is None:
+        out = np.empty(data.shape, dtype=lut.dtype)
+    for band, values in enumerate(data):
+        np.take(lut[band], values, out=out[band])
+    return out
+
+
+def calibrate_lut(*, src_path, dst_path, metadata_path, create_options=[], progress=None, box=None):
+    """Calibrate an image with a lookup table (see :func:`calibration_lut`),
+    block by block
+
+    If *box* (x, y, width, height) is set, only that region of the image is
+    calibrated and written.
+    """
+    import rasterio
+    from rasterio.windows import Window
+
+    lut = _scene_lut(metadata_path)
+
+    with gdal_config.env('calibration'), rasterio.open(src_path) as src:
+        if src.dtypes[0] not in ('uint8', 'uint16'):
+            raise RuntimeError(
+                'Lookup table calibration needs 8 or 16-bit unsigned '
+                'integers, but {} is {}'.format(src_path, src.dtypes[0]))
+        if src.count != len(lut):
+            raise RuntimeError(
+                '{} has {} bands, but its metadata has {}'.format(
+                    src_path, src.count, len(lut)))
+        x, y, width, height = box or (0, 0, src.width, src.height)
+        profile = dict(driver='GTiff',
+                       width=width,
+                       height=height,
+                       count=src.count,
+                       dtype='uint16')
+        if src.crs:
+            profile.update(crs=src.crs,
+                           transform=src.window_transform(
+                               Window(x, y, width, height)))
+        profile.update(rasterio_options(create_options))
+        with rasterio.open(dst_path, 'w', **profile) as dst:
+            windows = [w for _, w in dst.block_windows(1)]
+            for i, window in enumerate(windows):
+                data = src.read(window=Window(x + window.col_off,
+                                              y + window.row_off,
+                                              window.width, window.height))
+                dst.write(apply_lut(lut, data), window=window)
+                if progress:
+                    progress((i + 1) / len(windows))
+
+
+def calibrate(*, src_path, dst_path, metadata_path, create_options=[], progress=None, pixels=None, box=None, engine=OTB):
+    if engine == LUT:
+        return calibrate_lut(src_path=src_path,
+                             dst_path=dst_path,
+                             metadata_path=metadata_path,
+                             create_options=create_options,
+                             progress=progress,
+                             box=box)
+    if engine != OTB:
+        raise ValueError('Unknown calibration engine: {}'.format(engine))
 
-def calibrate(*, src_path, dst_path, metadata_path, create_options=[]):
-    create_opt = ''
-    if create_options:
-        create_opt = '&'.join('gdal:co:{}'.format(opt) for opt in create_options)
     base_cmd = """otbcli_OpticalCalibration \
       -in {src} \
-      -out "{dst}?{create_opt}" uint16 \
+      -out "{dst}" uint16 \
       -milli true \
+      -clamp true \
       -level toa \
       -acqui.minute {minute} \
       -acqui.hour {hour} \
@@ -50,12 +195,14 @@ def calibrate(*, src_path, dst_path, metadata_path, create_options=[]):
     sf.close()
 
     cmd = base_cmd.format(src=src_path,
-                          dst=dst_path,
+                          dst=otb_output_path(dst_path, create_options, box=box),
                           gainbias_path=gf.name,
                           solarillum_path=sf.name,
-                          create_opt=create_opt,
                           **metadata)
-    run_otb_command(cmd)
+    run_otb_command(cmd,
+                    progress=progress,
+                    stage='calibration',
+                    pixels=box[2] * box[3] if box else pixels)
 
     os.unlink(gf.name)
     os.unlink(sf.name)
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite scene catalog built from DIMAP metadata files.
+
+Each image (``DIM_*.XML``) found under a product tree is stored as a row
+with its footprint, acquisition time, sun and view angles and raster paths.
+Footprint bounding boxes are indexed with an R-tree, so that queries by
+bounding box and date do not need to touch the product files at all.
+
+"""
+
+import fnmatch
+import json
+import logging
+import os
+import sqlite3
+from datetime import date, datetime, time
+
+from perusatproc import vfs
+from perusatproc.metadata import (extract_acquisition_datetime,
+                                  extract_calibration_metadata,
+                                  extract_footprint,
+                                  extract_projection_metadata,
+                                  extract_raster_filepath)
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+DIM_PATTERN = 'DIM_*.XML'
+RPC_PATTERN = 'RPC_*.XML'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scenes (
+    id INTEGER PRIMARY KEY,
+    metadata_path TEXT UNIQUE NOT NULL,
+    mtime REAL NOT NULL,
+    raster_path TEXT,
+    rpc_path TEXT,
+    acquired TEXT,
+    sun_elev REAL,
+    sun_azim REAL,
+    view_elev REAL,
+    view_azim REAL,
+    sizex INTEGER,
+    sizey INTEGER,
+    footprint TEXT
+);
+CREATE INDEX IF NOT EXISTS scenes_acquired ON scenes (acquired);
+CREATE VIRTUAL TABLE IF NOT EXISTS scenes_rtree
+    USING rtree(id, minx, maxx, miny, maxy);
+"""
+
+SCENE_COLUMNS = [
+    'metadata_path',
+    'raster_path',
+    'rpc_path',
+    'acquired',
+    'sun_elev',
+    'sun_azim',
+    'view_elev',
+    'view_azim',
+    'sizex',
+    'sizey',
+    'footprint',
+]
+
+
+def connect(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def find_metadata_files(root):
+    """Find DIMAP metadata files under *root*, including inside archives"""
+    for dirpath, _, filenames in os.walk(root):
+        for filename in fnmatch.filter(filenames, DIM_PATTERN):
+            yield os.path.abspath(os.path.join(dirpath, filename))
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if vfs.is_archive(path):
+                for member in vfs.archive_files(path):
+                    if fnmatch.fnmatch(os.path.basename(member), DIM_PATTERN):
+                        yield member
+
+
+def read_scene(metadata_path):
+    dirname = os.path.dirname(metadata_path)
+
+    rpc_paths = fnmatch.filter(vfs.listdir(dirname), RPC_PATTERN)
+    rpc_path = os.path.join(dirname, rpc_paths[0]) if rpc_paths else None
+
+    calib = extract_calibration_metadata(metadata_path)
+    proj = extract_projection_metadata(metadata_path)
+
+    return dict(metadata_path=metadata_path,
+                raster_path=os.path.join(
+                    dirname, extract_raster_filepath(metadata_path)),
+                rpc_path=rpc_path,
+                acquired=extract_acquisition_datetime(
+                    metadata_path).isoformat(),
+                sun_elev=calib['sun_elev'],
+                sun_azim=calib['sun_azim'],
+                view_elev=calib['view_elev'],
+                view_azim=calib['view_azim'],
+                sizex=proj['sizex'],
+                sizey=proj['sizey'],
+                footprint=extract_footprint(metadata_path),
+                bounds=(proj['ulx'], proj['lry'], proj['lrx'], proj['uly']))
+
+
+def _upsert_scene(conn, scene, mtime):
+    values = dict(scene, footprint=json.dumps(scene['footprint']), mtime=mtime)
+    cur = conn.execute('SELECT id FROM scenes WHERE metadata_path = ?',
+                       (scene['metadata_path'], ))
+    row = cur.fetchone()
+    columns = SCENE_COLUMNS + ['mtime']
+    if row:
+        scene_id = row['id']
+        conn.execute(
+            'UPDATE scenes SET {} WHERE id = ?'.format(', '.join(
+                '{} = :{}'.format(c, c) for c in columns)),
+            dict(values, id=scene_id))
+        conn.execute('DELETE FROM scenes_rtree WHERE id = ?', (scene_id, ))
+    else:
+        cur = conn.execute(
+            'INSERT INTO scenes ({}) VALUES ({})'.format(
+                ', '.join(columns), ', '.join(':' + c for c in columns)),
+            values)
+        scene_id = cur.lastrowid
+    minx, miny, maxx, maxy = scene['bounds']
+    conn.execute('INSERT INTO scenes_rtree VALUES (?, ?, ?, ?, ?)',
+                 (scene_id, minx, maxx, miny, maxy))
+
+
+def _delete_scene(conn, scene_id):
+    conn.execute('DELETE FROM scenes WHERE id = ?', (scene_id, ))
+    conn.execute('DELETE FROM scenes_rtree WHERE id = ?', (scene_id, ))
+
+
+def update_catalog(db_path, roots):
+    """Incrementally index all DIMAP metadata files found under *roots*
+
+    Only files that are new or whose modification time changed since the last
+    update are parsed. Entries for files that no longer exist under the given
+    roots are removed.
+
+    Returns a dict with the number of updated, unchanged and removed scenes.
+    """
+    stats = dict(updated=0, unchanged=0, removed=0)
+    conn = connect(db_path)
+    try:
+        with conn:
+            for root in roots:
+                prefix = os.path.join(os.path.abspath(root), '')
+                # Scenes inside archives are stored with GDAL virtual paths
+                prefixes = [prefix] + [
+                    vsi + prefix for vsi in vfs.VSI_PREFIXES.values()
+                ]
+                known = {
+                    r['metadata_path']: (r['id'], r['mtime'])
+                    for p in prefixes for r in conn.execute(
+                        'SELECT id, metadata_path, mtime FROM scenes '
+                        'WHERE substr(metadata_path, 1, ?) = ?', (len(p), p))
+                }
+                for path in find_metadata_files(prefix):
+                    mtime, _ = vfs.cache_key(path)
+                    entry = known.pop(path, None)
+                    if entry and entry[1] == mtime:
+                        stats['unchanged'] += 1
+                        continue
+                    _logger.info("Index %s", path)
+                    try:
+                        scene = read_scene(path)
+                    except (KeyError, TypeError, ValueError) as err:
+                        _logger.warning("Failed to parse %s: %s", path, err)
+                        continue
+                    _upsert_scene(conn, scene, mtime)
+                    stats['updated'] += 1
+                for path, (scene_id, _) in known.items():
+                    _logger.info("Remove %s", path)
+                    _delete_scene(conn, scene_id)
+                    stats['removed'] += 1
+    finally:
+        conn.close()
+    return stats
+
+
+def _to_iso(value, end=False):
+    if isinstance(value, str):
+        # Plain dates cover the whole day when used as range end
+        if end and len(value) == 10:
+            return '{}T{}'.format(value, time.max.isoformat())
+        return value
+    if isinstance(value, date) and not isinstance(value, datetime):
+        value = datetime.combine(value, time.max if end else time.min)
+    return value.isoformat()
+
+
+def search(db_path, bbox=None, start=None, end=None):
+    """Query scenes by bounding box and acquisition date range
+
+    Args:
+      bbox (tuple): (minx, miny, maxx, maxy) in geographic coordinates
+      start, end (datetime, date or ISO string): inclusive date range
+
+    Returns:
+      list of dicts, one for each scene
+    """
+    query = 'SELECT s.* FROM scenes s'
+    where, params = [], []
+    if bbox:
+        minx, miny, maxx, maxy = bbox
+        query += ' JOIN scenes_rtree r ON r.id = s.id'
+        where += [
+            'r.minx <= ?', 'r.maxx >= ?', 'r.miny <= ?', 'r.maxy >= ?'
+        ]
+        params += [maxx, minx, maxy, miny]
+    if start:
+        where.append('s.acquired >= ?')
+        params.append(_to_iso(start))
+    if end:
+        where.append('s.acquired <= ?')
+        params.append(_to_iso(end, end=True))
+    if where:
+        query += ' WHERE ' + ' AND '.join(where)
+    query += ' ORDER BY s.acquired'
+
+    conn = connect(db_path)
+    try:
+        rows = conn.execute(query, params).fetchall()
+    finally:
+        conn.close()
+
+    res = []
+    for row in rows:
+        scene = {k: row[k] for k in SCENE_COLUMNS}
+        scene['footprint'] = json.loads(scene['footprint'])
+        res.append(scene)
+    return res
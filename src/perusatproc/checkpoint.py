@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Tile-granular checkpointing of long stages.
+
+A stage that supports it computes its output as a grid of tiles, each written
+to its own file, and records completed tiles in a sidecar JSON file with a
+bitmap. If the job is interrupted (e.g. a preemptible instance is reclaimed),
+running it again on the same workspace only computes the missing tiles.
+Tiles are finally merged into the output image.
+
+The sidecar stores a key computed from the stage inputs and parameters, so
+tiles of a previous run with different inputs are never reused.
+
+"""
+
+import base64
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from perusatproc import gdal_config
+from perusatproc.profiles import rasterio_options
+from perusatproc.workspace import commit, temp_path
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_TILE_SIZE = 8192
+
+CHECKPOINT_SUFFIX = '.tiles.json'
+TILES_SUFFIX = '.tiles'
+
+
+def tile_grid(width, height, tile_size=DEFAULT_TILE_SIZE):
+    """Return (x, y, width, height) boxes of a grid of tiles, by rows"""
+    return [(x, y, min(tile_size, width - x), min(tile_size, height - y))
+            for y in range(0, height, tile_size)
+            for x in range(0, width, tile_size)]
+
+
+def input_key(paths, **params):
+    """Return a key that identifies a computation from its input files (by
+    path, size and modification time) and parameters"""
+    h = hashlib.sha1()
+    for path in paths:
+        st = os.stat(path)
+        h.update(repr((path, st.st_size, st.st_mtime_ns)).encode())
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+class TileCheckpoint:
+    """Completion bitmap of the tiles of an output, stored in a JSON file
+
+    The file is rewritten atomically each time a tile is marked as done, so
+    it is always consistent with the tiles on disk. If the file exists but
+    was written for a different key or grid, it is ignored.
+    """
+
+    def __init__(self, path, key, ntiles):
+        self.path = path
+        self.key = key
+        self.ntiles = ntiles
+        self.done = bytearray((ntiles + 7) // 8)
+
+        state = self._load()
+        if state and state.get('key') == key and state.get(
+                'ntiles') == ntiles:
+            self.done = bytearray(base64.b64decode(state['done']))
+        elif state:
+            _logger.info("Checkpoint %s is stale, start over", path)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self):
+        tmp_path = temp_path(self.path)
+        with open(tmp_path, 'w') as f:
+            json.dump(
+                dict(key=self.key,
+                     ntiles=self.ntiles,
+                     done=base64.b64encode(bytes(self.done)).decode()), f)
+        commit(tmp_path, self.path)
+
+    def is_done(self, i):
+        return bool(self.done[i // 8] & (1 << (i % 8)))
+
+    def mark_done(self, i):
+        self.done[i // 8] |= 1 << (i % 8)
+        self.save()
+
+    def missing(self):
+        return [i for i in range(self.ntiles) if not self.is_done(i)]
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def merge_tiles(tile_paths,
+                boxes,
+                dst_path,
+                width,
+                height,
+                create_options=[],
+                sinks=[]):
+    """Merge tiles into a single image, block by block
+
+    The first tile must be at the origin of the image, as its georeference is
+    used for the whole image.
+
+    *sinks* are functions called with the output dataset, that return an
+    object whose ``update(data, window)`` method is called with each block
+    written, and ``close(dataset)`` when done, before closing the dataset
+    (see e.g. :class:`perusatproc.stats.RasterStats`). They are used to
+    compute other results in the same pass.
+
+    Returns:
+      list: objects created by *sinks*
+    """
+    import rasterio
+    from rasterio.windows import Window
+
+    with rasterio.open(tile_paths[0]) as first:
+        profile = first.profile
+    profile.update(driver='GTiff', width=width, height=height)
+    profile.update(rasterio_options(create_options))
+
+    tmp_path = temp_path(dst_path)
+    with gdal_config.env('merge'), \
+            rasterio.open(tmp_path, 'w', **profile) as dst:
+        outputs = [sink(dst) for sink in sinks]
+        for path, (x, y, _, _) in zip(tile_paths, boxes):
+            with rasterio.open(path) as src:
+                for _, window in src.block_windows(1):
+                    data = src.read(window=window)
+                    dst_window = Window(x + window.col_off,
+                                        y + window.row_off, window.width,
+                                        window.height)
+                    dst.write(data, window=dst_window)
+                    for output in outputs:
+                        output.update(data, dst_window)
+        for output in outputs:
+            output.close(dst)
+    commit(tmp_path, dst_path)
+    return outputs
+
+
+def scan_image(path, sinks=[]):
+    """Feed the blocks of an existing image to *sinks* (see
+    :func:`merge_tiles`), for images that were not written by it"""
+    if not sinks:
+        return []
+
+    import rasterio
+
+    # Opened for update, as sinks may write tags when closed (e.g. band
+    # statistics of perusatproc.stats.RasterStats)
+    with gdal_config.env('merge'), rasterio.open(path, 'r+') as ds:
+        outputs = [sink(ds) for sink in sinks]
+        for _, window in ds.block_windows(1):
+            data = ds.read(window=window)
+            for output in outputs:
+                output.update(data, window)
+        for output in outputs:
+            output.close(ds)
+    return outputs
+
+
+def run_tiled(compute_tile,
+              dst_path,
+              width,
+              height,
+              key,
+              tile_size=DEFAULT_TILE_SIZE,
+              create_options=[],
+              progress=None,
+              sinks=[],
+              merge=True):
+    """Compute an image tile by tile, resuming from a previous checkpoint
+
+    Args:
+      compute_tile (callable): function called with the path of a tile, its
+        box (x, y, width, height) and a progress callback, that writes the
+        tile as a GeoTIFF
+      dst_path (str): path to output image
+      width (int): width of output image
+      height (int): height of output image
+      key (str): key of the computation (see :func:`input_key`)
+      tile_size (int): size of tiles
+      create_options ([str]): GDAL creation options of output image
+      progress (callable): optional function called with overall progress
+      sinks (list): passed to :func:`merge_tiles`
+      merge (bool): merge tiles into *dst_path*. If False, tiles are kept
+        where they are, for the caller to read them (e.g. through a virtual
+        raster), and *sinks* are not used.
+
+    Returns:
+      list: objects created by *sinks*, or paths to tiles if *merge* is
+      False
+    """
+    boxes = tile_grid(width, height, tile_size)
+    tiles_dir = dst_path + TILES_SUFFIX
+    os.makedirs(tiles_dir, exist_ok=True)
+    tile_paths = [
+        os.path.join(tiles_dir, '{:05d}.tif'.format(i))
+        for i in range(len(boxes))
+    ]
+
+    checkpoint = TileCheckpoint(dst_path + CHECKPOINT_SUFFIX, key, len(boxes))
+    missing = checkpoint.missing()
+    if len(missing) < len(boxes):
+        _logger.info("Resume %s: %d of %d tiles already done", dst_path,
+                     len(boxes) - len(missing), len(boxes))
+
+    for n, i in enumerate(missing):
+        done = len(boxes) - len(missing) + n
+
+        def report(fraction, done=done):
+            if progress:
+                progress((done + fraction) / len(boxes))
+
+        _logger.info("Compute tile %d/%d %s of %s", i + 1, len(boxes),
+                     boxes[i], dst_path)
+        compute_tile(tile_paths[i], boxes[i], report)
+        checkpoint.mark_done(i)
+
+    if not merge:
+        return tile_paths
+
+    _logger.info("Merge %d tiles into %s", len(boxes), dst_path)
+    outputs = merge_tiles(tile_paths, boxes, dst_path, width, height,
+                          create_options, sinks)
+    checkpoint.remove()
+    shutil.rmtree(tiles_dir)
+    return outputs
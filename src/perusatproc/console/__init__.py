@@ -0,0 +1,21 @@
+import argparse
+
+
+class VersionAction(argparse.Action):
+    """Like argparse "version" action, but resolves the package version only
+    when the option is used, to keep console scripts startup fast."""
+
+    def __init__(self,
+                 option_strings,
+                 dest=argparse.SUPPRESS,
+                 default=argparse.SUPPRESS,
+                 help="show program's version number and exit"):
+        super().__init__(option_strings=option_strings,
+                         dest=dest,
+                         default=default,
+                         nargs=0,
+                         help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        from perusatproc import __version__
+        parser.exit(message="perusatproc {ver}\n".format(ver=__version__))
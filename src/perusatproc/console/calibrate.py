@@ -11,8 +11,10 @@ import os
 import sys
 import tempfile
 
-from perusatproc import __version__
-from perusatproc.calibration import calibrate
+from perusatproc.console import VersionAction
+from perusatproc.calibration import ENGINES, OTB, calibrate
+from perusatproc.profiles import FINAL, creation_options
+from perusatproc.workspace import commit, temp_path
 
 __author__ = "Damián Silvani"
 __copyright__ = "Dymaxion Labs"
@@ -21,7 +23,7 @@ __license__ = "mit"
 _logger = logging.getLogger(__name__)
 
 
-def process_image(src, dst, metadata=None, create_options=[]):
+def process_image(src, dst, metadata=None, create_options=[], engine=OTB):
     if not metadata:
         _logger.info(
             "Metadata file not provided. Going to look for XML file in src image directory."
@@ -37,7 +39,10 @@ def process_image(src, dst, metadata=None, create_options=[]):
 
     _logger.info("Metadata file: {}".format(metadata))
 
-    calibrate(src_path=src, dst_path=dst, metadata_path=metadata, create_options=create_options)
+    # Write to a temporary file first and move it into place when done
+    tmp_dst = temp_path(dst)
+    calibrate(src_path=src, dst_path=tmp_dst, metadata_path=metadata, create_options=create_options, engine=engine)
+    commit(tmp_dst, dst)
 
 
 def parse_args(args):
@@ -54,9 +59,7 @@ def parse_args(args):
         "Perform radiometric calibration from Level 2A to Top-of-Atmosphere (ToA)"
     )
 
-    parser.add_argument("--version",
-                        action="version",
-                        version="perusatproc {ver}".format(ver=__version__))
+    parser.add_argument("--version", action=VersionAction)
 
     parser.add_argument("-v",
                         "--verbose",
@@ -75,6 +78,12 @@ def parse_args(args):
     parser.add_argument("dst", help="path to output image")
     parser.add_argument("-m", "--metadata", help="path to metadata XML file")
 
+    parser.add_argument("--engine",
+                        choices=ENGINES,
+                        default=OTB,
+                        help="calibrate with OTB, or with per-band lookup "
+                        "tables (lut)")
+
     parser.add_argument("-co",
                         "--create-options",
                         nargs="+",
@@ -107,7 +116,11 @@ def main(args):
 
     _logger.debug("Args: %s", args)
 
-    process_image(args.src, args.dst, metadata=args.metadata, create_options=args.create_options)
+    process_image(args.src,
+                  args.dst,
+                  metadata=args.metadata,
+                  create_options=creation_options(FINAL, args.create_options),
+                  engine=args.engine)
 
 
 def run():
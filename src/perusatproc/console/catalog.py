@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+This script maintains a scene catalog of PeruSat-1 products, indexed from
+their DIMAP metadata files, and queries it by bounding box and date.
+
+"""
+
+import argparse
+import json
+import logging
+import sys
+
+from perusatproc.console import VersionAction
+from perusatproc.catalog import search, update_catalog
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+
+def parse_args(args):
+    """Parse command line parameters
+
+    Args:
+      args ([str]): command line parameters as list of strings
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = argparse.ArgumentParser(
+        description="Index and query a catalog of PeruSat-1 scenes")
+
+    parser.add_argument("--version", action=VersionAction)
+
+    parser.add_argument("-v",
+                        "--verbose",
+                        dest="loglevel",
+                        help="set loglevel to INFO",
+                        action="store_const",
+                        const=logging.INFO)
+    parser.add_argument("-vv",
+                        "--very-verbose",
+                        dest="loglevel",
+                        help="set loglevel to DEBUG",
+                        action="store_const",
+                        const=logging.DEBUG)
+
+    parser.add_argument("db", help="path to catalog database file")
+
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    update_parser = subparsers.add_parser(
+        "update", help="index new or modified scenes from product trees")
+    update_parser.add_argument("roots",
+                               nargs="+",
+                               help="path to directories containing products")
+
+    search_parser = subparsers.add_parser(
+        "search", help="search scenes by bounding box and date")
+    search_parser.add_argument("--bbox",
+                               nargs=4,
+                               type=float,
+                               metavar=("MINX", "MINY", "MAXX", "MAXY"),
+                               help="bounding box in geographic coordinates")
+    search_parser.add_argument("--start",
+                               help="start acquisition date (ISO format)")
+    search_parser.add_argument("--end",
+                               help="end acquisition date (ISO format)")
+
+    return parser.parse_args(args)
+
+
+def setup_logging(loglevel):
+    """Setup basic logging
+
+    Args:
+      loglevel (int): minimum loglevel for emitting messages
+    """
+    logformat = "[%(asctime)s] %(levelname)s:%(name)s:%(message)s"
+    logging.basicConfig(level=loglevel,
+                        stream=sys.stderr,
+                        format=logformat,
+                        datefmt="%Y-%m-%d %H:%M:%S")
+
+
+def main(args):
+    """Main entry point allowing external calls
+
+    Args:
+      args ([str]): command line parameter list
+    """
+    args = parse_args(args)
+    setup_logging(args.loglevel)
+
+    _logger.debug("Args: %s", args)
+
+    if args.command == "update":
+        stats = update_catalog(args.db, args.roots)
+        _logger.info("Updated: %d, unchanged: %d, removed: %d",
+                     stats['updated'], stats['unchanged'], stats['removed'])
+    elif args.command == "search":
+        for scene in search(args.db,
+                            bbox=args.bbox,
+                            start=args.start,
+                            end=args.end):
+            print(json.dumps(scene))
+
+
+def run():
+    """Entry point for console_scripts
+    """
+    main(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    run()
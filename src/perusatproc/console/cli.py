@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Single entry point for all perusatproc scripts:
+
+    perusatproc <command> [args...]
+
+Only the module of the requested command is imported, so short invocations
+(and --help/--version) do not pay for loading the other scripts.
+
+"""
+
+import importlib
+import sys
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+COMMANDS = {
+    'calibrate': ('perusatproc.console.calibrate',
+                  'Perform ToA radiometric calibration of an image'),
+    'orthorectify': ('perusatproc.console.orthorectify',
+                     'Orthorectify an image using its RPC metadata'),
+    'pansharpen': ('perusatproc.console.pansharpen',
+                   'Pansharpen a MS image with a P image'),
+    'process': ('perusatproc.console.process',
+                'Process a whole PeruSat-1 product'),
+    'catalog': ('perusatproc.console.catalog',
+                'Index and query a catalog of scenes'),
+    'watch': ('perusatproc.console.watch',
+              'Process products delivered to a drop folder'),
+    'tileserver': ('perusatproc.console.tileserver',
+                   'Serve map tiles of a raw product, processed on demand'),
+}
+
+
+def usage():
+    lines = ["usage: perusatproc [--version] <command> [args...]", "",
+             "commands:"]
+    for name, (_, help_text) in COMMANDS.items():
+        lines.append("  {:<14}{}".format(name, help_text))
+    lines.append("")
+    lines.append("Run `perusatproc <command> --help` for command options.")
+    return "\n".join(lines)
+
+
+def main(args):
+    """Main entry point allowing external calls
+
+    Args:
+      args ([str]): command line parameter list
+    """
+    if not args or args[0] in ('-h', '--help'):
+        print(usage())
+        return 0 if args else 2
+    if args[0] == '--version':
+        from perusatproc import __version__
+        print("perusatproc {ver}".format(ver=__version__))
+        return 0
+    if args[0] not in COMMANDS:
+        print("perusatproc: unknown command '{}'\n".format(args[0]),
+              file=sys.stderr)
+        print(usage(), file=sys.stderr)
+        return 2
+
+    module_name, _ = COMMANDS[args[0]]
+    module = importlib.import_module(module_name)
+    module.main(args[1:])
+    return 0
+
+
+def run():
+    """Entry point for console_scripts
+    """
+    args = sys.argv[1:]
+    if args and args[0] in COMMANDS:
+        # Show "perusatproc <command>" as program name in usage messages
+        sys.argv[0] = 'perusatproc {}'.format(args[0])
+    sys.exit(main(args))
+
+
+if __name__ == "__main__":
+    run()
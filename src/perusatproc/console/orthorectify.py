@@ -11,10 +11,11 @@ import argparse
 import logging
 import os
 import sys
-import shutil
 
-from perusatproc import __version__
+from perusatproc.console import VersionAction
 from perusatproc.orthorectification import add_rpc_tags, orthorectify, GEOID_PATH, DEM_PATH
+from perusatproc.profiles import FINAL, SCRATCH, creation_options
+from perusatproc.workspace import Workspace
 
 __author__ = "Damián Silvani"
 __copyright__ = "Dymaxion Labs"
@@ -32,25 +33,26 @@ def process_image(rpc_metadata_path=None,
                   src_path,
                   dst_path):
 
-    rpc_fixed_dir = os.path.join(os.path.dirname(dst_path), '_rpc')
-    os.makedirs(rpc_fixed_dir, exist_ok=True)
-    rpc_fixed_path = os.path.join(rpc_fixed_dir, os.path.basename(src_path))
+    with Workspace(os.path.dirname(dst_path) or '.') as ws:
+        rpc_fixed_path = ws.join('_rpc', os.path.basename(src_path))
 
-    _logger.info("Add RPC tags from %s and write %s", src_path, rpc_fixed_path)
-    add_rpc_tags(src_path=src_path,
-                 dst_path=rpc_fixed_path,
-                 metadata_path=rpc_metadata_path)
+        _logger.info("Add RPC tags from %s and write %s", src_path,
+                     rpc_fixed_path)
+        add_rpc_tags(src_path=src_path,
+                     dst_path=rpc_fixed_path,
+                     metadata_path=rpc_metadata_path,
+                     create_options=creation_options(SCRATCH))
 
-    _logger.info("Orthorectify %s and write %s", rpc_fixed_path, dst_path)
-    orthorectify(src_path=rpc_fixed_path,
-                 dst_path=dst_path,
-                 dem_path=dem_path,
-                 geoid_path=geoid_path,
-                 spacing=spacing,
-                 create_options=create_options)
+        orthorectify_path = ws.join(os.path.basename(dst_path))
+        _logger.info("Orthorectify %s and write %s", rpc_fixed_path, dst_path)
+        orthorectify(src_path=rpc_fixed_path,
+                     dst_path=orthorectify_path,
+                     dem_path=dem_path,
+                     geoid_path=geoid_path,
+                     spacing=spacing,
+                     create_options=create_options)
 
-    _logger.info("Clean up temporary results")
-    shutil.rmtree(rpc_fixed_dir)
+        ws.commit(orthorectify_path, dst_path)
 
 
 def parse_args(args):
@@ -67,9 +69,7 @@ def parse_args(args):
         "Perform radiometric calibration from Level 2A to Top-of-Atmosphere (ToA)"
     )
 
-    parser.add_argument("--version",
-                        action="version",
-                        version="perusatproc {ver}".format(ver=__version__))
+    parser.add_argument("--version", action=VersionAction)
 
     parser.add_argument("-v",
                         "--verbose",
@@ -142,7 +142,7 @@ def main(args):
                   dem_path=args.dem,
                   geoid_path=args.geoid,
                   spacing=args.spacing,
-                  create_options=args.create_options)
+                  create_options=creation_options(FINAL, args.create_options))
 
 
 def run():
@@ -12,8 +12,10 @@ import os
 import sys
 import tempfile
 
-from perusatproc import __version__
+from perusatproc.console import VersionAction
 from perusatproc.pansharpening import pansharpen
+from perusatproc.profiles import FINAL, creation_options
+from perusatproc.workspace import commit, temp_path
 
 __author__ = "Damián Silvani"
 __copyright__ = "Dymaxion Labs"
@@ -36,9 +38,7 @@ def parse_args(args):
         "Perform radiometric calibration from Level 2A to Top-of-Atmosphere (ToA)"
     )
 
-    parser.add_argument("--version",
-                        action="version",
-                        version="perusatproc {ver}".format(ver=__version__))
+    parser.add_argument("--version", action=VersionAction)
 
     parser.add_argument("-v",
                         "--verbose",
@@ -89,7 +89,13 @@ def main(args):
 
     _logger.debug("Args: %s", args)
 
-    pansharpen(args.p_src, args.ms_src, args.dst, create_options=args.create_options)
+    # Write to a temporary file first and move it into place when done
+    tmp_dst = temp_path(args.dst)
+    pansharpen(args.p_src,
+               args.ms_src,
+               tmp_dst,
+               create_options=creation_options(FINAL, args.create_options))
+    commit(tmp_dst, args.dst)
 
 
 def run():
@@ -8,23 +8,25 @@ Final output can be a virtual raster or a tiff file.
 """
 
 import argparse
+import json
 import sys
 import logging
 
-from perusatproc import __version__
-from perusatproc import calibration, orthorectification, pansharpening
+from perusatproc.console import VersionAction
+from perusatproc import calibration, checkpoint, executors, gdal_config, orthorectification, overviews, pansharpening, planner, preview, product, s3, stats, streaming, transcode, visual, vrt, zarr_store
+from perusatproc.dynamic import PAN_RATIO
+from perusatproc.tasks import Task, run_tasks
+from perusatproc.profiles import FINAL, SCRATCH, STAGE_PROFILES, creation_options
+from perusatproc.progress import JsonLinesWriter, MultiCallback, ProgressTracker, StageProgress, read_events
 from perusatproc.util import run_command
+from perusatproc.workspace import WORKSPACE_PREFIX, Workspace, commit, temp_path
 from perusatproc.orthorectification import GEOID_PATH, DEM_PATH
-from perusatproc.metadata import extract_raster_filepath
+from perusatproc.metadata import extract_acquisition_datetime, extract_display_bands, extract_projection_metadata, extract_raster_filepath
 
-import subprocess
-import xmltodict
-import tempfile
 import shutil
-import rasterio
+import tempfile
 import os
 from glob import glob
-from datetime import datetime
 
 __author__ = "Damián Silvani"
 __copyright__ = "Dymaxion Labs"
@@ -34,46 +36,113 @@ _logger = logging.getLogger(__name__)
 
 DEFAULT_TILE_SIZE = 2**14
 
+# Output formats of the pansharpened mosaic
+GTIFF = 'gtiff'
+ZARR = 'zarr'
+OUTPUT_FORMATS = [GTIFF, ZARR]
+
 
-def process_image(dem_path=None, geoid_path=None, spacing=None, *, src, dst):
+def process_image(dem_path=None,
+                  geoid_path=None,
+                  spacing=None,
+                  scratch_create_options=[],
+                  work_dir=None,
+                  progress=None,
+                  transcode_cache=None,
+                  calibration_engine=calibration.OTB,
+                  grid=None,
+                  *,
+                  src,
+                  dst):
     _logger.info(f"Source: {src}")
     _logger.info(f"Destination: {dst}")
 
-    dim_xml = glob(os.path.join(src, 'DIM_*.XML'))[0]
-    rpc_xml = glob(os.path.join(src, 'RPC_*.XML'))[0]
+    if not work_dir:
+        os.makedirs(dst, exist_ok=True)
+        work_dir = tempfile.mkdtemp(prefix=WORKSPACE_PREFIX, dir=dst)
+
+    dim_xml, rpc_xml = product.find_metadata_files(src)
 
     src_path = os.path.join(src, extract_raster_filepath(dim_xml))
     basename = os.path.basename(src_path)
 
-    calibration_dir = os.path.join(dst, '_calib')
+    job = os.path.basename(os.path.normpath(src))
+    proj = extract_projection_metadata(dim_xml)
+    pixels = proj['sizex'] * proj['sizey']
+
+    calibration_dir = os.path.join(work_dir, '_calib')
     os.makedirs(calibration_dir, exist_ok=True)
     calibration_path = os.path.join(calibration_dir, basename)
 
-    _logger.info("Calibrate %s and write %s", src_path, calibration_path)
-    calibration.calibrate(src_path=src_path,
-                          dst_path=calibration_path,
-                          metadata_path=dim_xml)
-
-    rpc_fixed_dir = os.path.join(dst, '_rpc')
+    rpc_fixed_dir = os.path.join(work_dir, '_rpc')
     os.makedirs(rpc_fixed_dir, exist_ok=True)
     rpc_fixed_path = os.path.join(rpc_fixed_dir, basename)
 
-    _logger.info("Add RPC tags from %s and write %s", calibration_path,
-                 rpc_fixed_path)
-    orthorectification.add_rpc_tags(src_path=calibration_path,
-                                    dst_path=rpc_fixed_path,
-                                    metadata_path=rpc_xml)
-
-    orthorectify_fixed_dir = os.path.join(dst, '_ortho')
+    orthorectify_fixed_dir = os.path.join(work_dir, '_ortho')
     os.makedirs(orthorectify_fixed_dir, exist_ok=True)
     orthorectify_path = os.path.join(orthorectify_fixed_dir, basename)
+
+    # Results of each stage are moved into place only when complete, so when
+    # the work directory of an interrupted run is reused, finished stages are
+    # skipped.
+    if os.path.exists(orthorectify_path):
+        _logger.info("Reuse %s from previous run", orthorectify_path)
+        return orthorectify_path
+
+    if not os.path.exists(rpc_fixed_path):
+        if os.path.exists(calibration_path):
+            _logger.info("Reuse %s from previous run", calibration_path)
+        else:
+            # Only calibration reads the source raster
+            if transcode_cache and transcode.needs_transcode(src_path):
+                with StageProgress(progress, job, 'transcode', pixels):
+                    src_path = transcode.cached_path(src_path,
+                                                     transcode_cache)
+            _logger.info("Calibrate %s and write %s", src_path,
+                         calibration_path)
+            tmp_path = temp_path(calibration_path)
+            with StageProgress(progress, job, 'calibration',
+                               pixels) as report:
+                calibration.calibrate(src_path=src_path,
+                                      dst_path=tmp_path,
+                                      metadata_path=dim_xml,
+                                      create_options=creation_options(
+                                          STAGE_PROFILES['calibration'],
+                                          scratch_create_options),
+                                      progress=report,
+                                      pixels=pixels,
+                                      engine=calibration_engine)
+            commit(tmp_path, calibration_path)
+
+        _logger.info("Add RPC tags from %s and write %s", calibration_path,
+                     rpc_fixed_path)
+        tmp_path = temp_path(rpc_fixed_path)
+        with StageProgress(progress, job, 'rpc', pixels) as report:
+            orthorectification.add_rpc_tags(src_path=calibration_path,
+                                            dst_path=tmp_path,
+                                            metadata_path=rpc_xml,
+                                            create_options=creation_options(
+                                                STAGE_PROFILES['rpc'],
+                                                scratch_create_options),
+                                            progress=report)
+        commit(tmp_path, rpc_fixed_path)
+
     _logger.info("Orthorectify %s and write %s", rpc_fixed_path,
                  orthorectify_path)
-    orthorectification.orthorectify(src_path=rpc_fixed_path,
-                                    dst_path=orthorectify_path,
-                                    dem_path=dem_path,
-                                    geoid_path=geoid_path,
-                                    spacing=spacing)
+    tmp_path = temp_path(orthorectify_path)
+    with StageProgress(progress, job, 'orthorectification', pixels) as report:
+        orthorectification.orthorectify(
+            src_path=rpc_fixed_path,
+            dst_path=tmp_path,
+            dem_path=dem_path,
+            geoid_path=geoid_path,
+            spacing=spacing,
+            create_options=creation_options(
+                STAGE_PROFILES['orthorectification'], scratch_create_options),
+            progress=report,
+            pixels=pixels,
+            grid=grid)
+    commit(tmp_path, orthorectify_path)
 
     _logger.info("Clean up image temporary results")
     shutil.rmtree(calibration_dir)
@@ -83,19 +152,347 @@ def process_image(dem_path=None, geoid_path=None, spacing=None, *, src, dst):
 
 
 def build_virtual_raster(inputs, dst):
-    cmd = 'gdalbuildvrt {dst} {inputs}'.format(dst=dst,
-                                               inputs=' '.join(inputs))
-    run_command(cmd)
+    vrt.build_vrt(inputs, dst)
 
 
-def retile_images(src, outdir, tile_size=DEFAULT_TILE_SIZE):
-    cmd = 'gdal_retile.py -co TILED=YES ' \
+def retile_images(src, outdir, tile_size=DEFAULT_TILE_SIZE, create_options=[]):
+    co_opts = ' '.join('-co {}'.format(opt) for opt in create_options)
+    cmd = 'gdal_retile.py {co_opts} ' \
         '-ps {tile_size} {tile_size} ' \
         '-targetDir {outdir} ' \
-        '{src}'.format(tile_size=tile_size,
+        '{src}'.format(co_opts=co_opts,
+        tile_size=tile_size,
         outdir=outdir,
         src=src)
-    run_command(cmd)
+    run_command(cmd, stage='retile')
+
+
+def volume_sinks(dst_path, compute_stats=True, rgb_bands=None, stretch=None):
+    """Return sinks that compute statistics and the visual image (if
+    *rgb_bands* is set) from the blocks of the final image of a volume while
+    it is written (see :func:`perusatproc.checkpoint.merge_tiles`)"""
+    sinks = []
+    if compute_stats:
+        sinks.append(stats.RasterStats.for_dataset)
+    if rgb_bands:
+        sinks.append(
+            visual.VisualWriter.factory(visual.visual_path(dst_path),
+                                        rgb_bands, stretch))
+    return sinks
+
+
+def pansharpen_volume(create_options=[],
+                      work_dir=None,
+                      progress=None,
+                      profile=STAGE_PROFILES['pansharpening'],
+                      tile_size=checkpoint.DEFAULT_TILE_SIZE,
+                      compute_stats=True,
+                      acquired=None,
+                      rgb_bands=None,
+                      merge=True,
+                      *,
+                      ms_img,
+                      p_img,
+                      dst_path):
+    """Pansharpen the MS and P images of a volume
+
+    If *merge* is False, pansharpened tiles are not merged into an image,
+    and *dst_path* is a virtual raster of the tiles (see
+    :func:`perusatproc.checkpoint.run_tiled`).
+    """
+    import rasterio
+
+    _logger.info("Pansharpen %s and %s and write %s", ms_img, p_img, dst_path)
+    with rasterio.open(p_img) as p_ds:
+        width, height = p_ds.width, p_ds.height
+    job, _ = os.path.splitext(os.path.basename(dst_path))
+    options = creation_options(profile, create_options)
+
+    stretch = None
+    if rgb_bands:
+        stretch = visual.compute_stretch(ms_img, bands=rgb_bands)
+    sinks = volume_sinks(dst_path, compute_stats, rgb_bands, stretch)
+
+    # Pansharpen tile by tile, so that an interrupted job resumes from the
+    # last finished tile
+    def pansharpen_tile(tile_path, box, tile_progress):
+        pansharpening.pansharpen(inp=p_img,
+                                 inxs=ms_img,
+                                 out=tile_path,
+                                 create_options=creation_options(SCRATCH),
+                                 box=box,
+                                 progress=tile_progress)
+
+    # Tiles of a run with another grid or options must not be reused
+    key = checkpoint.input_key([p_img, ms_img],
+                               tile_size=tile_size,
+                               create_options=options)
+    with StageProgress(progress, job, 'pansharpening',
+                       width * height) as report:
+        if tile_size and not merge:
+            tile_paths = checkpoint.run_tiled(pansharpen_tile,
+                                              dst_path,
+                                              width,
+                                              height,
+                                              key=key,
+                                              tile_size=tile_size,
+                                              progress=report,
+                                              merge=False)
+            outputs = []
+            tmp_path = temp_path(dst_path)
+            build_virtual_raster(inputs=tile_paths, dst=tmp_path)
+            commit(tmp_path, dst_path)
+        elif tile_size and max(width, height) > tile_size:
+            outputs = checkpoint.run_tiled(pansharpen_tile,
+                                           dst_path,
+                                           width,
+                                           height,
+                                           key=key,
+                                           tile_size=tile_size,
+                                           create_options=options,
+                                           progress=report,
+                                           sinks=sinks)
+        else:
+            # Images that fit in a tile are written once, and their blocks
+            # read back for the sinks (if any). Merging a scratch copy with
+            # the sinks instead would write and read the image once more too
+            # (both are compared by benchmarks/bench_sinks.py).
+            tmp_path = temp_path(dst_path)
+            pansharpening.pansharpen(inp=p_img,
+                                     inxs=ms_img,
+                                     out=tmp_path,
+                                     create_options=options,
+                                     progress=report,
+                                     pixels=width * height)
+            outputs = checkpoint.scan_image(tmp_path, sinks)
+            commit(tmp_path, dst_path)
+
+    if compute_stats:
+        outputs[0].write_sidecars(dst_path, datetime=acquired)
+
+    if work_dir:
+        _logger.info("Clean up volume temporary results")
+        shutil.rmtree(work_dir)
+
+    return dst_path
+
+
+def stream_volume(dem_path=None,
+                  geoid_path=None,
+                  spacing=None,
+                  create_options=[],
+                  scratch_create_options=[],
+                  work_dir=None,
+                  progress=None,
+                  profile=STAGE_PROFILES['pansharpening'],
+                  tile_size=streaming.DEFAULT_TILE_SIZE,
+                  compute_stats=True,
+                  acquired=None,
+                  rgb_bands=None,
+                  transcode_cache=None,
+                  calibration_engine=calibration.OTB,
+                  grid=None,
+                  merge=True,
+                  *,
+                  volume,
+                  dst_path):
+    """Process a volume with all stages running at once, tile by tile (see
+    :mod:`perusatproc.streaming`)
+
+    If *merge* is False, pansharpened tiles are not merged into an image,
+    and *dst_path* is a virtual raster of the tiles.
+    """
+    job, _ = os.path.splitext(os.path.basename(dst_path))
+
+    stretch = None
+    if rgb_bands:
+        ms_dir = product.find_image_dir(volume, product.MS)
+        dim_xml, _ = product.find_metadata_files(ms_dir)
+        stretch = visual.compute_reflectance_stretch(
+            os.path.join(ms_dir, extract_raster_filepath(dim_xml)),
+            dim_xml,
+            bands=rgb_bands)
+    sinks = volume_sinks(dst_path, compute_stats, rgb_bands, stretch)
+
+    with StageProgress(progress, job, 'streaming') as report:
+        outputs = streaming.stream_volume(
+            volume,
+            dst_path,
+            work_dir,
+            dem_path=dem_path,
+            geoid_path=geoid_path,
+            spacing=spacing,
+            tile_size=tile_size,
+            create_options=creation_options(profile, create_options),
+            scratch_create_options=scratch_create_options,
+            transcode_cache=transcode_cache,
+            calibration_engine=calibration_engine,
+            progress=report,
+            sinks=sinks,
+            grid=grid,
+            merge=merge)
+
+    if not merge:
+        tmp_path = temp_path(dst_path)
+        build_virtual_raster(inputs=outputs, dst=tmp_path)
+        commit(tmp_path, dst_path)
+        return dst_path
+
+    if compute_stats:
+        outputs[0].write_sidecars(dst_path, datetime=acquired)
+    return dst_path
+
+
+def volume_outputs(path):
+    """Return paths to the pansharpened image of a volume and the visual
+    image and metadata sidecars written with it"""
+    return [path] + [
+        p for p in [visual.visual_path(path)] + stats.sidecar_paths(path)
+        if os.path.exists(p)
+    ]
+
+
+def reuse_result(path):
+    """Return the result of a task that already finished on a previous run"""
+    _logger.info("Reuse %s from previous run", path)
+    return path
+
+
+def volume_tasks(volume,
+                 work_dir,
+                 dem_path=None,
+                 geoid_path=None,
+                 spacing=None,
+                 create_options=[],
+                 scratch_create_options=[],
+                 progress=None,
+                 pansharpen_profile=STAGE_PROFILES['pansharpening'],
+                 checkpoint_tile_size=checkpoint.DEFAULT_TILE_SIZE,
+                 compute_stats=True,
+                 write_visual=False,
+                 transcode_cache=None,
+                 calibration_engine=calibration.OTB,
+                 stream=False,
+                 stream_tile_size=streaming.DEFAULT_TILE_SIZE,
+                 grid=None,
+                 merge=True):
+    """Build tasks to process a volume: MS and P images, then pansharpening
+
+    The pansharpened image is written in *work_dir*, and intermediate results
+    of each image in its own subdirectory, so that tasks of different images
+    and volumes can run concurrently.
+
+    If *stream* is True, a single task processes the volume with all stages
+    running at once, tile by tile (see :mod:`perusatproc.streaming`).
+
+    If *grid* is given, the pansharpened image (and the P image) is
+    orthorectified into it, and the MS image into the same grid with larger
+    pixels (see :func:`perusatproc.orthorectification.volume_grid`).
+    Otherwise, OTB chooses the grid of each image.
+
+    If *merge* is False, pansharpened tiles are not merged into an image of
+    the volume, and the result of the last task is a virtual raster of the
+    tiles, which must not be moved out of *work_dir*. Statistics and visual
+    images are not computed then.
+
+    If the pansharpened image already exists in *work_dir* (i.e. the work
+    directory of an interrupted run is reused), it is not processed again.
+    """
+    name = os.path.basename(volume)
+    volume_work_dir = os.path.join(work_dir, name)
+    # There are tiles to merge only when pansharpening by tiles
+    merge = merge or not (stream or checkpoint_tile_size)
+    volume_dst_path = os.path.join(
+        work_dir, '{}.{}'.format(name, 'tif' if merge else 'vrt'))
+
+    if os.path.exists(volume_dst_path):
+        return [
+            Task(key='{}/pansharpen'.format(name),
+                 func=reuse_result,
+                 kwargs=dict(path=volume_dst_path),
+                 deps={})
+        ]
+
+    dim_xml, _ = product.find_metadata_files(
+        product.find_image_dir(volume, product.MS))
+    acquired = extract_acquisition_datetime(dim_xml).isoformat() + 'Z'
+
+    rgb_bands = None
+    if write_visual:
+        try:
+            rgb_bands = extract_display_bands(dim_xml)
+        except (KeyError, ValueError):
+            _logger.warning("No display bands in %s, use %s", dim_xml,
+                            visual.DEFAULT_RGB_BANDS)
+            rgb_bands = visual.DEFAULT_RGB_BANDS
+
+    if stream:
+        return [
+            Task(key='{}/pansharpen'.format(name),
+                 func=stream_volume,
+                 kwargs=dict(volume=volume,
+                             dst_path=volume_dst_path,
+                             work_dir=volume_work_dir,
+                             dem_path=dem_path,
+                             geoid_path=geoid_path,
+                             spacing=spacing,
+                             create_options=create_options,
+                             scratch_create_options=scratch_create_options,
+                             profile=pansharpen_profile,
+                             tile_size=stream_tile_size,
+                             compute_stats=compute_stats,
+                             acquired=acquired,
+                             rgb_bands=rgb_bands,
+                             transcode_cache=transcode_cache,
+                             calibration_engine=calibration_engine,
+                             grid=grid,
+                             merge=merge,
+                             progress=progress),
+                 deps={})
+        ]
+
+    grids = {product.MS: None, product.P: None}
+    if grid:
+        grids = {
+            product.MS: orthorectification.scale_grid(grid, PAN_RATIO),
+            product.P: grid
+        }
+
+    tasks = []
+    for kind in (product.MS, product.P):
+        img_dirname = product.find_image_dir(volume, kind)
+        tasks.append(
+            Task(key='{}/{}'.format(name, kind),
+                 func=process_image,
+                 kwargs=dict(src=img_dirname,
+                             dst=work_dir,
+                             work_dir=os.path.join(volume_work_dir, kind),
+                             dem_path=dem_path,
+                             geoid_path=geoid_path,
+                             spacing=spacing,
+                             scratch_create_options=scratch_create_options,
+                             transcode_cache=transcode_cache,
+                             calibration_engine=calibration_engine,
+                             grid=grids[kind],
+                             progress=progress),
+                 deps={}))
+
+    tasks.append(
+        Task(key='{}/pansharpen'.format(name),
+             func=pansharpen_volume,
+             kwargs=dict(dst_path=volume_dst_path,
+                         work_dir=volume_work_dir,
+                         create_options=create_options,
+                         profile=pansharpen_profile,
+                         tile_size=checkpoint_tile_size,
+                         compute_stats=compute_stats,
+                         acquired=acquired,
+                         rgb_bands=rgb_bands,
+                         merge=merge,
+                         progress=progress),
+             deps=dict(ms_img='{}/{}'.format(name, product.MS),
+                       p_img='{}/{}'.format(name, product.P))))
+    return tasks
 
 
 def process_product(src,
@@ -105,58 +502,268 @@ def process_product(src,
                     geoid_path=None,
                     spacing=None,
                     retile=False,
-                    create_options=[]):
-    volumes = glob(os.path.join(src, 'VOL_*'))
+                    create_options=[],
+                    scratch_create_options=[],
+                    build_overviews=True,
+                    overview_resampling=overviews.DEFAULT_RESAMPLING,
+                    jobs=None,
+                    executor=executors.LOCAL,
+                    scheduler=None,
+                    progress=None,
+                    plan=None,
+                    work_dir=None,
+                    output_format=GTIFF,
+                    zarr_chunk_size=zarr_store.DEFAULT_CHUNK_SIZE,
+                    checkpoint_tile_size=checkpoint.DEFAULT_TILE_SIZE,
+                    resume=False,
+                    compute_stats=True,
+                    write_visual=False,
+                    host_class=gdal_config.AUTO,
+                    gdal_options=[],
+                    transcode_cache=None,
+                    calibration_engine=calibration.OTB,
+                    stream=False,
+                    stream_tile_size=streaming.DEFAULT_TILE_SIZE,
+                    target_epsg=None,
+                    pixel_size=None,
+                    align=None):
+    gdal_config.configure(host_class,
+                          gdal_options,
+                          remote=s3.is_s3(src) or s3.is_s3(dst))
+
+    volumes = product.find_volumes(src)
     _logger.info("Num. Volumes: {}".format(len(volumes)))
 
-    gdal_imgs = []
-
-    for volume in volumes:
-        ms_dirname = glob(os.path.join(volume, 'IMG_*_MS_*'))[0]
-        p_dirname = glob(os.path.join(volume, 'IMG_*_P_*'))[0]
-
-        ms_img = process_image(src=ms_dirname,
-                               dst=dst,
-                               dem_path=dem_path,
-                               geoid_path=geoid_path,
-                               spacing=spacing)
-        p_img = process_image(src=p_dirname,
-                              dst=dst,
-                              dem_path=dem_path,
-                              geoid_path=geoid_path,
-                              spacing=spacing)
-
-        ortho_dir = os.path.join(dst, '_ortho')
-        volume_dst_path = os.path.join(
-            dst, '{}.tif'.format(os.path.basename(volume)))
-        pansharpening.pansharpen(inp=os.path.join(ortho_dir,
-                                                  os.path.basename(p_img)),
-                                 inxs=os.path.join(ortho_dir,
-                                                   os.path.basename(ms_img)),
-                                 out=volume_dst_path,
-                                 create_options=create_options)
-        gdal_imgs.append(volume_dst_path)
+    name = product.product_name(src)
 
-        _logger.info("Clean up volume temporary results")
-        shutil.rmtree(ortho_dir)
+    # Volumes are orthorectified into grids that share their pixels, so that
+    # they are mosaicked without resampling. Streaming always needs explicit
+    # grids, and so does Zarr output, whose mosaic is read from tiles of all
+    # volumes at once.
+    grids = {}
+    if stream or output_format == ZARR or target_epsg or pixel_size or align:
+        target_epsg, pixel_size = orthorectification.target_params(
+            volumes, target_epsg, pixel_size)
+        for volume in volumes:
+            grids[volume] = orthorectification.volume_grid(
+                volume, epsg=target_epsg, pixel_size=pixel_size, align=align)
+        _logger.info("Target grid of %s pixels (EPSG:%d)", pixel_size,
+                     target_epsg)
+
+    remote_dst = None
+    if s3.is_s3(dst):
+        # Results are written to a local staging directory, and uploaded to
+        # object storage as soon as each of them is ready
+        remote_dst = dst
+        if resume:
+            dst = os.path.join(work_dir or tempfile.gettempdir(),
+                               'perusatproc-{}'.format(name))
+            os.makedirs(dst, exist_ok=True)
+        else:
+            dst = tempfile.mkdtemp(prefix='perusatproc-', dir=work_dir)
+        _logger.info("Stage results on %s for upload to %s", dst,
+                     remote_dst)
+
+    # All intermediate and final results are written in a workspace unique to
+    # this run, and final results are then moved into place atomically. When
+    # resuming, the workspace is named after the product, so that the one of
+    # an interrupted run is reused.
+    with Workspace(dst, name=name if resume else None) as ws, \
+            s3.Uploader() as uploader:
+        # Pansharpened volumes are intermediate results when writing Zarr,
+        # and their tiles are read into the store without merging them first
+        pansharpen_options = dict(create_options=create_options,
+                                  compute_stats=compute_stats,
+                                  write_visual=write_visual)
+        if output_format == ZARR:
+            pansharpen_options = dict(create_options=scratch_create_options,
+                                      pansharpen_profile=SCRATCH,
+                                      compute_stats=False,
+                                      merge=False)
+            if write_visual:
+                _logger.warning("Visual images are not written for Zarr "
+                                "output")
+
+        tasks = []
+        volume_keys = []
+        for volume in volumes:
+            vol_tasks = volume_tasks(
+                volume,
+                ws.path,
+                dem_path=dem_path,
+                geoid_path=geoid_path,
+                spacing=spacing,
+                scratch_create_options=scratch_create_options,
+                progress=progress,
+                checkpoint_tile_size=checkpoint_tile_size,
+                transcode_cache=transcode_cache,
+                calibration_engine=calibration_engine,
+                stream=stream,
+                stream_tile_size=stream_tile_size,
+                grid=grids.get(volume),
+                **pansharpen_options)
+            tasks.extend(vol_tasks)
+            volume_keys.append(vol_tasks[-1].key)
+
+        def commit_volume(path):
+            # Move the image, its visual image and metadata sidecars into
+            # place
+            return [ws.commit(p) for p in volume_outputs(path)]
+
+        def visual_paths(paths):
+            return [
+                visual.visual_path(p) for p in paths
+                if os.path.exists(visual.visual_path(p))
+            ]
+
+        def finish_volume(path):
+            if build_overviews:
+                for p in [path] + visual_paths([path]):
+                    overviews.build_overviews(p,
+                                              resampling=overview_resampling)
+            for p in commit_volume(path):
+                uploader.submit(p, s3.join(remote_dst, os.path.basename(p)))
 
-    # Create pansharpened virtual raster
-    name, _ = os.path.splitext(os.path.basename(src))
-    vrt_path = os.path.join(dst, '{}.vrt'.format(name))
-    build_virtual_raster(inputs=gdal_imgs, dst=vrt_path)
+        finishing = []
 
-    if retile:
-        # Retile virtual raster
-        tiles_dir = os.path.join(dst, 'tiles')
-        _logger.info("Retile %s on %s using size (%d, %d)", vrt_path,
-                     tiles_dir, tile_size, tile_size)
-        retile_images(src=vrt_path, outdir=tiles_dir, tile_size=tile_size)
+        def upload_volume(key, path):
+            # Overviews are built in the background, so that the scheduler
+            # keeps submitting tasks meanwhile
+            if key in volume_keys:
+                finishing.append(uploader.run(finish_volume, path))
 
-        # Create virtual raster for all pansharpened tiles
-        tile_paths = glob(os.path.join(dst, '*.tif'))
-        tiles_vrt_path = os.path.join(tiles_dir, '{}.vrt'.format(name))
-        build_virtual_raster(inputs=tile_paths, dst=tiles_vrt_path)
-        _logger.info("Create virtual raster %s for tiles", tiles_vrt_path)
+        admission, costs = None, None
+        if plan:
+            # Admit tasks only while their estimated memory and scratch disk
+            # fit in what is available on this host
+            admission = planner.Admission(
+                memory=plan['resources']['memory'],
+                disk=plan['resources']['disk'] - plan['final_disk'])
+            costs = planner.task_costs(plan)
+
+        with executors.get_executor(executor, jobs=jobs,
+                                    address=scheduler) as pool:
+            results = run_tasks(tasks,
+                                pool,
+                                admission=admission,
+                                costs=costs,
+                                on_result=upload_volume if remote_dst
+                                and output_format == GTIFF else None)
+        volume_imgs = [results[key] for key in volume_keys]
+        # Volumes are committed when finished
+        for future in finishing:
+            future.result()
+
+        if output_format == ZARR:
+            # Write the mosaic of the pansharpened tiles of all volumes
+            # straight into a Zarr store
+            vrt_path = ws.join('{}.vrt'.format(name))
+            build_virtual_raster(inputs=volume_imgs, dst=vrt_path)
+            zarr_path = ws.join('{}.zarr'.format(name))
+            with StageProgress(progress, name, 'zarr') as report:
+                zarr_store.write_zarr(vrt_path,
+                                      zarr_path,
+                                      chunk_size=zarr_chunk_size,
+                                      jobs=jobs,
+                                      progress=report)
+            # Stale chunks of a previous run would not be overwritten, as
+            # chunks with no data are not written
+            zarr_dst_path = os.path.join(dst, os.path.basename(zarr_path))
+            shutil.rmtree(zarr_dst_path, ignore_errors=True)
+            ws.commit(zarr_path, zarr_dst_path)
+            if remote_dst:
+                uploader.submit_tree(
+                    zarr_dst_path,
+                    s3.join(remote_dst, os.path.basename(zarr_dst_path)))
+            if retile:
+                _logger.warning("Retiling is not supported for Zarr output")
+        else:
+            if remote_dst:
+                gdal_imgs = [
+                    os.path.join(dst, os.path.basename(path))
+                    for path in volume_imgs
+                ]
+            else:
+                if build_overviews:
+                    # Overviews of each volume are also used by GDAL as
+                    # implicit overviews of the virtual raster built below.
+                    _logger.info("Build overviews for %d volumes",
+                                 len(volume_imgs))
+                    overviews.build_all_overviews(
+                        volume_imgs + visual_paths(volume_imgs),
+                        resampling=overview_resampling,
+                        jobs=jobs)
+                gdal_imgs = [commit_volume(path)[0] for path in volume_imgs]
+
+            # Create pansharpened virtual raster
+            vrt_path = os.path.join(dst, '{}.vrt'.format(name))
+            vrt_tmp_path = temp_path(vrt_path)
+            build_virtual_raster(inputs=gdal_imgs, dst=vrt_tmp_path)
+            commit(vrt_tmp_path, vrt_path)
+            if remote_dst:
+                uploader.submit(
+                    vrt_path, s3.join(remote_dst, os.path.basename(vrt_path)))
+
+            if retile:
+                # Retile virtual raster
+                tiles_dir = os.path.join(dst, 'tiles')
+                tiles_work_dir = ws.subdir('tiles')
+                _logger.info("Retile %s on %s using size (%d, %d)", vrt_path,
+                             tiles_dir, tile_size, tile_size)
+                retile_images(src=vrt_path,
+                              outdir=tiles_work_dir,
+                              tile_size=tile_size,
+                              create_options=creation_options(
+                                  FINAL, create_options))
+                tile_paths = [
+                    os.path.join(tiles_dir, os.path.basename(path))
+                    for path in glob(os.path.join(tiles_work_dir, '*.tif'))
+                ]
+                ws.commit(tiles_work_dir, tiles_dir)
+
+                # Create virtual raster for all pansharpened tiles
+                tiles_vrt_path = os.path.join(tiles_dir,
+                                              '{}.vrt'.format(name))
+                tiles_vrt_tmp_path = temp_path(tiles_vrt_path)
+                build_virtual_raster(inputs=tile_paths,
+                                     dst=tiles_vrt_tmp_path)
+                commit(tiles_vrt_tmp_path, tiles_vrt_path)
+                _logger.info("Create virtual raster %s for tiles",
+                             tiles_vrt_path)
+                if remote_dst:
+                    uploader.submit_tree(tiles_dir,
+                                         s3.join(remote_dst, 'tiles'))
+
+    if remote_dst:
+        shutil.rmtree(dst, ignore_errors=True)
+
+
+def write_product_preview(src,
+                          dst,
+                          size=preview.DEFAULT_SIZE,
+                          dem_path=None,
+                          host_class=gdal_config.AUTO,
+                          gdal_options=[]):
+    """Write the preview of a product in *dst* (see
+    :mod:`perusatproc.preview`)"""
+    gdal_config.configure(host_class,
+                          gdal_options,
+                          remote=s3.is_s3(src) or s3.is_s3(dst))
+    if not s3.is_s3(dst):
+        os.makedirs(dst, exist_ok=True)
+        return preview.write_preview(src,
+                                     preview.preview_path(src, dst),
+                                     size=size,
+                                     dem_path=dem_path)
+
+    with tempfile.TemporaryDirectory(prefix='perusatproc-') as tmpdir:
+        path = preview.write_preview(src,
+                                     preview.preview_path(src, tmpdir),
+                                     size=size,
+                                     dem_path=dem_path)
+        uri = s3.join(dst, os.path.basename(path))
+        s3.upload(path, uri)
+    return uri
 
 
 def parse_args(args):
@@ -173,9 +780,7 @@ def parse_args(args):
         "Process a PeruSat-1 product into a set of calibrated, orthorectified and pansharpened tiles",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
-    parser.add_argument("--version",
-                        action="version",
-                        version="perusatproc {ver}".format(ver=__version__))
+    parser.add_argument("--version", action=VersionAction)
 
     parser.add_argument("-v",
                         "--verbose",
@@ -190,9 +795,17 @@ def parse_args(args):
                         action="store_const",
                         const=logging.DEBUG)
 
-    parser.add_argument("src", help="path to directory containing product")
-    parser.add_argument("dst",
-                        help="path to output directory containing tiles")
+    parser.add_argument(
+        "src",
+        help="path to directory or ZIP/TAR archive containing product "
+        "(local or s3:// URI)")
+    parser.add_argument(
+        "dst",
+        help="path to output directory containing tiles (local or s3:// URI)")
+    parser.add_argument("--work-dir",
+                        help="local directory where results are staged "
+                        "before uploading, when dst is an s3:// URI "
+                        "(defaults to system temporary directory)")
 
     parser.add_argument("--retile",
                         dest="retile",
@@ -207,6 +820,145 @@ def parse_args(args):
                         default=DEFAULT_TILE_SIZE,
                         help="tile size (in pixels)")
 
+    parser.add_argument("--overviews",
+                        dest="overviews",
+                        action="store_true",
+                        default=True,
+                        help="Build overviews for each processed volume")
+    parser.add_argument("--no-overviews",
+                        dest="overviews",
+                        action="store_false",
+                        help="Do not build overviews")
+    parser.add_argument("--stats",
+                        dest="stats",
+                        action="store_true",
+                        default=True,
+                        help="Compute statistics, histograms and footprint "
+                        "of each volume while writing it")
+    parser.add_argument("--no-stats",
+                        dest="stats",
+                        action="store_false",
+                        help="Do not compute statistics")
+    parser.add_argument("--visual",
+                        dest="visual",
+                        action="store_true",
+                        help="Also write an 8-bit RGB visual image of each "
+                        "volume, in the same pass")
+    parser.add_argument("--overview-resampling",
+                        choices=overviews.RESAMPLING_METHODS,
+                        default=overviews.DEFAULT_RESAMPLING,
+                        help="resampling method used for overviews")
+    parser.add_argument("--format",
+                        dest="output_format",
+                        choices=OUTPUT_FORMATS,
+                        default=GTIFF,
+                        help="output format of pansharpened mosaic: GeoTIFF "
+                        "volumes with a virtual raster, or a single chunked "
+                        "Zarr store")
+    parser.add_argument("--zarr-chunk-size",
+                        type=int,
+                        default=zarr_store.DEFAULT_CHUNK_SIZE,
+                        help="size of spatial chunks of Zarr output")
+    parser.add_argument("--checkpoint-tile-size",
+                        type=int,
+                        default=checkpoint.DEFAULT_TILE_SIZE,
+                        help="size of tiles in which long stages are computed "
+                        "and checkpointed (0 to disable)")
+    parser.add_argument("--stream",
+                        action="store_true",
+                        help="run calibration, orthorectification and "
+                        "pansharpening of each volume at once, tile by tile, "
+                        "into the target grid")
+    parser.add_argument("--stream-tile-size",
+                        type=int,
+                        default=streaming.DEFAULT_TILE_SIZE,
+                        help="size of panchromatic tiles with --stream")
+    parser.add_argument("--target-epsg",
+                        type=int,
+                        help="EPSG code of the CRS of output images "
+                        "(defaults to the UTM zone of the product)")
+    parser.add_argument("--pixel-size",
+                        type=float,
+                        help="size of output pixels in CRS units (defaults "
+                        "to the panchromatic ground spacing)")
+    parser.add_argument("--align",
+                        type=float,
+                        help="align the origin of output grids to multiples "
+                        "of this size in CRS units (defaults to 4 times the "
+                        "pixel size)")
+    parser.add_argument("--resume",
+                        action="store_true",
+                        help="reuse the workspace of an interrupted run of "
+                        "the same product, only computing missing results")
+    parser.add_argument("--transcode-cache",
+                        metavar="DIR",
+                        help="decode JPEG2000 source rasters once into "
+                        "GeoTIFFs cached in DIR, and read those instead")
+    parser.add_argument("--calibration-engine",
+                        choices=calibration.ENGINES,
+                        default=calibration.OTB,
+                        help="calibrate with OTB, or with per-band lookup "
+                        "tables of all 16-bit digital numbers (lut)")
+    parser.add_argument("--host-class",
+                        choices=[gdal_config.AUTO] + gdal_config.HOST_CLASSES,
+                        default=gdal_config.AUTO,
+                        help="preset of GDAL performance options (cache size, "
+                        "threads), guessed from CPUs and memory by default")
+    parser.add_argument("--gdal-config",
+                        dest="gdal_options",
+                        metavar="[STAGE:]KEY=VALUE",
+                        action="append",
+                        default=[],
+                        help="GDAL configuration option for all stages, or "
+                        "only for STAGE (e.g. overviews:GDAL_NUM_THREADS=8)")
+    parser.add_argument("-j",
+                        "--jobs",
+                        type=int,
+                        help="number of parallel jobs (defaults to number of CPUs)")
+    parser.add_argument("--executor",
+                        choices=executors.EXECUTORS,
+                        default=executors.LOCAL,
+                        help="how to run volume tasks: sequentially (local), "
+                        "on a process pool (process) or on a Dask cluster (dask)")
+    parser.add_argument("--scheduler",
+                        help="address of Dask scheduler (with --executor dask). "
+                        "Workers must share the destination filesystem")
+
+    parser.add_argument("--preview",
+                        action="store_true",
+                        help="only write a small RGB preview of the product "
+                        "(a Cloud Optimized GeoTIFF), rendered from decimated "
+                        "multispectral images in a few seconds")
+    parser.add_argument("--preview-size",
+                        type=int,
+                        default=preview.DEFAULT_SIZE,
+                        help="size in pixels of the longest side of the "
+                        "preview")
+
+    parser.add_argument("--plan",
+                        action="store_true",
+                        help="only estimate resources needed to process the "
+                        "product and print the plan as JSON (exits with "
+                        "status 1 if it does not fit on this host)")
+    parser.add_argument("--history",
+                        nargs="+",
+                        help="progress log files of past runs used to fit the "
+                        "cost model of the planner")
+    parser.add_argument("--strict",
+                        action="store_true",
+                        help="refuse to process product if the planner "
+                        "estimates it does not fit on this host, instead of "
+                        "only warning")
+
+    parser.add_argument("--progress-log",
+                        help="path to JSON lines file where progress events "
+                        "of each stage are appended")
+    parser.add_argument("--progress-interval",
+                        type=float,
+                        default=30,
+                        help="interval (in seconds) between progress summaries "
+                        "(local executor only)")
+
     parser.add_argument(
         "--dem",
         help=
@@ -221,7 +973,11 @@ def parse_args(args):
     parser.add_argument("-co",
                         "--create-options",
                         nargs="+",
-                        help="GDAL create options")
+                        help="GDAL create options for final images")
+    parser.add_argument("-sco",
+                        "--scratch-create-options",
+                        nargs="+",
+                        help="GDAL create options for intermediate images")
 
     return parser.parse_args(args)
 
@@ -253,6 +1009,55 @@ def main(args):
     if not args.dem:
         _logger.info(f"Using default DEM files from: {DEM_PATH}")
 
+    if args.preview:
+        write_product_preview(args.src,
+                              args.dst,
+                              size=args.preview_size,
+                              dem_path=args.dem,
+                              host_class=args.host_class,
+                              gdal_options=args.gdal_options)
+        return
+
+    model = None
+    if args.history:
+        events = [e for path in args.history for e in read_events(path)]
+        model = planner.fit_cost_model(events)
+    # When uploading to object storage, disk space is taken locally
+    local_dst = args.dst
+    if s3.is_s3(args.dst):
+        local_dst = args.work_dir or tempfile.gettempdir()
+    plan = planner.plan_product(args.src,
+                                local_dst,
+                                model=model,
+                                max_jobs=args.jobs)
+    if args.plan:
+        print(json.dumps(plan, indent=2))
+        if not plan['fits']:
+            sys.exit(1)
+        return
+    _logger.info(
+        "Plan: %d jobs, OTB RAM %d MB, ~%d MB memory, ~%d MB scratch disk, "
+        "~%d MB final disk, ~%.0f s", plan['jobs'], plan['otb_ram'],
+        plan['memory'] / planner.MB, plan['scratch_disk'] / planner.MB,
+        plan['final_disk'] / planner.MB, plan['seconds'])
+    if not plan['fits']:
+        # Estimates are rough, so only refuse to run when asked to
+        msg = 'Product is not expected to fit on this host ' \
+            '(memory or disk space). Use --plan to see estimates.'
+        if args.strict:
+            raise RuntimeError(msg)
+        _logger.warning(msg)
+    # OTB applications read their default RAM budget from this variable
+    os.environ.setdefault('OTB_MAX_RAM_HINT', str(plan['otb_ram']))
+
+    # Events are written to a file by workers, but they can only be
+    # aggregated in memory when tasks run on this process.
+    writer = JsonLinesWriter(args.progress_log) if args.progress_log else None
+    tracker = None
+    if args.executor == executors.LOCAL:
+        tracker = ProgressTracker(log_interval=args.progress_interval)
+    progress = MultiCallback(writer, tracker)
+
     process_product(args.src,
                     args.dst,
                     tile_size=args.tile_size,
@@ -260,7 +1065,32 @@ def main(args):
                     geoid_path=args.geoid,
                     spacing=args.spacing,
                     retile=args.retile,
-                    create_options=args.create_options)
+                    create_options=args.create_options,
+                    scratch_create_options=args.scratch_create_options,
+                    build_overviews=args.overviews,
+                    overview_resampling=args.overview_resampling,
+                    output_format=args.output_format,
+                    zarr_chunk_size=args.zarr_chunk_size,
+                    checkpoint_tile_size=args.checkpoint_tile_size,
+                    resume=args.resume,
+                    compute_stats=args.stats,
+                    write_visual=args.visual,
+                    host_class=args.host_class,
+                    gdal_options=args.gdal_options,
+                    transcode_cache=args.transcode_cache,
+                    calibration_engine=args.calibration_engine,
+                    stream=args.stream,
+                    stream_tile_size=args.stream_tile_size,
+                    target_epsg=args.target_epsg,
+                    pixel_size=args.pixel_size,
+                    align=args.align,
+                    jobs=args.jobs or plan['jobs'],
+                    executor=args.executor,
+                    scheduler=args.scheduler,
+                    progress=progress,
+                    # Resources of remote workers are not known here
+                    plan=plan if args.executor != executors.DASK else None,
+                    work_dir=args.work_dir)
 
 
 def run():
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+This script serves XYZ web map tiles of a raw PeruSat-1 product, calibrated,
+orthorectified and pansharpened on demand, without processing the whole
+product.
+
+"""
+
+import argparse
+import logging
+import sys
+
+from perusatproc.console import VersionAction
+from perusatproc import gdal_config, s3, tileserver
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+
+def parse_args(args):
+    """Parse command line parameters
+
+    Args:
+      args ([str]): command line parameters as list of strings
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = argparse.ArgumentParser(
+        description="Serve web map tiles of a raw PeruSat-1 product, "
+        "processed on demand",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("--version", action=VersionAction)
+
+    parser.add_argument("-v",
+                        "--verbose",
+                        dest="loglevel",
+                        help="set loglevel to INFO",
+                        action="store_const",
+                        const=logging.INFO)
+    parser.add_argument("-vv",
+                        "--very-verbose",
+                        dest="loglevel",
+                        help="set loglevel to DEBUG",
+                        action="store_const",
+                        const=logging.DEBUG)
+
+    parser.add_argument(
+        "src",
+        help="path to directory or ZIP/TAR archive containing product "
+        "(local or s3:// URI)")
+
+    parser.add_argument("--host",
+                        default="127.0.0.1",
+                        help="address to listen on")
+    parser.add_argument("--port",
+                        type=int,
+                        default=8080,
+                        help="port to listen on")
+    parser.add_argument("--min-zoom",
+                        type=int,
+                        default=tileserver.DEFAULT_MIN_ZOOM,
+                        help="minimum zoom level served")
+    parser.add_argument("--max-zoom",
+                        type=int,
+                        default=tileserver.DEFAULT_MAX_ZOOM,
+                        help="maximum zoom level served")
+    parser.add_argument("--cache-tiles",
+                        type=int,
+                        default=tileserver.DEFAULT_CACHE_TILES,
+                        help="number of tiles kept in memory")
+    parser.add_argument("--cache-dir",
+                        help="directory where rendered tiles are also cached")
+    parser.add_argument("--cache-dir-size",
+                        type=int,
+                        default=tileserver.DEFAULT_DISK_CACHE_SIZE // 2**20,
+                        help="maximum size of cache directory (in MB)")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=tileserver.DEFAULT_WORKERS,
+                        help="number of threads rendering tiles")
+
+    return parser.parse_args(args)
+
+
+def setup_logging(loglevel):
+    """Setup basic logging
+
+    Args:
+      loglevel (int): minimum loglevel for emitting messages
+    """
+    logformat = "[%(asctime)s] %(levelname)s:%(name)s:%(message)s"
+    logging.basicConfig(level=loglevel,
+                        stream=sys.stdout,
+                        format=logformat,
+                        datefmt="%Y-%m-%d %H:%M:%S")
+
+
+def main(args):
+    """Main entry point allowing external calls
+
+    Args:
+      args ([str]): command line parameter list
+    """
+    args = parse_args(args)
+    setup_logging(args.loglevel)
+
+    gdal_config.configure(remote=s3.is_s3(args.src))
+    tileserver.serve(args.src,
+                     host=args.host,
+                     port=args.port,
+                     min_zoom=args.min_zoom,
+                     max_zoom=args.max_zoom,
+                     cache_tiles=args.cache_tiles,
+                     cache_dir=args.cache_dir,
+                     max_disk_size=args.cache_dir_size * 2**20,
+                     workers=args.workers)
+
+
+def run():
+    """Entry point for console_scripts
+    """
+    main(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    run()
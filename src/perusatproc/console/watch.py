@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+This script watches a drop folder where PeruSat-1 products are delivered, and
+processes each volume as soon as all of its files are complete, on a bounded
+pool of worker processes.
+
+Results of each product are written to its own directory in the destination,
+as with perusat_process: a pansharpened image for each volume, and a virtual
+raster of all volumes, rebuilt each time a volume finishes.
+
+"""
+
+import argparse
+import collections
+import logging
+import os
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from glob import glob
+
+from perusatproc.console import VersionAction
+from perusatproc import checkpoint, executors, gdal_config, overviews, product, visual
+from perusatproc.console.process import build_virtual_raster, volume_outputs, volume_tasks
+from perusatproc.tasks import run_tasks
+from perusatproc.watch import DEFAULT_INTERVAL, DEFAULT_SETTLE, VolumeWatcher, needs_processing, write_source
+from perusatproc.workspace import Workspace, commit, temp_path
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+
+def process_volume(volume,
+                   dst,
+                   build_overviews=True,
+                   overview_resampling=overviews.DEFAULT_RESAMPLING,
+                   **options):
+    """Process a single volume into *dst*, and return paths to results
+
+    Intermediate results are written to a workspace named after the volume,
+    so that processing resumes if the daemon is restarted.
+    """
+    name = os.path.basename(volume)
+    with Workspace(dst, name=name) as ws:
+        tasks = volume_tasks(volume, ws.path, **options)
+        with executors.get_executor(executors.LOCAL) as pool:
+            results = run_tasks(tasks, pool)
+        path = results[tasks[-1].key]
+        if build_overviews:
+            for p in volume_outputs(path):
+                if p.endswith('.tif'):
+                    overviews.build_overviews(p,
+                                              resampling=overview_resampling)
+        return [ws.commit(p) for p in volume_outputs(path)]
+
+
+def volume_images(dst):
+    """Return paths to pansharpened volume images in *dst*"""
+    return sorted(path
+                  for path in glob(os.path.join(dst, '{}.tif'.format(
+                      product.VOLUME_PATTERN)))
+                  if not path.endswith(visual.VISUAL_SUFFIX))
+
+
+def update_virtual_raster(dst, name):
+    """Rebuild the virtual raster of all volumes processed so far"""
+    vrt_path = os.path.join(dst, '{}.vrt'.format(name))
+    vrt_tmp_path = temp_path(vrt_path)
+    build_virtual_raster(inputs=volume_images(dst), dst=vrt_tmp_path)
+    commit(vrt_tmp_path, vrt_path)
+    return vrt_path
+
+
+def parse_args(args):
+    """Parse command line parameters
+
+    Args:
+      args ([str]): command line parameters as list of strings
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = argparse.ArgumentParser(
+        description="Watch a drop folder and process volumes of PeruSat-1 "
+        "products as soon as they are delivered",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("--version", action=VersionAction)
+
+    parser.add_argument("-v",
+                        "--verbose",
+                        dest="loglevel",
+                        help="set loglevel to INFO",
+                        action="store_const",
+                        const=logging.INFO)
+    parser.add_argument("-vv",
+                        "--very-verbose",
+                        dest="loglevel",
+                        help="set loglevel to DEBUG",
+                        action="store_const",
+                        const=logging.DEBUG)
+
+    parser.add_argument("src",
+                        help="path to drop folder where products (directories "
+                        "or ZIP/TAR archives) are delivered")
+    parser.add_argument("dst",
+                        help="path to output directory, with a subdirectory "
+                        "for each product")
+
+    parser.add_argument("--interval",
+                        type=float,
+                        default=DEFAULT_INTERVAL,
+                        help="seconds between scans of the drop folder")
+    parser.add_argument("--settle",
+                        type=float,
+                        default=DEFAULT_SETTLE,
+                        help="seconds files of a volume must stay unchanged "
+                        "before processing it")
+    parser.add_argument("--no-inotify",
+                        dest="inotify",
+                        action="store_false",
+                        help="only poll the drop folder, even if inotify is "
+                        "available")
+    parser.add_argument("--once",
+                        action="store_true",
+                        help="process volumes that are ready and exit, "
+                        "instead of watching forever")
+    parser.add_argument("-j",
+                        "--jobs",
+                        type=int,
+                        default=1,
+                        help="number of volumes processed in parallel")
+
+    parser.add_argument("--overviews",
+                        dest="overviews",
+                        action="store_true",
+                        default=True,
+                        help="Build overviews for each processed volume")
+    parser.add_argument("--no-overviews",
+                        dest="overviews",
+                        action="store_false",
+                        help="Do not build overviews")
+    parser.add_argument("--overview-resampling",
+                        choices=overviews.RESAMPLING_METHODS,
+                        default=overviews.DEFAULT_RESAMPLING,
+                        help="resampling method used for overviews")
+    parser.add_argument("--stats",
+                        dest="stats",
+                        action="store_true",
+                        default=True,
+                        help="Compute statistics, histograms and footprint "
+                        "of each volume while writing it")
+    parser.add_argument("--no-stats",
+                        dest="stats",
+                        action="store_false",
+                        help="Do not compute statistics")
+    parser.add_argument("--visual",
+                        dest="visual",
+                        action="store_true",
+                        help="Also write an 8-bit RGB visual image of each "
+                        "volume, in the same pass")
+    parser.add_argument("--checkpoint-tile-size",
+                        type=int,
+                        default=checkpoint.DEFAULT_TILE_SIZE,
+                        help="size of tiles in which long stages are computed "
+                        "and checkpointed (0 to disable)")
+    parser.add_argument("--host-class",
+                        choices=[gdal_config.AUTO] + gdal_config.HOST_CLASSES,
+                        default=gdal_config.AUTO,
+                        help="preset of GDAL performance options (cache size, "
+                        "threads), guessed from CPUs and memory by default")
+    parser.add_argument("--gdal-config",
+                        dest="gdal_options",
+                        metavar="[STAGE:]KEY=VALUE",
+                        action="append",
+                        default=[],
+                        help="GDAL configuration option for all stages, or "
+                        "only for STAGE (e.g. overviews:GDAL_NUM_THREADS=8)")
+
+    parser.add_argument(
+        "--dem",
+        help=
+        "path to directory containing DEM files (defaults to SRTM 1-arc tiles)"
+    )
+    parser.add_argument("--geoid",
+                        help="path to geoid file (defaults to EGM96 geoid)")
+    parser.add_argument("--spacing",
+                        default=15,
+                        help="resampling grid spacing")
+
+    parser.add_argument("-co",
+                        "--create-options",
+                        nargs="+",
+                        help="GDAL create options for final images")
+    parser.add_argument("-sco",
+                        "--scratch-create-options",
+                        nargs="+",
+                        help="GDAL create options for intermediate images")
+
+    return parser.parse_args(args)
+
+
+def setup_logging(loglevel):
+    """Setup basic logging
+
+    Args:
+      loglevel (int): minimum loglevel for emitting messages
+    """
+    logformat = "[%(asctime)s] %(levelname)s:%(name)s:%(message)s"
+    logging.basicConfig(level=loglevel,
+                        stream=sys.stdout,
+                        format=logformat,
+                        datefmt="%Y-%m-%d %H:%M:%S")
+
+
+def main(args):
+    """Main entry point allowing external calls
+
+    Args:
+      args ([str]): command line parameter list
+    """
+    args = parse_args(args)
+    setup_logging(args.loglevel)
+
+    gdal_config.configure(args.host_class, args.gdal_options)
+
+    options = dict(dem_path=args.dem,
+                   geoid_path=args.geoid,
+                   spacing=args.spacing,
+                   create_options=args.create_options,
+                   scratch_create_options=args.scratch_create_options,
+                   build_overviews=args.overviews,
+                   overview_resampling=args.overview_resampling,
+                   checkpoint_tile_size=args.checkpoint_tile_size,
+                   compute_stats=args.stats,
+                   write_visual=args.visual)
+
+    watcher = VolumeWatcher(args.src,
+                            settle=args.settle,
+                            interval=args.interval,
+                            use_inotify=args.inotify)
+    _logger.info("Watch %s for new products", args.src)
+
+    queue = collections.deque()
+    running = {}
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        while True:
+            for product_path, volume in watcher.scan():
+                name = product.product_name(product_path)
+                dst = os.path.join(args.dst, name)
+                state = watcher.reported[volume]
+                output = os.path.join(dst, '{}.tif'.format(
+                    os.path.basename(volume)))
+                if not needs_processing(output, state):
+                    _logger.info("Volume %s was already processed", volume)
+                    continue
+                queue.append((name, volume, dst, state))
+
+            # Volumes wait in the queue until a worker is free
+            while queue and len(running) < args.jobs:
+                name, volume, dst, state = queue.popleft()
+                _logger.info("Process volume %s into %s", volume, dst)
+                future = pool.submit(process_volume, volume, dst, **options)
+                running[future] = (name, volume, dst, state)
+
+            if running:
+                done, _ = wait(running,
+                               timeout=watcher.timeout(),
+                               return_when=FIRST_COMPLETED)
+            else:
+                if args.once and not watcher.pending:
+                    break
+                watcher.wait()
+                done = []
+
+            for future in done:
+                name, volume, dst, state = running.pop(future)
+                try:
+                    future.result()
+                except Exception:
+                    # Volume is processed again only if delivered again
+                    _logger.exception("Failed to process volume %s", volume)
+                    continue
+                write_source(
+                    os.path.join(dst, '{}.tif'.format(
+                        os.path.basename(volume))), state)
+                vrt_path = update_virtual_raster(dst, name)
+                _logger.info("Volume %s done, updated %s", volume, vrt_path)
+
+
+def run():
+    """Entry point for console_scripts
+    """
+    main(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory processing of small windows of raw products, for on-demand tiles.
+
+This is a lightweight version of the batch pipeline, applied only to the
+pixels of a requested output grid (e.g. a web map tile):
+
+* Ground coordinates of output pixels are projected into each raw image with
+  its RPC model, at the mean height of the scene (no DEM), and only the
+  window of the raw image they fall in is read, decimated if the output grid
+  is coarser than the image.
+* Pixels are resampled bilinearly and calibrated to top of atmosphere
+  reflectance (as ``otbcli_OpticalCalibration -milli true``).
+* If the output grid is finer than the multispectral image, it is
+  pansharpened with the RCS method (as ``otbcli_BundleToPerfectSensor``): the
+  multispectral image is multiplied by the ratio of the panchromatic image
+  to its local mean.
+
+Results are meant for display and differ slightly from the batch results,
+which are orthorectified with a DEM.
+
+"""
+
+import logging
+import math
+import os
+import threading
+
+from perusatproc import product
+from perusatproc.calibration import toa_reflectance
+from perusatproc.metadata import extract_calibration_metadata, extract_display_bands, extract_footprint, extract_raster_filepath
+from perusatproc.rpc import RPCModel
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+# Radius (in panchromatic pixels) of the local mean of RCS pansharpening,
+# as the default of otbcli_BundleToPerfectSensor
+RCS_RADIUS = 9
+
+# Resolution of panchromatic relative to multispectral images
+PAN_RATIO = 4
+
+# Extra pixels read around windows, for bilinear interpolation
+WINDOW_MARGIN = 2
+
+
+def bilinear(data, cols, rows):
+    """Sample (bands, height, width) *data* at fractional pixel coordinates
+    (pixel centers at integers)
+
+    Returns:
+      tuple: (bands, *cols.shape) float32 array, and mask of coordinates
+      inside *data*
+    """
+    import numpy as np
+
+    h, w = data.shape[1:]
+    valid = (cols >= 0) & (cols <= w - 1) & (rows >= 0) & (rows <= h - 1)
+    c = np.clip(cols, 0, max(w - 1, 0))
+    r = np.clip(rows, 0, max(h - 1, 0))
+    c0 = np.minimum(np.floor(c).astype('int64'), max(w - 2, 0))
+    r0 = np.minimum(np.floor(r).astype('int64'), max(h - 2, 0))
+    c1 = np.minimum(c0 + 1, w - 1)
+    r1 = np.minimum(r0 + 1, h - 1)
+    fc = (c - c0).astype('float32')
+    fr = (r - r0).astype('float32')
+    data = data.astype('float32')
+    top = data[:, r0, c0] * (1 - fc) + data[:, r0, c1] * fc
+    bottom = data[:, r1, c0] * (1 - fc) + data[:, r1, c1] * fc
+    return top * (1 - fr) + bottom * fr, valid
+
+
+def box_mean(img, radius):
+    """Mean of each pixel of a 2D array over a (2 * radius + 1) square,
+    computed with an integral image"""
+    import numpy as np
+
+    size = 2 * radius + 1
+    padded = np.pad(img.astype('float64'), radius, mode='edge')
+    integral = np.pad(padded.cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+    total = (integral[size:, size:] - integral[:-size, size:] -
+             integral[size:, :-size] + integral[:-size, :-size])
+    return (total / size**2).astype('float32')
+
+
+def rcs_pansharpen(ms, pan, radius):
+    """Pansharpen (bands, h, w) *ms* with (h, w) *pan*, both on the same
+    grid, with the Relative Component Substitution method"""
+    import numpy as np
+
+    mean = box_mean(pan, radius)
+    ratio = np.divide(pan, mean, out=np.zeros_like(pan), where=mean > 0)
+    return ms * ratio
+
+
+class Image:
+    """Raw image of a volume, with its RPC model and calibration"""
+
+    def __init__(self, image_dir):
+        dim_xml, rpc_xml = product.find_metadata_files(image_dir)
+        self.dim_xml = dim_xml
+        self.path = os.path.join(image_dir, extract_raster_filepath(dim_xml))
+        self.rpc = RPCModel.from_metadata(rpc_xml)
+        self.calib = extract_calibration_metadata(dim_xml)
+        # Datasets are opened once per thread, as they are not thread-safe
+        self._local = threading.local()
+
+    def dataset(self):
+        import rasterio
+
+        ds = getattr(self._local, 'ds', None)
+        if ds is None:
+            ds = self._local.ds = rasterio.open(self.path)
+        return ds
+
+    def spacing(self, lons, lats, height):
+        """Return the distance in image pixels between adjacent output
+        pixels, at the center of a (h, w) grid of ground coordinates"""
+        i, j = lons.shape[0] // 2, lons.shape[1] // 2
+        cols, rows = self.rpc.project(lons[i, j:j + 2], lats[i, j:j + 2],
+                                      height)
+        return math.hypot(cols[1] - cols[0], rows[1] - rows[0])
+
+    def sample(self, lons, lats, height, bands=None):
+        """Return reflectance of the image at a grid of ground coordinates,
+        and mask of valid pixels, or None if the grid is outside the image
+
+        *height* is either a single height for all coordinates or an array
+        of the same shape.
+        """
+        import numpy as np
+        from rasterio.enums import Resampling
+        from rasterio.windows import Window
+
+        ds = self.dataset()
+        bands = list(bands or range(1, ds.count + 1))
+        cols, rows = self.rpc.project(lons, lats, height)
+
+        col0 = max(int(math.floor(cols.min())) - WINDOW_MARGIN, 0)
+        row0 = max(int(math.floor(rows.min())) - WINDOW_MARGIN, 0)
+        col1 = min(int(math.ceil(cols.max())) + WINDOW_MARGIN + 1, ds.width)
+        row1 = min(int(math.ceil(rows.max())) + WINDOW_MARGIN + 1, ds.height)
+        if col1 <= col0 or row1 <= row0:
+            return None
+
+        # Read coarser grids decimated, which lets GDAL use overviews or
+        # JPEG2000 resolution levels
+        dec = max(1, int(self.spacing(lons, lats, float(np.mean(height)))))
+        out_shape = (len(bands), math.ceil((row1 - row0) / dec),
+                     math.ceil((col1 - col0) / dec))
+        data = ds.read(bands,
+                       window=Window(col0, row0, col1 - col0, row1 - row0),
+                       out_shape=out_shape,
+                       resampling=Resampling.average)
+
+        # Center of decimated pixel k is at k * dec + (dec - 1) / 2
+        offset = (dec - 1) / 2
+        values, valid = bilinear(data, (cols - col0 - offset) / dec,
+                                 (rows - row0 - offset) / dec)
+        valid &= (values != 0).any(axis=0)
+        calib = dict(self.calib)
+        for key in ('gains', 'biases', 'solar_irradiances'):
+            calib[key] = [calib[key][b - 1] for b in bands]
+        return toa_reflectance(values, calib), valid
+
+
+class Volume:
+    """Volume of a raw product, rendered on demand"""
+
+    def __init__(self, volume):
+        self.name = os.path.basename(volume)
+        self.ms = Image(product.find_image_dir(volume, product.MS))
+        self.p = Image(product.find_image_dir(volume, product.P))
+        self.height = self.p.rpc.height_offset
+
+        coords = extract_footprint(self.ms.dim_xml)['coordinates'][0]
+        lons, lats = zip(*coords)
+        self.bounds = (min(lons), min(lats), max(lons), max(lats))
+
+        try:
+            self.rgb_bands = extract_display_bands(self.ms.dim_xml)
+        except (KeyError, ValueError):
+            from perusatproc.visual import DEFAULT_RGB_BANDS
+            self.rgb_bands = DEFAULT_RGB_BANDS
+
+    def intersects(self, bounds):
+        w, s, e, n = bounds
+        return not (e < self.bounds[0] or w > self.bounds[2]
+                    or n < self.bounds[1] or s > self.bounds[3])
+
+    def render(self, lons, lats, bands=None, heights=None):
+        """Return pansharpened reflectance of *bands* of the MS image (all
+        by default) at a grid of ground coordinates, and mask of valid
+        pixels, or None if the grid is outside the volume
+
+        *heights* are ellipsoidal heights of the coordinates, which default to
+        the mean height of the scene.
+        """
+        import numpy as np
+
+        bands = list(bands or range(1, self.ms.dataset().count + 1))
+        height = self.height if heights is None else heights
+
+        # Pansharpen only if output pixels are smaller than MS pixels
+        spacing = self.p.spacing(lons, lats, self.height)
+        radius = 0
+        if spacing < PAN_RATIO:
+            radius = max(1, int(round(RCS_RADIUS / max(spacing, 1e-6))))
+
+        if radius:
+            # Pad the grid so that the local mean of the panchromatic image
+            # is complete at the edges
+            lons, lats = _pad_grid(lons, lats, radius)
+            if heights is not None:
+                height = np.pad(heights, radius, mode='edge')
+
+        ms = self.ms.sample(lons, lats, height, bands=bands)
+        if ms is None:
+            return None
+        values, valid = ms
+        if radius:
+            p = self.p.sample(lons, lats, height)
+            if p is not None:
+                pan, p_valid = p
+                values = rcs_pansharpen(values, pan[0], radius)
+                valid &= p_valid
+            crop = (slice(radius, -radius), slice(radius, -radius))
+            values = values[(slice(None), ) + crop]
+            valid = valid[crop]
+        return values, valid
+
+
+def _pad_grid(lons, lats, pad):
+    # Extrapolate a regular grid of coordinates by *pad* cells on each side
+    import numpy as np
+
+    h, w = lons.shape
+    dx = (lons[0, -1] - lons[0, 0]) / max(w - 1, 1)
+    dy = (lats[-1, 0] - lats[0, 0]) / max(h - 1, 1)
+    cols = lons[0, 0] + dx * np.arange(-pad, w + pad)
+    # Rows of web mercator grids are not evenly spaced in latitude, but
+    # they are almost so at the scale of the padding
+    rows = np.concatenate([
+        lats[0, 0] + dy * np.arange(-pad, 0), lats[:, 0],
+        lats[-1, 0] + dy * np.arange(1, pad + 1)
+    ])
+    return np.meshgrid(cols, rows)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import pickle
+from concurrent.futures import Executor, Future
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+LOCAL = 'local'
+PROCESS = 'process'
+DASK = 'dask'
+
+EXECUTORS = [LOCAL, PROCESS, DASK]
+
+
+class LocalExecutor(Executor):
+    """Executor that runs each task synchronously on submit
+
+    With *serialize* enabled, functions and arguments are pickled and
+    unpickled before running, as a remote scheduler would do. This makes it a
+    cheap stand-in to check that tasks can be distributed.
+    """
+
+    def __init__(self, serialize=False):
+        self.serialize = serialize
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            if self.serialize:
+                fn, args, kwargs = pickle.loads(pickle.dumps(
+                    (fn, args, kwargs)))
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as err:
+            future.set_exception(err)
+        return future
+
+
+class ClientExecutor(Executor):
+    """Executor of a Dask client, that closes the client when shut down
+    (e.g. when leaving a ``with`` block)"""
+
+    def __init__(self, client):
+        self.client = client
+        self.executor = client.get_executor()
+
+    def submit(self, fn, *args, **kwargs):
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def shutdown(self, wait=True, **kwargs):
+        try:
+            self.executor.shutdown(wait=wait)
+        finally:
+            self.client.close()
+
+
+def get_executor(kind=LOCAL, jobs=None, address=None):
+    """Create an executor of a specific *kind*
+
+    Args:
+      kind (str): one of ``local``, ``process`` or ``dask``
+      jobs (int): number of worker processes (``process`` only)
+      address (str): scheduler address (``dask`` only). If not set, a local
+        Dask cluster is started.
+
+    Returns:
+      :class:`concurrent.futures.Executor`
+    """
+    if kind == LOCAL:
+        return LocalExecutor()
+    elif kind == PROCESS:
+        from concurrent.futures import ProcessPoolExecutor
+        return ProcessPoolExecutor(max_workers=jobs)
+    elif kind == DASK:
+        try:
+            from distributed import Client
+        except ImportError:
+            raise RuntimeError(
+                "Dask executor requires the 'distributed' package. "
+                "Install it with `pip install perusatproc[dask]`.")
+        _logger.info("Connect to Dask scheduler at %s", address or "local cluster")
+        # Workers must share a filesystem with the client, as tasks read and
+        # write their inputs and outputs by path.
+        return ClientExecutor(Client(address))
+    raise ValueError('Unknown executor: {}'.format(kind))
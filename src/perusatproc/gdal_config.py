@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+GDAL performance configuration shared by all stages.
+
+A preset of GDAL configuration options (block cache size, compression
+threads, file cache...) is chosen by host class, either given or guessed
+from the CPUs and memory of the host. Options can be overriden globally, or
+only for a stage, with ``[STAGE:]KEY=VALUE`` strings.
+
+Global options are set in the environment, so that they are used both by
+rasterio in this process and by OTB and GDAL subprocesses and worker
+processes. Options already set in the environment are kept, unless
+overriden explicitly. Stage options are applied on top of them with
+:func:`env` (for rasterio) and :func:`subprocess_env` (for commands).
+
+"""
+
+import json
+import logging
+import os
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+GB = 2**30
+
+SMALL = 'small'
+STANDARD = 'standard'
+LARGE = 'large'
+AUTO = 'auto'
+HOST_CLASSES = [SMALL, STANDARD, LARGE]
+
+# Common to all presets. Directories are not listed when opening a file
+# (sidecar files are still found, by name)
+COMMON_OPTIONS = dict(
+    GDAL_DISABLE_READDIR_ON_OPEN='TRUE',
+    VSI_CACHE='TRUE',
+)
+
+# GDAL_CACHEMAX is in MB, and is per process: there is usually one process
+# per job, so presets keep it well below memory / jobs
+PRESETS = {
+    SMALL:
+    dict(GDAL_CACHEMAX='256',
+         GDAL_NUM_THREADS='2',
+         VSI_CACHE_SIZE=str(64 * 2**20)),
+    STANDARD:
+    dict(GDAL_CACHEMAX='512',
+         GDAL_NUM_THREADS='4',
+         VSI_CACHE_SIZE=str(128 * 2**20)),
+    LARGE:
+    dict(GDAL_CACHEMAX='2048',
+         GDAL_NUM_THREADS='ALL_CPUS',
+         VSI_CACHE_SIZE=str(256 * 2**20)),
+}
+
+# Default options of each stage, on top of global options
+STAGE_OPTIONS = {
+    'overviews': dict(COMPRESS_OVERVIEW='DEFLATE', PREDICTOR_OVERVIEW='2'),
+    # JPEG2000 decoding and compression are multi-threaded
+    'transcode': dict(GDAL_NUM_THREADS='ALL_CPUS'),
+    # Only our own results are opened, which have no sidecar files
+    'vrt': dict(GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR'),
+}
+
+# Stage overrides are passed to worker processes through this variable
+STAGE_OPTIONS_ENV = 'PERUSATPROC_GDAL_STAGE_OPTIONS'
+
+
+def guess_host_class(resources=None):
+    """Return the host class of a host from its CPUs and memory"""
+    if resources is None:
+        from perusatproc.planner import host_resources
+        resources = host_resources()
+    cpus = resources['cpus']
+    memory = resources['memory'] or 0
+    if cpus <= 4 or memory < 8 * GB:
+        return SMALL
+    if cpus >= 16 and memory >= 64 * GB:
+        return LARGE
+    return STANDARD
+
+
+def parse_overrides(overrides):
+    """Parse ``[STAGE:]KEY=VALUE`` strings into global and stage options
+
+    Returns:
+      tuple: (dict of global options, dict of options by stage)
+    """
+    global_opts, stage_opts = {}, {}
+    for override in overrides or []:
+        opt, sep, value = override.partition('=')
+        if not sep:
+            raise ValueError(
+                'Invalid GDAL option {!r}, expected [STAGE:]KEY=VALUE'.format(
+                    override))
+        stage, _, key = opt.rpartition(':')
+        key = key.strip().upper()
+        if stage:
+            stage_opts.setdefault(stage.strip(), {})[key] = value.strip()
+        else:
+            global_opts[key] = value.strip()
+    return global_opts, stage_opts
+
+
+def configure(host_class=AUTO, overrides=[], remote=False):
+    """Set global GDAL options of a host class in the environment
+
+    Args:
+      host_class (str): one of :data:`HOST_CLASSES`, or ``auto`` to guess
+        it from this host
+      overrides ([str]): ``[STAGE:]KEY=VALUE`` options that replace those of
+        the preset and the environment
+      remote (bool): also set options for reading from object storage (see
+        :data:`perusatproc.s3.GDAL_OPTIONS`)
+
+    Returns:
+      dict: global options
+    """
+    if host_class == AUTO:
+        host_class = guess_host_class()
+    options = dict(COMMON_OPTIONS)
+    options.update(PRESETS[host_class])
+    if remote:
+        from perusatproc.s3 import GDAL_OPTIONS
+        options.update(GDAL_OPTIONS)
+
+    global_opts, stage_opts = parse_overrides(overrides)
+    for key, value in options.items():
+        os.environ.setdefault(key, value)
+    os.environ.update(global_opts)
+    if stage_opts:
+        os.environ[STAGE_OPTIONS_ENV] = json.dumps(stage_opts)
+
+    options.update(global_opts)
+    _logger.info("GDAL options (%s host): %s", host_class,
+                 {k: os.environ[k] for k in options})
+    return options
+
+
+def stage_options(stage):
+    """Return GDAL options of a stage, on top of global options"""
+    options = dict(STAGE_OPTIONS.get(stage, {}))
+    overrides = json.loads(os.environ.get(STAGE_OPTIONS_ENV) or '{}')
+    options.update(overrides.get(stage, {}))
+    return options
+
+
+def env(stage=None, **options):
+    """Return a :class:`rasterio.Env` with the options of a stage
+
+    Extra *options* take precedence over stage options.
+    """
+    import rasterio
+
+    opts = stage_options(stage) if stage else {}
+    opts.update(options)
+    return rasterio.Env(**opts)
+
+
+def subprocess_env(stage=None):
+    """Return the environment of a command run for a stage"""
+    environ = dict(os.environ)
+    if stage:
+        environ.update(stage_options(stage))
+    return environ
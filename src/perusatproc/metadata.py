@@ -1,10 +1,11 @@
 # -*- coding: utf-8 -*-
 
-import xmltodict
+import functools
 import logging
-import os
 from datetime import datetime
 
+from perusatproc import vfs
+
 __author__ = "Damián Silvani"
 __copyright__ = "Dymaxion Labs"
 __license__ = "mit"
@@ -19,11 +20,32 @@ RPC_COEFF_PAIRS = [
 ]
 
 
-def read_metadata(path):
-    with open(path) as f:
+@functools.lru_cache(maxsize=64)
+def _parse_metadata(path, mtime, size):
+    import xmltodict
+
+    with vfs.open(path) as f:
         return xmltodict.parse(f.read())
 
 
+def read_metadata(path):
+    # Parsed documents are cached by modification time and size, so that the
+    # several extract_* calls on the same DIMAP file parse it only once.
+    # Path can also be a file inside an archive (see perusatproc.vfs).
+    return _parse_metadata(path, *vfs.cache_key(path))
+
+
+def _imaging_datetime(doc):
+    strip_source = doc['Dataset_Sources']['Source_Identification'][
+        'Strip_Source']
+    date_str, time_str = strip_source['IMAGING_DATE'], strip_source[
+        'IMAGING_TIME']
+    # Tolerate fractional seconds in IMAGING_TIME
+    time_str = time_str.split('.')[0]
+    return datetime.strptime('{}T{}'.format(date_str, time_str),
+                             "%Y-%m-%dT%H:%M:%S")
+
+
 def extract_raster_filepath(metadata_path):
     body = read_metadata(metadata_path)
     doc = body['Dimap_Document']
@@ -35,12 +57,7 @@ def extract_calibration_metadata(metadata_path):
     doc = body['Dimap_Document']
 
     # Image date and time
-    strip_source = doc['Dataset_Sources']['Source_Identification'][
-        'Strip_Source']
-    date_str, time_str = strip_source['IMAGING_DATE'], strip_source[
-        'IMAGING_TIME']
-    date = datetime.strptime(date_str, "%Y-%m-%d")
-    time = datetime.strptime(time_str, "%H:%M:%S")
+    acquired = _imaging_datetime(doc)
 
     geom_values = doc['Geometric_Data']['Use_Area']['Located_Geometric_Values']
 
@@ -69,11 +86,11 @@ def extract_calibration_metadata(metadata_path):
         band_solar_irradiances = [band_solar_irradiances]
     solar_irradiances = [float(r['VALUE']) for r in band_solar_irradiances]
 
-    return dict(minute=time.minute,
-                hour=time.hour,
-                day=date.day,
-                month=date.month,
-                year=date.year,
+    return dict(minute=acquired.minute,
+                hour=acquired.hour,
+                day=acquired.day,
+                month=acquired.month,
+                year=acquired.year,
                 sun_elev=sun_elev,
                 sun_azim=sun_azim,
                 view_elev=view_elev,
@@ -91,6 +108,7 @@ def extract_projection_metadata(metadata_path):
     raster_dimensions = doc['Raster_Data']['Raster_Dimensions']
     sizex = int(raster_dimensions['NCOLS'])
     sizey = int(raster_dimensions['NROWS'])
+    nbands = int(raster_dimensions.get('NBANDS', 1))
 
     # Raster extent
     vertices = doc['Dataset_Content']['Dataset_Extent']['Vertex']
@@ -101,15 +119,50 @@ def extract_projection_metadata(metadata_path):
 
     return dict(sizex=sizex,
                 sizey=sizey,
+                nbands=nbands,
                 ulx=minx,
                 uly=maxy,
                 lrx=maxx,
                 lry=miny)
 
 
+def extract_footprint(metadata_path):
+    body = read_metadata(metadata_path)
+    doc = body['Dimap_Document']
+
+    vertices = doc['Dataset_Content']['Dataset_Extent']['Vertex']
+    coords = [[float(v['LON']), float(v['LAT'])] for v in vertices]
+    # Close the ring, as required by GeoJSON polygons
+    if coords and coords[0] != coords[-1]:
+        coords.append(coords[0])
+
+    return dict(type='Polygon', coordinates=[coords])
+
+
+def extract_display_bands(metadata_path):
+    """Return indexes (starting from 1) of the bands displayed as red, green
+    and blue, in the order bands are stored in the image"""
+    body = read_metadata(metadata_path)
+    doc = body['Dimap_Document']
+
+    display_order = doc['Raster_Data']['Raster_Display']['Band_Display_Order']
+    band_radiances = doc['Radiometric_Data']['Radiometric_Calibration'][
+        'Instrument_Calibration']['Band_Measurement_List']['Band_Radiance']
+    if not isinstance(band_radiances, list):
+        band_radiances = [band_radiances]
+    band_ids = [r['BAND_ID'] for r in band_radiances]
+    return tuple(
+        band_ids.index(display_order[channel]) + 1
+        for channel in ('RED_CHANNEL', 'GREEN_CHANNEL', 'BLUE_CHANNEL'))
+
+
+def extract_acquisition_datetime(metadata_path):
+    body = read_metadata(metadata_path)
+    return _imaging_datetime(body['Dimap_Document'])
+
+
 def extract_rpc_metadata(metadata_path):
-    with open(metadata_path) as f:
-        body = xmltodict.parse(f.read())
+    body = read_metadata(metadata_path)
 
     doc = body['Rpc_Document']
 
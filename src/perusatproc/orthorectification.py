@@ -1,13 +1,15 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import math
 import os
-import pkg_resources
+from collections import namedtuple
 
-import rasterio
-
-from perusatproc.metadata import extract_projection_metadata, extract_rpc_metadata
-from perusatproc.util import run_otb_command
+from perusatproc import gdal_config, product
+from perusatproc.dynamic import PAN_RATIO
+from perusatproc.metadata import extract_footprint, extract_projection_metadata, extract_rpc_metadata
+from perusatproc.profiles import rasterio_options
+from perusatproc.util import otb_output_path, run_otb_command
 
 __author__ = "Damián Silvani"
 __copyright__ = "Dymaxion Labs"
@@ -15,7 +17,17 @@ __license__ = "mit"
 
 _logger = logging.getLogger(__name__)
 
-DATA_DIR = pkg_resources.resource_filename('perusatproc', 'data')
+
+def _data_dir():
+    try:
+        from importlib.resources import files
+    except ImportError:  # pragma: no cover
+        # TODO: Remove when `python_requires = >= 3.9`
+        return os.path.join(os.path.dirname(__file__), 'data')
+    return str(files('perusatproc') / 'data')
+
+
+DATA_DIR = _data_dir()
 GEOID_PATH = os.path.join(DATA_DIR, 'egm96.grd')
 DEM_PATH = os.path.join(DATA_DIR, 'dem')
 
@@ -38,8 +50,178 @@ RPC_COEFF_KEYS = [
     'samp_den_coeffs',
 ]
 
+# Meters per degree of latitude, and of longitude at the equator
+METERS_PER_DEGREE_LAT = 110574.0
+METERS_PER_DEGREE_LON = 111320.0
+
+# Points sampled along each edge of footprints, to compute their bounds in
+# another CRS
+EDGE_POINTS = 16
+
+OutputGrid = namedtuple('OutputGrid',
+                        ['epsg', 'ulx', 'uly', 'width', 'height', 'pixel_size'])
+OutputGrid.__doc__ = """Grid of an orthorectified image
+
+*ulx* and *uly* are the coordinates of the upper left corner of the grid (not
+the center of its first pixel), in the CRS of EPSG code *epsg*, and
+*pixel_size* the size of its square pixels, in CRS units.
+"""
+
+
+def utm_epsg(lon, lat):
+    """Return the EPSG code of the WGS84 UTM zone of a point"""
+    zone = int((lon + 180) // 6) % 60 + 1
+    return (32600 if lat >= 0 else 32700) + zone
+
+
+def ground_spacing(rpc, lon, lat, height=None):
+    """Return the ground distance in meters between pixels of an image, at a
+    point, from its :class:`perusatproc.rpc.RPCModel`"""
+    d = 1e-4
+    cols, rows = rpc.project([lon, lon + d, lon], [lat, lat, lat + d], height)
+    dx = d * METERS_PER_DEGREE_LON * math.cos(math.radians(lat))
+    dy = d * METERS_PER_DEGREE_LAT
+    # Area of the ground covered by a pixel, from the Jacobian of the
+    # projection
+    det = ((cols[1] - cols[0]) / dx * (rows[2] - rows[0]) / dy -
+           (cols[2] - cols[0]) / dy * (rows[1] - rows[0]) / dx)
+    return math.sqrt(1 / abs(det))
+
+
+def footprint_bounds(metadata_path, epsg):
+    """Return (minx, miny, maxx, maxy) bounds of the footprint of an image in
+    the CRS of EPSG code *epsg*"""
+    from rasterio.warp import transform
+
+    ring = extract_footprint(metadata_path)['coordinates'][0]
+    lons, lats = [], []
+    for (x0, y0), (x1, y1) in zip(ring[:-1], ring[1:]):
+        for k in range(EDGE_POINTS):
+            lons.append(x0 + (x1 - x0) * k / EDGE_POINTS)
+            lats.append(y0 + (y1 - y0) * k / EDGE_POINTS)
+    xs, ys = transform('EPSG:4326', 'EPSG:{}'.format(epsg), lons, lats)
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def default_pixel_size(rpc, epsg):
+    """Return the ground spacing of an image at its center, from its
+    :class:`perusatproc.rpc.RPCModel`, as a pixel size in the CRS of EPSG
+    code *epsg*: rounded to centimeters in projected CRSs, and converted to
+    degrees in geographic CRSs"""
+    from rasterio.crs import CRS
+
+    size = ground_spacing(rpc, rpc.params['lon_offset'],
+                          rpc.params['lat_offset'])
+    if CRS.from_epsg(epsg).is_geographic:
+        return size / METERS_PER_DEGREE_LAT
+    return round(size, 2)
+
+
+def output_grid(dim_xml, rpc_xml, pixel_size=None, align=None, epsg=None):
+    """Return the :class:`OutputGrid` that covers an image
+
+    Args:
+      dim_xml (str): path to DIMAP metadata file of the image
+      rpc_xml (str): path to RPC metadata file of the image
+      pixel_size (float): size of pixels in CRS units (see
+        :func:`default_pixel_size` for the default)
+      align (float): bounds are aligned to multiples of this size (defaults
+        to *pixel_size*)
+      epsg (int): EPSG code of the CRS of the grid (defaults to the UTM zone
+        of the center of the image)
+    """
+    from perusatproc.rpc import RPCModel
+
+    rpc = RPCModel.from_metadata(rpc_xml)
+    if not epsg:
+        epsg = utm_epsg(rpc.params['lon_offset'], rpc.params['lat_offset'])
+    if not pixel_size:
+        pixel_size = default_pixel_size(rpc, epsg)
+    align = align or pixel_size
+
+    minx, miny, maxx, maxy = footprint_bounds(dim_xml, epsg)
+    ulx = math.floor(minx / align) * align
+    uly = math.ceil(maxy / align) * align
+    lrx = math.ceil(maxx / align) * align
+    lry = math.floor(miny / align) * align
+    return OutputGrid(epsg=epsg,
+                      ulx=ulx,
+                      uly=uly,
+                      width=int(round((lrx - ulx) / pixel_size)),
+                      height=int(round((uly - lry) / pixel_size)),
+                      pixel_size=pixel_size)
+
+
+def target_params(volumes, epsg=None, pixel_size=None):
+    """Return (epsg, pixel_size) of a grid shared by all *volumes* of a
+    product, by default the UTM zone and the panchromatic ground spacing of
+    the first volume"""
+    from perusatproc.rpc import RPCModel
+
+    if epsg and pixel_size:
+        return epsg, pixel_size
+    _, rpc_xml = product.find_metadata_files(
+        product.find_image_dir(volumes[0], product.P))
+    rpc = RPCModel.from_metadata(rpc_xml)
+    if not epsg:
+        epsg = utm_epsg(rpc.params['lon_offset'], rpc.params['lat_offset'])
+    if not pixel_size:
+        pixel_size = default_pixel_size(rpc, epsg)
+    return epsg, pixel_size
+
+
+def volume_grid(volume, epsg=None, pixel_size=None, align=None):
+    """Return the grid of the panchromatic (and pansharpened) image of a
+    volume
+
+    The grid of the multispectral image is the same one with PAN_RATIO times
+    larger pixels (see :func:`scale_grid`), so bounds are aligned to
+    multispectral pixels. Grids of volumes with the same *epsg*, *pixel_size*
+    and *align* share their pixels (i.e. have target-aligned pixels), so
+    their images can be mosaicked without resampling.
+
+    Args:
+      volume (str): path to volume
+      epsg, pixel_size: see :func:`output_grid`
+      align (float): bounds are aligned to multiples of this size, which
+        must be a multiple of the multispectral pixel size (its default)
+    """
+    dim_xml, rpc_xml = product.find_metadata_files(
+        product.find_image_dir(volume, product.P))
+    if not pixel_size:
+        epsg, pixel_size = target_params([volume], epsg)
+    ms_size = pixel_size * PAN_RATIO
+    if align:
+        steps = align / ms_size
+        if abs(steps - round(steps)) > 1e-6 or round(steps) < 1:
+            raise ValueError(
+                'Alignment {} is not a multiple of the multispectral pixel '
+                'size {}'.format(align, ms_size))
+    return output_grid(dim_xml,
+                       rpc_xml,
+                       pixel_size=pixel_size,
+                       align=align or ms_size,
+                       epsg=epsg)
+
+
+def scale_grid(grid, factor):
+    """Return a grid with the same bounds as *grid* and pixels *factor* times
+    larger (bounds must be aligned to the larger pixels)"""
+    return grid._replace(width=int(round(grid.width / factor)),
+                         height=int(round(grid.height / factor)),
+                         pixel_size=grid.pixel_size * factor)
+
+
+def grid_transform(grid):
+    """Return the affine transform of a grid"""
+    from rasterio.transform import Affine
 
-def add_rpc_tags(*, src_path, dst_path, metadata_path):
+    return Affine(grid.pixel_size, 0, grid.ulx, 0, -grid.pixel_size, grid.uly)
+
+
+def rpc_tags(metadata_path):
+    """Return GDAL RPC metadata items of an image from its RPC metadata
+    file"""
     metadata = extract_rpc_metadata(metadata_path)
 
     keys = [
@@ -63,24 +245,50 @@ def add_rpc_tags(*, src_path, dst_path, metadata_path):
                    ('SAMP_DEN_COEFF', 'samp_den_coeffs')]
     for k, v in coeffs_keys:
         tags[k] = ' '.join([str(v2) for v2 in metadata[v]])
+    return tags
+
+
+def add_rpc_tags(create_options=[], progress=None, *, src_path, dst_path, metadata_path):
+    tags = rpc_tags(metadata_path)
+
+    import rasterio
 
-    with rasterio.open(src_path) as src:
-        with rasterio.open(dst_path, 'w', **src.profile) as dst:
-            dst.write(src.read())
+    with gdal_config.env('rpc'), rasterio.open(src_path) as src:
+        profile = src.profile.copy()
+        profile.update(rasterio_options(create_options))
+        with rasterio.open(dst_path, 'w', **profile) as dst:
+            # Copy block by block to keep memory bounded and reads aligned
+            windows = [w for _, w in dst.block_windows(1)]
+            for i, window in enumerate(windows):
+                dst.write(src.read(window=window), window=window)
+                if progress:
+                    progress((i + 1) / len(windows))
             dst.update_tags(ns='RPC', **tags)
 
 
-def orthorectify(dem_path=None, geoid_path=None, spacing=None, create_options=[], *, src_path, dst_path):
+def orthorectify(dem_path=None, geoid_path=None, spacing=None, create_options=[], progress=None, pixels=None, grid=None, box=None, *, src_path, dst_path):
     spacing_opt = ""
     if spacing:
         spacing_opt = "-opt.gridspacing {spacing}".format(spacing=spacing)
-    create_opt = ''
-    if create_options:
-        create_opt = '&'.join('gdal:co:{}'.format(opt) for opt in create_options)
+    outputs_opt = "-outputs.mode auto"
+    if grid:
+        # OTB takes the center of the upper left pixel
+        outputs_opt = "-outputs.mode user " \
+            "-outputs.ulx {ulx!r} -outputs.uly {uly!r} " \
+            "-outputs.sizex {width} -outputs.sizey {height} " \
+            "-outputs.spacingx {size!r} -outputs.spacingy {neg_size!r} " \
+            "-map epsg -map.epsg.code {epsg}".format(
+                ulx=grid.ulx + grid.pixel_size / 2,
+                uly=grid.uly - grid.pixel_size / 2,
+                width=grid.width,
+                height=grid.height,
+                size=grid.pixel_size,
+                neg_size=-grid.pixel_size,
+                epsg=grid.epsg)
     base_cmd = """otbcli_OrthoRectification \
-      -io.in \"{src}?{create_opt}&skipcarto=true\" \
-      -io.out {dst} uint16 \
-      -outputs.mode auto \
+      -io.in \"{src}?&skipcarto=true\" \
+      -io.out \"{dst}\" uint16 \
+      {outputs_opt} \
       -elev.geoid {geoid_path} \
       -elev.dem {dem_path} \
       {spacing_opt}
@@ -92,9 +300,12 @@ def orthorectify(dem_path=None, geoid_path=None, spacing=None, create_options=[]
         dem_path = DEM_PATH
 
     cmd = base_cmd.format(src=src_path,
-                          dst=dst_path,
+                          dst=otb_output_path(dst_path, create_options, box=box),
+                          outputs_opt=outputs_opt,
                           geoid_path=geoid_path,
                           dem_path=dem_path,
-                          spacing_opt=spacing_opt,
-                          create_opt=create_opt)
-    run_otb_command(cmd)
+                          spacing_opt=spacing_opt)
+    run_otb_command(cmd,
+                    progress=progress,
+                    stage='orthorectification',
+                    pixels=box[2] * box[3] if box else pixels)
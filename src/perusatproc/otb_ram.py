@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+OTB RAM budgets that are known to work on this host.
+
+When an OTB application runs out of memory, it is retried with half the RAM
+budget (``OTB_MAX_RAM_HINT``, which controls the size of the chunks OTB
+processes at once) until it succeeds or the minimum budget is reached. The
+budget that worked is remembered in a JSON file, by host (name and total
+memory), stage and raster size class, so that later runs on the same kind of
+input start with it instead of failing again.
+
+The file is at ``~/.cache/perusatproc/otb_ram.json`` by default, and can be
+changed with the ``PERUSATPROC_OTB_RAM_CACHE`` environment variable (set it
+empty to disable the cache). Removing it forgets all budgets.
+
+"""
+
+import json
+import logging
+import os
+import platform
+
+from perusatproc.planner import DEFAULT_OTB_RAM, MIN_OTB_RAM
+from perusatproc.workspace import commit, temp_path
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+CACHE_PATH_ENV = 'PERUSATPROC_OTB_RAM_CACHE'
+
+
+def cache_path():
+    """Return the path to the cache file, or None if it is disabled"""
+    path = os.environ.get(CACHE_PATH_ENV)
+    if path is not None:
+        return path or None
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(
+        os.path.join('~', '.cache'))
+    return os.path.join(cache_home, 'perusatproc', 'otb_ram.json')
+
+
+def _total_memory():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+def host_key():
+    """Return the key of this host: its name and total memory in GB"""
+    return '{}/{}G'.format(platform.node(), round(_total_memory() / 2**30))
+
+
+def size_key(stage, pixels):
+    """Return the key of a stage run on a raster of *pixels* pixels
+
+    Sizes are rounded up to a power of two, so that rasters of about the
+    same size share their budget.
+    """
+    if not pixels:
+        return stage
+    return '{}/2^{}'.format(stage, (int(pixels) - 1).bit_length())
+
+
+def _load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def known_ram(stage, pixels=None):
+    """Return the RAM budget (in MB) remembered for a stage and raster size
+    on this host, or None"""
+    path = cache_path()
+    if not path:
+        return None
+    return _load(path).get(host_key(), {}).get(size_key(stage, pixels))
+
+
+def remember(stage, pixels, ram):
+    """Remember that a stage ran on a raster of *pixels* pixels with a RAM
+    budget of *ram* MB on this host"""
+    path = cache_path()
+    if not path:
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # Read again just before writing, in case another job updated it, and
+    # keep the smallest budget
+    data = _load(path)
+    budgets = data.setdefault(host_key(), {})
+    key = size_key(stage, pixels)
+    budgets[key] = min(ram, budgets.get(key, ram))
+    tmp_path = temp_path(path)
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    commit(tmp_path, path)
+    _logger.info("Remember OTB RAM of %d MB for %s on %s", budgets[key], key,
+                 host_key())
+
+
+def initial_ram(stage, pixels=None):
+    """Return the RAM budget (in MB) to run a stage with first: the one set
+    in ``OTB_MAX_RAM_HINT`` (or the OTB default), unless a smaller one is
+    remembered"""
+    try:
+        ram = int(os.environ.get('OTB_MAX_RAM_HINT') or DEFAULT_OTB_RAM)
+    except ValueError:
+        ram = DEFAULT_OTB_RAM
+    known = known_ram(stage, pixels)
+    if known and known < ram:
+        _logger.info("Use remembered OTB RAM of %d MB for %s", known,
+                     size_key(stage, pixels))
+        ram = known
+    return ram
+
+
+def next_ram(ram):
+    """Return the RAM budget to retry with after running out of memory with
+    *ram*, or None if it is already the minimum"""
+    if ram <= MIN_OTB_RAM:
+        return None
+    return max(ram // 2, MIN_OTB_RAM)
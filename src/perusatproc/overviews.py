@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+from perusatproc import gdal_config
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_RESAMPLING = 'average'
+MIN_OVERVIEW_SIZE = 256
+RESAMPLING_METHODS = [
+    'nearest', 'average', 'bilinear', 'cubic', 'gauss', 'mode', 'lanczos'
+]
+
+
+def overview_factors(width, height, min_size=MIN_OVERVIEW_SIZE):
+    factors = []
+    factor = 2
+    while max(width, height) // factor >= min_size:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def build_overviews(path, resampling=DEFAULT_RESAMPLING, factors=None):
+    import rasterio
+    from rasterio.enums import Resampling
+
+    # GDAL builds each level block by block, computing it from the previous
+    # (already decimated) level, so memory stays bounded regardless of size.
+    with gdal_config.env('overviews'):
+        with rasterio.open(path, 'r+') as ds:
+            if factors is None:
+                factors = overview_factors(ds.width, ds.height)
+            if not factors:
+                return []
+            _logger.info("Build overviews %s for %s (%s)", factors, path,
+                         resampling)
+            ds.build_overviews(factors, Resampling[resampling])
+            ds.update_tags(ns='rio_overview', resampling=resampling)
+    return factors
+
+
+def build_all_overviews(paths, resampling=DEFAULT_RESAMPLING, jobs=None):
+    if jobs == 1 or len(paths) <= 1:
+        for path in paths:
+            build_overviews(path, resampling=resampling)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(build_overviews, path, resampling=resampling)
+            for path in paths
+        ]
+        for future in futures:
+            future.result()
@@ -1,11 +1,11 @@
-from perusatproc.util import run_otb_command
+from perusatproc.util import otb_output_path, run_otb_command
 
 
-def pansharpen(inp, inxs, out, create_options=[]):
-    create_opt = ''
-    if create_options:
-        create_opt = '&'.join('gdal:co:{}'.format(opt) for opt in create_options)
+def pansharpen(inp, inxs, out, create_options=[], progress=None, box=None, pixels=None):
     base_cmd = 'otbcli_BundleToPerfectSensor -inp {inp} ' \
         '-inxs {inxs} ' \
-        '-out "{out}?{create_opt}" uint16'
-    run_otb_command(base_cmd.format(inp=inp, inxs=inxs, out=out, create_opt=create_opt))
+        '-out "{out}" uint16'
+    run_otb_command(base_cmd.format(inp=inp, inxs=inxs, out=otb_output_path(out, create_options, box=box)),
+                    progress=progress,
+                    stage='pansharpening',
+                    pixels=box[2] * box[3] if box else pixels)
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming pipelines of tiled stages, connected by bounded queues.
+
+Each stage computes the tiles of an output, on its own worker threads. A tile
+of a stage can depend on tiles of previous stages, and it is queued as soon
+as all of them are done, instead of waiting for the whole previous stage to
+finish. Queues are bounded, so a fast stage blocks when the next one falls
+behind, and the tiles in flight (and their memory and scratch disk) stay
+bounded while stages overlap.
+
+Stages run external commands or release the GIL while computing, so threads
+are enough to use many cores.
+
+"""
+
+import logging
+import queue
+import threading
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_SIZE = 4
+
+# Seconds that blocked threads wait before checking if the pipeline failed
+POLL_INTERVAL = 0.5
+
+
+class TileStage:
+    """A stage that computes a list of tiles
+
+    Args:
+      name (str): name of the stage, for logging
+      ntiles (int): number of tiles
+      compute (callable): function called with the index of a tile, that
+        computes it
+      deps (callable): function called with the index of a tile, that
+        returns a list of (stage, index) pairs of the tiles it depends on.
+        Stages must be added to the pipeline after the stages they depend on.
+      workers (int): number of worker threads
+      queue_size (int): maximum number of tiles ready to be computed
+      checkpoint: optional :class:`perusatproc.checkpoint.TileCheckpoint` of
+        the tiles, whose tiles already done are not computed again, and
+        where tiles are marked as done
+    """
+
+    def __init__(self,
+                 name,
+                 ntiles,
+                 compute,
+                 deps=None,
+                 workers=1,
+                 queue_size=DEFAULT_QUEUE_SIZE,
+                 checkpoint=None):
+        self.name = name
+        self.ntiles = ntiles
+        self.compute = compute
+        self.deps = deps
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.checkpoint = checkpoint
+        self.done = [
+            bool(checkpoint and checkpoint.is_done(i)) for i in range(ntiles)
+        ]
+
+    def __repr__(self):
+        return 'TileStage({!r})'.format(self.name)
+
+
+class Pipeline:
+    """Runs :class:`TileStage` objects, overlapping their tiles
+
+    Args:
+      stages (list): stages, in dependency order
+      progress (callable): optional function called with the fraction of
+        tiles done, of all stages
+    """
+
+    def __init__(self, stages, progress=None):
+        self.stages = stages
+        self.progress = progress
+        self.lock = threading.Lock()
+        self.failed = threading.Event()
+        self.error = None
+
+        # Number of tiles not done yet that each tile waits for, and tiles
+        # that wait for each tile
+        self.waiting = {}
+        self.dependents = {}
+        for stage in stages:
+            for i in range(stage.ntiles):
+                if stage.done[i]:
+                    continue
+                deps = stage.deps(i) if stage.deps else []
+                count = 0
+                for dep_stage, j in deps:
+                    if dep_stage not in self.stages[:self.stages.index(
+                            stage)]:
+                        raise ValueError(
+                            '{} depends on {}, which is not before it'.format(
+                                stage, dep_stage))
+                    if not dep_stage.done[j]:
+                        self.dependents.setdefault((dep_stage, j),
+                                                   []).append((stage, i))
+                        count += 1
+                self.waiting[(stage, i)] = count
+
+        # Tiles ready from the start. Other tiles are queued by _finish when
+        # the last tile they wait for is done, so each tile is queued once.
+        self.ready = {
+            stage: [
+                i for i in range(stage.ntiles)
+                if not stage.done[i] and self.waiting[(stage, i)] == 0
+            ]
+            for stage in stages
+        }
+        self.remaining = {
+            stage: stage.done.count(False)
+            for stage in stages
+        }
+        # Stages with nothing to compute are stopped by their feeder, and
+        # other stages by _finish when their last tile is done
+        self.idle = [s for s in stages if self.remaining[s] == 0]
+        self.total = sum(s.ntiles for s in stages)
+        self.finished = self.total - sum(self.remaining.values())
+
+    def _put(self, stage, item):
+        # Block while the queue is full, unless the pipeline fails
+        while not self.failed.is_set():
+            try:
+                stage.queue.put(item, timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                continue
+
+    def _feed(self, stage):
+        # Queue tiles that are ready from the start, in order
+        for i in self.ready[stage]:
+            self._put(stage, i)
+        if stage in self.idle:
+            self._stop(stage)
+
+    def _stop(self, stage):
+        for _ in range(stage.workers):
+            self._put(stage, None)
+
+    def _work(self, stage):
+        while not self.failed.is_set():
+            try:
+                i = stage.queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if i is None:
+                return
+            try:
+                _logger.debug("Compute tile %d of %s", i, stage.name)
+                stage.compute(i)
+                self._finish(stage, i)
+            except BaseException as err:
+                with self.lock:
+                    if self.error is None:
+                        self.error = err
+                self.failed.set()
+                return
+
+    def _finish(self, stage, i):
+        ready = []
+        with self.lock:
+            stage.done[i] = True
+            if stage.checkpoint:
+                stage.checkpoint.mark_done(i)
+            self.remaining[stage] -= 1
+            last = self.remaining[stage] == 0
+            self.finished += 1
+            finished = self.finished
+            for dependent in self.dependents.pop((stage, i), []):
+                self.waiting[dependent] -= 1
+                if self.waiting[dependent] == 0:
+                    ready.append(dependent)
+        if self.progress:
+            self.progress(finished / self.total)
+        # Queue outside the lock, as it may block until the next stage
+        # catches up
+        for dep_stage, j in ready:
+            self._put(dep_stage, j)
+        if last:
+            self._stop(stage)
+
+    def run(self):
+        """Compute all tiles of all stages
+
+        Raises the first error raised while computing a tile, after all
+        running tiles finish.
+        """
+        threads = []
+        for stage in self.stages:
+            _logger.info("%s: %d of %d tiles to compute", stage.name,
+                         self.remaining[stage], stage.ntiles)
+            threads.append(
+                threading.Thread(target=self._feed,
+                                 args=(stage, ),
+                                 name='{}-feed'.format(stage.name),
+                                 daemon=True))
+            for n in range(stage.workers):
+                threads.append(
+                    threading.Thread(target=self._work,
+                                     args=(stage, ),
+                                     name='{}-{}'.format(stage.name, n),
+                                     daemon=True))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
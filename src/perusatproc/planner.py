@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""
+Resource planner for processing a product.
+
+Before running, the planner reads the DIMAP metadata of every volume and
+predicts memory, scratch disk and runtime of each stage using a simple
+linear cost model. Runtime coefficients can be fitted from progress event
+logs of past runs (see :mod:`perusatproc.progress`). The plan then chooses
+job concurrency and OTB RAM budget (which controls the size of the chunks
+OTB processes at once) to fit the host.
+
+"""
+
+import logging
+import os
+import shutil
+from collections import defaultdict
+
+from perusatproc import product
+from perusatproc.metadata import extract_projection_metadata
+from perusatproc.progress import END, START
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+MB = 2**20
+
+BYTES_PER_SAMPLE = 2  # uint16
+
+IMAGE_STAGES = ['calibration', 'rpc', 'orthorectification']
+VOLUME_STAGES = ['pansharpening']
+
+# OTB RAM budget (in MB) bounds, as set with OTB_MAX_RAM_HINT
+DEFAULT_OTB_RAM = 256
+MIN_OTB_RAM = 128
+MAX_OTB_RAM = 4096
+
+# Linear cost model for each stage, in terms of the number of pixels (width
+# times height) of the stage input:
+#
+#   seconds = seconds_base + seconds_per_pixel * pixels
+#   memory  = memory_base + OTB RAM budget (if otb)
+#   disk    = pixels * bands * BYTES_PER_SAMPLE * disk_factor
+#
+# Orthorectified images are larger than their inputs because of the no-data
+# borders, and final images are compressed.
+DEFAULT_COST_MODEL = {
+    'calibration':
+    dict(seconds_base=2.0,
+         seconds_per_pixel=2e-8,
+         memory_base=200 * MB,
+         otb=True,
+         disk_factor=1.0),
+    'rpc':
+    dict(seconds_base=0.5,
+         seconds_per_pixel=1e-8,
+         memory_base=150 * MB,
+         otb=False,
+         disk_factor=1.0),
+    'orthorectification':
+    dict(seconds_base=5.0,
+         seconds_per_pixel=1.5e-7,
+         memory_base=300 * MB,
+         otb=True,
+         disk_factor=1.3),
+    'pansharpening':
+    dict(seconds_base=2.0,
+         seconds_per_pixel=8e-8,
+         memory_base=300 * MB,
+         otb=True,
+         disk_factor=0.8),
+}
+
+# Overviews add about a third of the size of the image they are built for
+OVERVIEWS_DISK_FACTOR = 1 / 3
+
+
+def host_resources(path='.'):
+    """Return available CPUs, memory and disk space (in bytes) at *path*"""
+    memory = None
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    memory = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        pass
+    if memory is None:
+        try:
+            memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+        except (ValueError, OSError, AttributeError):
+            memory = None
+
+    while path and not os.path.exists(path):
+        path = os.path.dirname(path)
+    disk = shutil.disk_usage(path or '.').free
+
+    return dict(cpus=os.cpu_count() or 1, memory=memory, disk=disk)
+
+
+def fit_cost_model(events, model=None):
+    """Fit runtime coefficients of the cost model from progress events
+
+    Durations of finished stages are computed from their start and end
+    events, and a least-squares line is fitted per stage (or a line through
+    the origin, if all samples have the same size).
+
+    Args:
+      events: iterable of :class:`perusatproc.progress.ProgressEvent`
+      model (dict): cost model to update (defaults to DEFAULT_COST_MODEL)
+
+    Returns:
+      dict: a new cost model
+    """
+    model = {k: dict(v) for k, v in (model or DEFAULT_COST_MODEL).items()}
+
+    starts = {}
+    samples = defaultdict(list)
+    for event in events:
+        key = (event.job, event.stage)
+        if event.status == START:
+            starts[key] = event.time
+        elif event.status == END and key in starts and event.pixels:
+            samples[event.stage].append(
+                (event.pixels, event.time - starts.pop(key)))
+
+    for stage, points in samples.items():
+        if stage not in model:
+            continue
+        n = len(points)
+        mean_x = sum(p for p, _ in points) / n
+        mean_y = sum(t for _, t in points) / n
+        var_x = sum((p - mean_x)**2 for p, _ in points)
+        if var_x > 0:
+            slope = sum((p - mean_x) * (t - mean_y) for p, t in points) / var_x
+            base = mean_y - slope * mean_x
+        else:
+            slope, base = mean_y / mean_x, 0.0
+        if slope <= 0:
+            continue
+        model[stage].update(seconds_per_pixel=slope,
+                            seconds_base=max(base, 0.0))
+        _logger.info("Fitted %s runtime from %d runs: %.3g s + %.3g s/px",
+                     stage, n, model[stage]['seconds_base'], slope)
+
+    return model
+
+
+def _stage_cost(model, stage, pixels, bands, otb_ram):
+    coeffs = model[stage]
+    memory = coeffs['memory_base']
+    if coeffs['otb']:
+        memory += otb_ram * MB
+    return dict(seconds=coeffs['seconds_base'] +
+                coeffs['seconds_per_pixel'] * pixels,
+                memory=memory,
+                disk=pixels * bands * BYTES_PER_SAMPLE * coeffs['disk_factor'])
+
+
+def estimate_volume(volume, model=None, otb_ram=DEFAULT_OTB_RAM):
+    """Estimate costs of processing a volume
+
+    Returns:
+      dict with the cost of each stage of each image, peak memory of a single
+      task, peak scratch disk, final disk and total seconds of the volume
+    """
+    model = model or DEFAULT_COST_MODEL
+
+    images = {}
+    for kind in (product.MS, product.P):
+        dim_xml, _ = product.find_metadata_files(
+            product.find_image_dir(volume, kind))
+        proj = extract_projection_metadata(dim_xml)
+        pixels = proj['sizex'] * proj['sizey']
+        images[kind] = dict(pixels=pixels,
+                            bands=proj['nbands'],
+                            stages={
+                                stage: _stage_cost(model, stage, pixels,
+                                                   proj['nbands'], otb_ram)
+                                for stage in IMAGE_STAGES
+                            })
+
+    # Pansharpened image has the size of the P image, with the MS bands
+    pansharpening = _stage_cost(model, 'pansharpening',
+                                images[product.P]['pixels'],
+                                images[product.MS]['bands'], otb_ram)
+
+    stages = [s for img in images.values() for s in img['stages'].values()]
+    stages.append(pansharpening)
+
+    # Scratch peaks: while processing an image, its calibrated, RPC and
+    # orthorectified images exist at once (and the other ortho image may
+    # already exist). While pansharpening, both ortho images exist.
+    orthos = {
+        kind: img['stages']['orthorectification']['disk']
+        for kind, img in images.items()
+    }
+    image_peak = max(
+        sum(s['disk'] for s in img['stages'].values()) +
+        sum(d for k, d in orthos.items() if k != kind)
+        for kind, img in images.items())
+    scratch_peak = max(image_peak, sum(orthos.values()))
+
+    return dict(name=os.path.basename(volume),
+                images=images,
+                pansharpening=pansharpening,
+                memory=max(s['memory'] for s in stages),
+                scratch_disk=scratch_peak,
+                final_disk=pansharpening['disk'] * (1 + OVERVIEWS_DISK_FACTOR),
+                seconds=sum(s['seconds'] for s in stages))
+
+
+def plan_product(src, dst='.', model=None, resources=None, max_jobs=None):
+    """Plan processing of a product on this host
+
+    Args:
+      src (str): path to product
+      dst (str): path to destination directory (to check free disk space)
+      model (dict): cost model (defaults to DEFAULT_COST_MODEL)
+      resources (dict): available resources, as returned by
+        :func:`host_resources` (defaults to this host's)
+      max_jobs (int): upper bound for job concurrency
+
+    Returns:
+      dict with volume estimates, totals, chosen ``jobs`` and ``otb_ram``
+      (in MB), and ``fits`` (whether the product fits the host at all)
+    """
+    model = model or DEFAULT_COST_MODEL
+    if resources is None:
+        resources = host_resources(dst)
+
+    volumes = [
+        estimate_volume(v, model=model, otb_ram=DEFAULT_OTB_RAM)
+        for v in product.find_volumes(src)
+    ]
+    if not volumes:
+        raise RuntimeError('No volumes found at {}'.format(src))
+
+    final_disk = sum(v['final_disk'] for v in volumes)
+    scratch_disk = max(v['scratch_disk'] for v in volumes)
+    task_memory = max(v['memory'] for v in volumes)
+
+    # Each volume has two independent image tasks
+    jobs = min(resources['cpus'], 2 * len(volumes))
+    if max_jobs:
+        jobs = min(jobs, max_jobs)
+    if resources.get('memory'):
+        jobs = min(jobs, resources['memory'] // task_memory)
+    free_disk = resources['disk'] - final_disk
+    jobs = min(jobs, free_disk // scratch_disk) if scratch_disk else jobs
+    fits = jobs >= 1 and free_disk > 0
+    jobs = int(max(jobs, 1))
+
+    # Give spare memory to OTB, so that it processes larger chunks at once
+    otb_ram = DEFAULT_OTB_RAM
+    if resources.get('memory'):
+        base = max(c['memory_base'] for c in model.values())
+        otb_ram = int((0.8 * resources['memory'] / jobs - base) / MB)
+        otb_ram = min(max(otb_ram, MIN_OTB_RAM), MAX_OTB_RAM)
+        if otb_ram != DEFAULT_OTB_RAM:
+            volumes = [
+                estimate_volume(v, model=model, otb_ram=otb_ram)
+                for v in product.find_volumes(src)
+            ]
+            task_memory = max(v['memory'] for v in volumes)
+
+    total_seconds = sum(v['seconds'] for v in volumes)
+    longest_volume = max(v['seconds'] for v in volumes)
+
+    return dict(volumes=volumes,
+                resources=resources,
+                jobs=jobs,
+                otb_ram=otb_ram,
+                task_memory=task_memory,
+                memory=task_memory * jobs,
+                scratch_disk=scratch_disk * jobs,
+                final_disk=final_disk,
+                cpu_seconds=total_seconds,
+                seconds=max(total_seconds / jobs, longest_volume),
+                fits=fits)
+
+
+class Admission:
+    """Admission control of tasks by memory and disk budgets
+
+    Tasks are admitted while the sum of the costs of running tasks fits the
+    budgets. A task is always admitted when nothing else is running, so that
+    tasks larger than the budget can still run on their own.
+    """
+
+    def __init__(self, memory=None, disk=None):
+        self.budget = dict(memory=memory, disk=disk)
+        self.used = dict(memory=0, disk=0)
+        self.running = 0
+
+    def try_acquire(self, cost):
+        cost = cost or {}
+        if self.running:
+            for k, budget in self.budget.items():
+                if budget is not None and self.used[k] + cost.get(k, 0) > budget:
+                    return False
+        for k in self.used:
+            self.used[k] += cost.get(k, 0)
+        self.running += 1
+        return True
+
+    def release(self, cost):
+        cost = cost or {}
+        for k in self.used:
+            self.used[k] -= cost.get(k, 0)
+        self.running -= 1
+
+
+def task_costs(plan):
+    """Return memory and disk cost of each volume task of a plan, by task key
+    (see :func:`perusatproc.console.process.volume_tasks`)"""
+    costs = {}
+    for vol in plan['volumes']:
+        for kind, img in vol['images'].items():
+            stages = img['stages'].values()
+            costs['{}/{}'.format(vol['name'], kind)] = dict(
+                memory=max(s['memory'] for s in stages),
+                disk=sum(s['disk'] for s in stages))
+        costs['{}/pansharpen'.format(vol['name'])] = dict(
+            memory=vol['pansharpening']['memory'],
+            disk=vol['pansharpening']['disk'])
+    return costs
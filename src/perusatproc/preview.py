@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+Quick georeferenced preview of a raw product.
+
+A small RGB Cloud Optimized GeoTIFF of the whole product is rendered in a few
+seconds, regardless of the size of the scenes, without running the
+processing chain:
+
+* The output grid covers the footprints of all volumes, in the UTM zone of
+  the product, with pixels sized so that its longest side has a fixed size.
+* Ground coordinates are computed on a coarse grid and interpolated, and
+  projected into the multispectral images with their RPC models, at heights
+  from the DEM downsampled to the output grid (or at the mean scene height
+  if there is no DEM). DEM heights are used as ellipsoidal heights, which
+  is well below a preview pixel.
+* Multispectral images are read decimated, which lets GDAL use overviews or
+  JPEG2000 resolution levels, and calibrated to reflectance (see
+  :mod:`perusatproc.dynamic`). There is no pansharpening.
+* Bands are stretched with percentiles of the preview itself.
+
+"""
+
+import logging
+import math
+import os
+import re
+import tempfile
+import time
+from glob import glob
+
+from perusatproc import gdal_config, product, vrt
+from perusatproc.dynamic import Volume, bilinear
+from perusatproc.orthorectification import DEM_PATH, OutputGrid, footprint_bounds, grid_transform, utm_epsg
+from perusatproc.profiles import PREVIEW, creation_options, rasterio_options
+from perusatproc.visual import DEFAULT_PERCENTILES
+from perusatproc.workspace import commit, temp_path
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+PREVIEW_SUFFIX = '_preview.tif'
+
+# Size in pixels of the longest side of previews
+DEFAULT_SIZE = 1024
+
+# Ground coordinates are computed every GRID_SPACING pixels and interpolated
+GRID_SPACING = 16
+
+DEM_EXTENSIONS = ('.tif', '.tiff', '.hgt', '.dt1', '.dt2')
+
+# SRTM tiles are named after their south-west corner, e.g. S13W077.hgt
+SRTM_TILE_RE = re.compile(r'^([NS])(\d{2})([EW])(\d{3})', re.IGNORECASE)
+
+
+def preview_path(src, dst_dir):
+    """Return path to the preview of product *src* in *dst_dir*"""
+    return os.path.join(dst_dir, product.product_name(src) + PREVIEW_SUFFIX)
+
+
+def preview_grid(volumes, size=DEFAULT_SIZE):
+    """Return an :class:`perusatproc.orthorectification.OutputGrid` that
+    covers the footprints of *volumes*, with *size* pixels on its longest
+    side"""
+    first = volumes[0]
+    epsg = utm_epsg(first.ms.rpc.params['lon_offset'],
+                    first.ms.rpc.params['lat_offset'])
+    bounds = [footprint_bounds(v.ms.dim_xml, epsg) for v in volumes]
+    minx = min(b[0] for b in bounds)
+    miny = min(b[1] for b in bounds)
+    maxx = max(b[2] for b in bounds)
+    maxy = max(b[3] for b in bounds)
+    # Whole meters, aligned to pixels
+    pixel_size = float(math.ceil(max(maxx - minx, maxy - miny) / size))
+    ulx = math.floor(minx / pixel_size) * pixel_size
+    uly = math.ceil(maxy / pixel_size) * pixel_size
+    return OutputGrid(epsg=epsg,
+                      ulx=ulx,
+                      uly=uly,
+                      width=int(math.ceil((maxx - ulx) / pixel_size)),
+                      height=int(math.ceil((uly - miny) / pixel_size)),
+                      pixel_size=pixel_size)
+
+
+def grid_coordinates(grid, spacing=GRID_SPACING):
+    """Return (lons, lats) arrays of the centers of the pixels of a grid,
+    computed every *spacing* pixels and interpolated bilinearly"""
+    import numpy as np
+    from rasterio.warp import transform
+
+    cols = np.arange(0, grid.width + spacing, spacing, dtype='float64')
+    rows = np.arange(0, grid.height + spacing, spacing, dtype='float64')
+    xs, ys = np.meshgrid(grid.ulx + (cols + 0.5) * grid.pixel_size,
+                         grid.uly - (rows + 0.5) * grid.pixel_size)
+    lons, lats = transform('EPSG:{}'.format(grid.epsg), 'EPSG:4326',
+                           xs.ravel(), ys.ravel())
+    coarse = np.array([lons, lats]).reshape((2, ) + xs.shape)
+
+    fine_cols, fine_rows = np.meshgrid(
+        np.arange(grid.width) / spacing,
+        np.arange(grid.height) / spacing)
+    # Interpolated in float32, which is precise to about a meter
+    values, _ = bilinear(coarse, fine_cols, fine_rows)
+    return values[0], values[1]
+
+
+def srtm_tile_name(lon, lat):
+    """Return the name of the 1 degree SRTM tile that contains a point,
+    e.g. ``S13W077``"""
+    lon, lat = math.floor(lon), math.floor(lat)
+    return '{}{:02d}{}{:03d}'.format('N' if lat >= 0 else 'S', abs(lat),
+                                     'E' if lon >= 0 else 'W', abs(lon))
+
+
+def dem_candidates(paths, bounds):
+    """Return DEM tiles of *paths* that may intersect (west, south, east,
+    north) *bounds*
+
+    Tiles named as SRTM tiles are selected by name, without opening them.
+    Other tiles are kept, to be checked by their extent.
+    """
+    w, s, e, n = bounds
+    names = set(
+        srtm_tile_name(lon, lat)
+        for lon in range(math.floor(w), math.floor(e) + 1)
+        for lat in range(math.floor(s), math.floor(n) + 1))
+    candidates = []
+    for path in paths:
+        match = SRTM_TILE_RE.match(os.path.basename(path))
+        if not match or match.group(0).upper() in names:
+            candidates.append(path)
+    return candidates
+
+
+def dem_heights(grid, dem_path=DEM_PATH):
+    """Return heights of a DEM (a directory of tiles) averaged over the pixels
+    of a grid, or None if the DEM does not cover it"""
+    import numpy as np
+    import rasterio
+    from rasterio.crs import CRS
+    from rasterio.warp import Resampling, reproject, transform_bounds
+
+    w, s, e, n = transform_bounds(
+        'EPSG:{}'.format(grid.epsg), 'EPSG:4326', grid.ulx,
+        grid.uly - grid.height * grid.pixel_size,
+        grid.ulx + grid.width * grid.pixel_size, grid.uly)
+    paths = dem_candidates(
+        sorted(p for ext in DEM_EXTENSIONS
+               for p in glob(os.path.join(dem_path, '*' + ext))),
+        (w, s, e, n))
+    if not paths:
+        return None
+
+    infos = []
+    for info in vrt.read_infos(paths):
+        t = info.transform
+        if (t.c < e and t.c + info.width * t.a > w and t.f > s
+                and t.f + info.height * t.e < n):
+            infos.append(info)
+    if not infos:
+        return None
+
+    heights = np.full((grid.height, grid.width), np.nan, dtype='float32')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dem_vrt = vrt.build_vrt(infos, os.path.join(tmpdir, 'dem.vrt'))
+        with gdal_config.env('preview'), rasterio.open(dem_vrt) as src:
+            reproject(source=rasterio.band(src, 1),
+                      destination=heights,
+                      src_nodata=src.nodata,
+                      dst_transform=grid_transform(grid),
+                      dst_crs=CRS.from_epsg(grid.epsg),
+                      dst_nodata=np.nan,
+                      resampling=Resampling.average)
+    if np.isnan(heights).all():
+        return None
+    return heights
+
+
+def stretch_rgb(values, mask, percentiles=DEFAULT_PERCENTILES):
+    """Stretch (3, h, w) *values* to 8 bits with percentiles of the valid
+    pixels of each band"""
+    import numpy as np
+
+    rgb = np.zeros(values.shape, dtype='uint8')
+    for i, band in enumerate(values):
+        low, high = np.percentile(band[mask], percentiles)
+        high = max(high, low + 1e-6)
+        rgb[i] = np.clip((band - low) * (255 / (high - low)), 0, 255)
+    rgb[:, ~mask] = 0
+    return rgb
+
+
+def write_cog(rgb, mask, grid, dst_path, create_options=[]):
+    """Write an RGB image with a mask as a Cloud Optimized GeoTIFF"""
+    import rasterio
+    import rasterio.shutil
+    from rasterio.crs import CRS
+    from rasterio.io import MemoryFile
+
+    profile = dict(driver='GTiff',
+                   width=grid.width,
+                   height=grid.height,
+                   count=3,
+                   dtype='uint8',
+                   crs=CRS.from_epsg(grid.epsg),
+                   transform=grid_transform(grid))
+    options = rasterio_options(creation_options(PREVIEW, create_options))
+    with gdal_config.env('preview', GDAL_TIFF_INTERNAL_MASK='YES'), \
+            MemoryFile() as mem:
+        with mem.open(**profile) as ds:
+            ds.write(rgb)
+            ds.write_mask(mask.astype('uint8') * 255)
+        with mem.open() as ds:
+            rasterio.shutil.copy(ds, dst_path, driver='COG', **options)
+
+
+def write_preview(src,
+                  dst_path,
+                  size=DEFAULT_SIZE,
+                  dem_path=None,
+                  create_options=[]):
+    """Write an RGB preview of a raw product
+
+    Args:
+      src (str): path to product (directory or archive)
+      dst_path (str): path to output Cloud Optimized GeoTIFF
+      size (int): size in pixels of the longest side of the preview
+      dem_path (str): path to directory of DEM tiles (defaults to the
+        bundled SRTM DEM)
+      create_options ([str]): options of the COG driver
+
+    Returns:
+      str: *dst_path*
+    """
+    import numpy as np
+
+    start = time.time()
+    volumes = [Volume(v) for v in product.find_volumes(src)]
+    if not volumes:
+        raise RuntimeError('No volumes found at {}'.format(src))
+    rgb_bands = volumes[0].rgb_bands
+
+    grid = preview_grid(volumes, size)
+    _logger.info("Preview grid of %dx%d pixels of %.0f m (EPSG:%d)",
+                 grid.width, grid.height, grid.pixel_size, grid.epsg)
+    lons, lats = grid_coordinates(grid)
+    heights = dem_heights(grid, dem_path or DEM_PATH)
+    if heights is None:
+        _logger.info("No DEM covers the product, use mean scene heights")
+
+    values = np.zeros((3, grid.height, grid.width), dtype='float32')
+    mask = np.zeros((grid.height, grid.width), dtype=bool)
+    for volume in volumes:
+        volume_heights = None
+        if heights is not None:
+            volume_heights = np.where(np.isnan(heights), volume.height,
+                                      heights)
+        result = volume.render(lons,
+                               lats,
+                               bands=rgb_bands,
+                               heights=volume_heights)
+        if result is None:
+            continue
+        data, valid = result
+        # Volumes overlap slightly: keep pixels of the first one
+        fill = valid & ~mask
+        values[:, fill] = data[:, fill]
+        mask |= fill
+    if not mask.any():
+        raise RuntimeError('Preview of {} has no valid pixels'.format(src))
+
+    tmp_path = temp_path(dst_path)
+    write_cog(stretch_rgb(values, mask), mask, grid, tmp_path,
+              create_options)
+    commit(tmp_path, dst_path)
+    _logger.info("Wrote preview %s in %.1f s", dst_path, time.time() - start)
+    return dst_path
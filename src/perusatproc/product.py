@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Discovery of volumes, images and metadata files inside a PeruSat-1 product.
+
+A product can be a directory or a ZIP/TAR archive, which is read in place,
+either local or on S3 storage (see :mod:`perusatproc.vfs`).
+
+"""
+
+import os
+
+from perusatproc import vfs
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+VOLUME_PATTERN = 'VOL_*'
+IMAGE_PATTERN = 'IMG_*_{kind}_*'
+DIM_PATTERN = 'DIM_*.XML'
+RPC_PATTERN = 'RPC_*.XML'
+
+MS = 'MS'
+P = 'P'
+
+
+def product_name(src):
+    """Return the name of a product, without archive extension"""
+    name = os.path.basename(os.path.normpath(src))
+    if vfs.archive_kind(name):
+        return vfs.strip_archive_extension(name)
+    return os.path.splitext(name)[0]
+
+
+def product_root(src):
+    """Return the path to the directory that contains the volumes of a product
+
+    If *src* is an archive, a GDAL virtual path inside it is returned. Archives
+    usually wrap the product in a single top-level directory, which is
+    descended into if there are no volumes at the root.
+    """
+    if not vfs.is_archive(src):
+        return vfs.to_gdal_path(src)
+    root = vfs.archive_path(src)
+    if not vfs.glob(os.path.join(root, VOLUME_PATTERN)):
+        entries = vfs.listdir(root)
+        if len(entries) == 1 and vfs.isdir(os.path.join(root, entries[0])):
+            root = os.path.join(root, entries[0])
+    return root
+
+
+def find_volumes(src):
+    return sorted(vfs.glob(os.path.join(product_root(src), VOLUME_PATTERN)))
+
+
+def find_image_dir(volume, kind):
+    paths = vfs.glob(os.path.join(volume, IMAGE_PATTERN.format(kind=kind)))
+    if not paths:
+        raise RuntimeError('No {} image found at {}'.format(kind, volume))
+    return paths[0]
+
+
+def find_metadata_files(image_dir):
+    """Return paths to the DIMAP and RPC metadata files of an image"""
+    dim_paths = vfs.glob(os.path.join(image_dir, DIM_PATTERN))
+    rpc_paths = vfs.glob(os.path.join(image_dir, RPC_PATTERN))
+    if not dim_paths or not rpc_paths:
+        raise RuntimeError(
+            'No DIMAP or RPC metadata file found at {}'.format(image_dir))
+    return dim_paths[0], rpc_paths[0]
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+GeoTIFF output profiles for each processing stage.
+
+Intermediate (scratch) results are written tiled and uncompressed, as they
+are read once by the next stage and then deleted. Final results are tiled
+and compressed with a horizontal predictor. In both cases the block size
+matches the window size used by the next windowed stage, so that reads are
+block aligned. Visual (8-bit RGB) results are JPEG compressed in YCbCr, for
+display only. Transcoded copies of JPEG2000 sources use a compression that is
+fast to decode, as they are read several times. Previews are written with the
+COG driver, whose options differ from those of the GTiff driver.
+
+"""
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+SCRATCH = 'scratch'
+FINAL = 'final'
+VISUAL = 'visual'
+TRANSCODE = 'transcode'
+PREVIEW = 'preview'
+
+BLOCK_SIZE = 512
+
+PROFILES = {
+    SCRATCH: [
+        'TILED=YES',
+        'BLOCKXSIZE={}'.format(BLOCK_SIZE),
+        'BLOCKYSIZE={}'.format(BLOCK_SIZE),
+        'COMPRESS=NONE',
+        'BIGTIFF=IF_SAFER',
+    ],
+    FINAL: [
+        'TILED=YES',
+        'BLOCKXSIZE={}'.format(BLOCK_SIZE),
+        'BLOCKYSIZE={}'.format(BLOCK_SIZE),
+        'COMPRESS=DEFLATE',
+        'PREDICTOR=2',
+        'ZLEVEL=6',
+        'BIGTIFF=IF_SAFER',
+    ],
+    VISUAL: [
+        'TILED=YES',
+        'BLOCKXSIZE={}'.format(BLOCK_SIZE),
+        'BLOCKYSIZE={}'.format(BLOCK_SIZE),
+        'COMPRESS=JPEG',
+        'PHOTOMETRIC=YCBCR',
+        'JPEG_QUALITY=85',
+        'BIGTIFF=IF_SAFER',
+    ],
+    TRANSCODE: [
+        'TILED=YES',
+        'BLOCKXSIZE={}'.format(BLOCK_SIZE),
+        'BLOCKYSIZE={}'.format(BLOCK_SIZE),
+        'COMPRESS=ZSTD',
+        'ZSTD_LEVEL=1',
+        'PREDICTOR=2',
+        'BIGTIFF=IF_SAFER',
+    ],
+    PREVIEW: [
+        'BLOCKSIZE={}'.format(BLOCK_SIZE),
+        'COMPRESS=JPEG',
+        'QUALITY=85',
+        'OVERVIEW_RESAMPLING=AVERAGE',
+    ],
+}
+
+# Output profile used by each stage when processing a whole product
+STAGE_PROFILES = {
+    'calibration': SCRATCH,
+    'rpc': SCRATCH,
+    'orthorectification': SCRATCH,
+    'pansharpening': FINAL,
+}
+
+
+def creation_options(profile, overrides=None):
+    """Return GDAL creation options of a profile, as a list of KEY=VALUE
+
+    Options in *overrides* (e.g. from -co arguments) replace the options of
+    the profile with the same key, or are appended otherwise.
+    """
+    options = dict(_split_option(opt) for opt in PROFILES[profile])
+    for opt in overrides or []:
+        key, value = _split_option(opt)
+        options[key] = value
+    return ['{}={}'.format(k, v) for k, v in options.items()]
+
+
+def rasterio_options(create_options):
+    """Convert a list of KEY=VALUE creation options to rasterio keywords"""
+    return {
+        key.lower(): value
+        for key, value in (_split_option(opt) for opt in create_options or [])
+    }
+
+
+def _split_option(opt):
+    key, _, value = opt.partition('=')
+    return key.strip().upper(), value.strip()
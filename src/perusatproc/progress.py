@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Progress reporting for processing stages.
+
+Stages report progress as a stream of :class:`ProgressEvent`, passed to a
+callback. Events are emitted when a stage starts, on each progress update
+(parsed from OTB progress bars or reported per window by Python stages) and
+when it ends or fails.
+
+Callbacks can write events to a JSON lines file (:class:`JsonLinesWriter`),
+which works across processes and hosts, or aggregate them in memory
+(:class:`ProgressTracker`) to compute throughput, ETA and stragglers.
+
+"""
+
+import json
+import logging
+import statistics
+import threading
+import time
+from collections import namedtuple
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+START = 'start'
+PROGRESS = 'progress'
+END = 'end'
+FAILED = 'failed'
+
+ProgressEvent = namedtuple(
+    'ProgressEvent', ['time', 'job', 'stage', 'status', 'fraction', 'pixels'])
+
+
+class StageProgress:
+    """Context manager that emits events for a stage of a job
+
+    Calling the instance with a fraction (between 0 and 1) reports progress.
+    If *callback* is None, nothing is reported.
+    """
+
+    def __init__(self, callback, job, stage, pixels=None):
+        self.callback = callback
+        self.job = job
+        self.stage = stage
+        self.pixels = pixels
+        self.fraction = 0.0
+
+    def _emit(self, status):
+        if self.callback:
+            self.callback(
+                ProgressEvent(time=time.time(),
+                              job=self.job,
+                              stage=self.stage,
+                              status=status,
+                              fraction=self.fraction,
+                              pixels=self.pixels))
+
+    def __call__(self, fraction):
+        fraction = min(max(fraction, 0.0), 1.0)
+        if fraction <= self.fraction:
+            return
+        self.fraction = fraction
+        self._emit(PROGRESS)
+
+    def __enter__(self):
+        self._emit(START)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.fraction = 1.0
+            self._emit(END)
+        else:
+            self._emit(FAILED)
+
+
+class JsonLinesWriter:
+    """Progress callback that appends events to a JSON lines file
+
+    The file is opened on each event in append mode, so instances can be
+    pickled and shared by processes running in parallel.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, event):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(event._asdict()) + '\n')
+
+
+def read_events(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield ProgressEvent(**json.loads(line))
+
+
+class ProgressTracker:
+    """Progress callback that aggregates events of many (parallel) jobs
+
+    Pixel throughput and ETA only take into account stages that already
+    started. If *log_interval* is set, a summary is logged at most every
+    *log_interval* seconds.
+    """
+
+    def __init__(self, log_interval=None):
+        self.log_interval = log_interval
+        self._stages = {}
+        self._start_time = None
+        self._last_log = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            key = (event.job, event.stage)
+            if self._start_time is None:
+                self._start_time = event.time
+            if event.status == START or key not in self._stages:
+                self._stages[key] = dict(start=event.time,
+                                         time=event.time,
+                                         fraction=event.fraction,
+                                         pixels=event.pixels or 0,
+                                         status=event.status)
+            else:
+                self._stages[key].update(time=event.time,
+                                         fraction=event.fraction,
+                                         status=event.status)
+
+        if self.log_interval and time.time() - self._last_log >= self.log_interval:
+            self._last_log = time.time()
+            self.log_summary()
+
+    def summary(self, now=None):
+        """Return aggregated progress of all stages
+
+        Returns:
+          dict with total and done pixels, throughput (pixels per second),
+          ETA (in seconds) and running, finished and failed stages count.
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            stages = list(self._stages.values())
+            start_time = self._start_time
+
+        total = sum(s['pixels'] for s in stages)
+        done = sum(s['pixels'] * s['fraction'] for s in stages)
+        elapsed = now - start_time if start_time else 0
+        throughput = done / elapsed if elapsed > 0 else 0.0
+        eta = (total - done) / throughput if throughput > 0 else None
+        return dict(total_pixels=total,
+                    done_pixels=done,
+                    throughput=throughput,
+                    eta=eta,
+                    running=sum(1 for s in stages
+                                if s['status'] in (START, PROGRESS)),
+                    finished=sum(1 for s in stages if s['status'] == END),
+                    failed=sum(1 for s in stages if s['status'] == FAILED))
+
+    def job_throughputs(self, now=None):
+        """Return pixel throughput of each running (job, stage)"""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            stages = dict(self._stages)
+        return {
+            key: s['pixels'] * s['fraction'] / (now - s['start'])
+            for key, s in stages.items()
+            if s['status'] in (START, PROGRESS) and now > s['start']
+        }
+
+    def stragglers(self, factor=0.5, now=None):
+        """Return running (job, stage) keys whose throughput is below
+        *factor* times the median throughput of running stages"""
+        throughputs = self.job_throughputs(now=now)
+        if len(throughputs) < 2:
+            return []
+        median = statistics.median(throughputs.values())
+        return [k for k, v in throughputs.items() if v < factor * median]
+
+    def log_summary(self):
+        s = self.summary()
+        eta = '{:.0f}s'.format(s['eta']) if s['eta'] is not None else '?'
+        _logger.info(
+            "Progress: %.1f%% of %d pixels, %.2f Mpx/s, ETA %s "
+            "(%d running, %d finished, %d failed)",
+            100 * s['done_pixels'] / s['total_pixels'] if s['total_pixels'] else 0,
+            s['total_pixels'], s['throughput'] / 1e6, eta, s['running'],
+            s['finished'], s['failed'])
+
+
+class MultiCallback:
+    """Progress callback that forwards events to many callbacks"""
+
+    def __init__(self, *callbacks):
+        self.callbacks = [c for c in callbacks if c]
+
+    def __call__(self, event):
+        for callback in self.callbacks:
+            callback(event)
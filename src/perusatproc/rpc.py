@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Rational polynomial camera (RPC00B) model of PeruSat-1 images.
+
+Projects ground coordinates (longitude, latitude and height above the
+ellipsoid) into image coordinates (column and row, with the center of the
+first pixel at 0), using the same coefficients and offsets that are written
+as RPC tags of images before orthorectification.
+
+"""
+
+import logging
+
+from perusatproc.metadata import extract_rpc_metadata
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+
+def _terms(x, y, z):
+    # Terms of the cubic polynomial, in RPC00B order. x is normalized
+    # longitude, y latitude and z height.
+    return [
+        1, x, y, z, x * y, x * z, y * z, x * x, y * y, z * z, x * y * z,
+        x * x * x, x * y * y, x * z * z, x * x * y, y * y * y, y * z * z,
+        x * x * z, y * y * z, z * z * z
+    ]
+
+
+def _polynomial(coeffs, terms):
+    result = 0
+    for c, t in zip(coeffs, terms):
+        result = result + c * t
+    return result
+
+
+class RPCModel:
+    """RPC00B model, with the keys of
+    :func:`perusatproc.metadata.extract_rpc_metadata`"""
+
+    def __init__(self, **params):
+        self.params = params
+        self.height_offset = params['height_offset']
+
+    @classmethod
+    def from_metadata(cls, metadata_path):
+        """Read the model from an RPC XML metadata file"""
+        return cls(**extract_rpc_metadata(metadata_path))
+
+    def project(self, lon, lat, height=None):
+        """Project ground coordinates into image coordinates
+
+        Args:
+          lon, lat (array-like): geographic coordinates, in degrees
+          height (array-like): heights above the ellipsoid in meters.
+            Defaults to the height offset of the model (i.e. the mean height
+            of the scene)
+
+        Returns:
+          tuple: (col, row) arrays
+        """
+        import numpy as np
+
+        p = self.params
+        if height is None:
+            height = self.height_offset
+        x = (np.asarray(lon, dtype='float64') - p['lon_offset']) / p['lon_scale']
+        y = (np.asarray(lat, dtype='float64') - p['lat_offset']) / p['lat_scale']
+        z = (np.asarray(height, dtype='float64') -
+             p['height_offset']) / p['height_scale']
+        terms = _terms(x, y, z)
+        col = _polynomial(p['samp_num_coeffs'], terms) / _polynomial(
+            p['samp_den_coeffs'], terms)
+        row = _polynomial(p['line_num_coeffs'], terms) / _polynomial(
+            p['line_den_coeffs'], terms)
+        return (col * p['samp_scale'] + p['samp_offset'],
+                row * p['line_scale'] + p['line_offset'])
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+Access to S3-compatible object storage.
+
+Objects are addressed either as ``s3://bucket/key`` URIs or as GDAL virtual
+paths (``/vsis3/bucket/key``), which can be passed as is to GDAL and OTB.
+Listing, small ranged reads (e.g. metadata XML) and multipart uploads are done
+with boto3, which is an optional dependency.
+
+Endpoint and credentials are read from the same environment variables GDAL
+uses, so that both see the same storage. For example, to use a local MinIO
+server::
+
+    AWS_S3_ENDPOINT=localhost:9000 AWS_HTTPS=NO AWS_VIRTUAL_HOSTING=FALSE
+    AWS_ACCESS_KEY_ID=minioadmin AWS_SECRET_ACCESS_KEY=minioadmin
+
+"""
+
+import functools
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+URI_PREFIX = 's3://'
+VSI_PREFIX = '/vsis3/'
+
+MB = 2**20
+
+# Size of ranged GET requests when reading objects from Python
+READ_CHUNK_SIZE = 256 * 1024
+
+# Multipart upload settings
+MULTIPART_THRESHOLD = 64 * MB
+MULTIPART_CHUNK_SIZE = 64 * MB
+UPLOAD_PART_CONCURRENCY = 8
+UPLOAD_FILE_CONCURRENCY = 4
+
+# GDAL configuration for streaming rasters from object storage: keep a block
+# cache of what was read, read ahead in large chunks, merge ranged requests,
+# and do not list "directories" when opening a file, as that means listing
+# whole prefixes.
+GDAL_OPTIONS = dict(
+    VSI_CACHE='TRUE',
+    VSI_CACHE_SIZE=str(256 * MB),
+    CPL_VSIL_CURL_CHUNK_SIZE=str(4 * MB),
+    CPL_VSIL_CURL_CACHE_SIZE=str(512 * MB),
+    GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR',
+    GDAL_HTTP_MULTIRANGE='YES',
+    GDAL_HTTP_MERGE_CONSECUTIVE_RANGES='YES',
+    GDAL_HTTP_MAX_RETRY='5',
+    GDAL_HTTP_RETRY_DELAY='1',
+)
+
+
+def is_s3(path):
+    return path.startswith(URI_PREFIX) or path.startswith(VSI_PREFIX)
+
+
+def to_vsi(path):
+    """Return the GDAL virtual path of an S3 URI"""
+    if path.startswith(URI_PREFIX):
+        return VSI_PREFIX + path[len(URI_PREFIX):]
+    return path
+
+
+def split(path):
+    """Split an S3 URI or GDAL virtual path into bucket and key"""
+    path = to_vsi(path)[len(VSI_PREFIX):]
+    bucket, _, key = path.partition('/')
+    return bucket, key
+
+
+def join(uri, *parts):
+    return '/'.join([uri.rstrip('/')] + [p.strip('/') for p in parts])
+
+
+@functools.lru_cache(maxsize=None)
+def client():
+    try:
+        import boto3
+        from botocore.config import Config
+    except ImportError as err:
+        raise RuntimeError(
+            'boto3 is required to access S3 storage. '
+            'Install it with `pip install perusatproc[s3]`') from err
+
+    endpoint_url = None
+    endpoint = os.getenv('AWS_S3_ENDPOINT')
+    if endpoint:
+        scheme = 'http' if os.getenv('AWS_HTTPS', 'YES').upper() in (
+            'NO', 'FALSE', 'OFF') else 'https'
+        endpoint_url = '{}://{}'.format(scheme, endpoint)
+    addressing_style = 'path' if os.getenv(
+        'AWS_VIRTUAL_HOSTING', 'TRUE').upper() in ('NO', 'FALSE',
+                                                   'OFF') else 'auto'
+    return boto3.client('s3',
+                        endpoint_url=endpoint_url,
+                        config=Config(
+                            s3=dict(addressing_style=addressing_style),
+                            max_pool_connections=UPLOAD_PART_CONCURRENCY *
+                            UPLOAD_FILE_CONCURRENCY))
+
+
+def list_objects(path):
+    """Yield (key, size) of all objects under a prefix"""
+    bucket, prefix = split(path)
+    paginator = client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            yield obj['Key'], obj['Size']
+
+
+def stat(path):
+    """Return (mtime, size) of an object"""
+    bucket, key = split(path)
+    res = client().head_object(Bucket=bucket, Key=key)
+    return res['LastModified'].timestamp(), res['ContentLength']
+
+
+def exists(path):
+    from botocore.exceptions import ClientError
+
+    try:
+        stat(path)
+    except ClientError as err:
+        if err.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+            return False
+        raise
+    return True
+
+
+class RangeReader(io.RawIOBase):
+    """Seekable read-only file over an object, using ranged GET requests"""
+
+    def __init__(self, path, size=None):
+        self.bucket, self.key = split(path)
+        self.size = stat(path)[1] if size is None else size
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.pos = max(offset, 0)
+        return self.pos
+
+    def _get(self, size):
+        end = min(self.pos + size, self.size) - 1
+        if end < self.pos:
+            return b''
+        res = client().get_object(Bucket=self.bucket,
+                                  Key=self.key,
+                                  Range='bytes={}-{}'.format(self.pos, end))
+        data = res['Body'].read()
+        self.pos += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self._get(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def readall(self):
+        # Read the rest of the object with a single request
+        return self._get(self.size - self.pos)
+
+
+def open(path):
+    """Open an object for reading in binary mode"""
+    return io.BufferedReader(RangeReader(path), buffer_size=READ_CHUNK_SIZE)
+
+
+def upload(src_path, uri):
+    """Upload a file, in parallel multipart chunks if it is large"""
+    from boto3.s3.transfer import TransferConfig
+
+    bucket, key = split(uri)
+    _logger.info("Upload %s to %s", src_path, uri)
+    client().upload_file(src_path,
+                         bucket,
+                         key,
+                         Config=TransferConfig(
+                             multipart_threshold=MULTIPART_THRESHOLD,
+                             multipart_chunksize=MULTIPART_CHUNK_SIZE,
+                             max_concurrency=UPLOAD_PART_CONCURRENCY))
+    return uri
+
+
+class Uploader:
+    """Uploads files in background threads, as they become ready
+
+    When used as a context manager, it waits for all uploads to finish and
+    raises the first error, if any.
+    """
+
+    def __init__(self, max_workers=UPLOAD_FILE_CONCURRENCY):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = []
+        self.lock = threading.Lock()
+
+    def run(self, fn, *args, **kwargs):
+        """Run a function in the background, e.g. to finish files before
+        submitting their uploads from it"""
+        future = self.pool.submit(fn, *args, **kwargs)
+        with self.lock:
+            self.futures.append(future)
+        return future
+
+    def submit(self, src_path, uri):
+        return self.run(upload, src_path, uri)
+
+    def submit_tree(self, src_dir, uri):
+        """Upload all files inside *src_dir* under the *uri* prefix"""
+        for dirpath, _, filenames in os.walk(src_dir):
+            rel_dir = os.path.relpath(dirpath, src_dir)
+            for filename in filenames:
+                self.submit(
+                    os.path.join(dirpath, filename),
+                    join(uri, os.path.normpath(os.path.join(rel_dir,
+                                                            filename))))
+
+    def wait(self):
+        try:
+            # Functions passed to run may submit more uploads while waiting
+            i = 0
+            while True:
+                with self.lock:
+                    if i >= len(self.futures):
+                        break
+                    future = self.futures[i]
+                future.result()
+                i += 1
+        finally:
+            with self.lock:
+                self.futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.wait()
+        finally:
+            self.pool.shutdown(wait=True)
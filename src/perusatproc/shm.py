@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Shared memory buffers for handing tiles to worker processes without copies.
+
+Arrays sent to a process pool are pickled, copied through a pipe and
+unpickled on the way in and on the way out, which for large tiles (e.g. 32 MB
+for 4 bands of 2048x2048 uint16 pixels) costs more than most per-tile
+computations. A :class:`TileBufferPool` preallocates a number of slots of
+the size of a tile in a single shared memory block. The parent process
+writes a tile into a free slot and sends only its :class:`TileBuffer`
+descriptor. Workers map the slot with :func:`buffer_array`, read and write
+it in place, and the slot is released for the next tile when done.
+
+Workers keep the last few blocks they mapped attached (see
+:data:`MAX_ATTACHED`), and detach older ones, so that the memory of closed
+pools is freed even if workers outlive them. Workers can also call
+:func:`detach` when they know a pool is closed.
+
+Requires Python 3.8 or later.
+
+"""
+
+import logging
+import threading
+from collections import OrderedDict, deque, namedtuple
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+TileBuffer = namedtuple('TileBuffer',
+                        ['name', 'slot', 'offset', 'shape', 'dtype'])
+TileBuffer.__doc__ = """Descriptor of a tile in a slot of a shared memory
+block *name*, at byte *offset*, with an array *shape* and *dtype* (a numpy
+dtype string). It is small and cheap to pickle."""
+
+# Shared memory blocks attached by a process at once. Each pool has one
+# block, so this is the number of pools a worker can use concurrently.
+MAX_ATTACHED = 4
+
+# Shared memory blocks attached by this process, by name, least recently
+# used first
+_attached = OrderedDict()
+_attached_lock = threading.Lock()
+
+
+def _shared_memory():
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        raise RuntimeError(
+            'Shared memory tile buffers need Python 3.8 or later')
+    return shared_memory
+
+
+def _close(name, shm):
+    try:
+        shm.close()
+    except BufferError:
+        # Some arrays still map the block: it is unmapped when they are
+        # garbage collected
+        _logger.debug("Shared memory block %s is still mapped", name)
+
+
+def _attach(name):
+    # Attach to a block once per process, and keep it attached while it is
+    # used, as arrays returned by buffer_array are views of its buffer
+    with _attached_lock:
+        shm = _attached.get(name)
+        if shm is not None:
+            _attached.move_to_end(name)
+        else:
+            shared_memory = _shared_memory()
+            try:
+                shm = shared_memory.SharedMemory(name=name, track=False)
+            except TypeError:
+                # Before Python 3.13, attaching registers the block in the
+                # resource tracker, which would remove it when this process
+                # exits, even though the pool owns it. Unregistering it
+                # afterwards would also drop the registration of the owner
+                # when the tracker is shared (forked workers), so skip it.
+                from multiprocessing import resource_tracker
+                register = resource_tracker.register
+                resource_tracker.register = lambda name, rtype: None
+                try:
+                    shm = shared_memory.SharedMemory(name=name)
+                finally:
+                    resource_tracker.register = register
+            _attached[name] = shm
+            while len(_attached) > MAX_ATTACHED:
+                _close(*_attached.popitem(last=False))
+        return shm
+
+
+def detach(name):
+    """Detach this process from the shared memory block *name*, if attached
+
+    Arrays returned by :func:`buffer_array` for the block must not be used
+    afterwards.
+    """
+    with _attached_lock:
+        shm = _attached.pop(name, None)
+    if shm is not None:
+        _close(name, shm)
+
+
+def buffer_array(buf):
+    """Return a numpy array that maps the tile of a :class:`TileBuffer`, in
+    any process"""
+    import numpy as np
+
+    shm = _attach(buf.name)
+    return np.ndarray(buf.shape,
+                      dtype=buf.dtype,
+                      buffer=shm.buf,
+                      offset=buf.offset)
+
+
+class TileBufferPool:
+    """Pool of reusable tile slots in a shared memory block
+
+    Slots are acquired and released by the process that owns the pool (from
+    any of its threads), and workers only see the descriptors of the slots
+    they are given. Tiles smaller than the slot shape (e.g. at the edges of
+    an image) fit in a slot too.
+
+    Args:
+      slots (int): number of slots, i.e. tiles that can be in flight at once
+      shape (tuple): shape of the largest tile, e.g. (bands, rows, cols)
+      dtype (str): data type of tiles
+    """
+
+    def __init__(self, slots, shape, dtype='uint16'):
+        import numpy as np
+
+        shared_memory = _shared_memory()
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype).str
+        self.slot_size = int(np.prod(self.shape)) * np.dtype(dtype).itemsize
+        self.slots = slots
+        self.shm = shared_memory.SharedMemory(create=True,
+                                              size=slots * self.slot_size)
+        self.name = self.shm.name
+        self.free = deque(range(slots))
+        self.cond = threading.Condition()
+        _logger.debug("Created tile buffer pool %s of %d slots of %d bytes",
+                      self.name, slots, self.slot_size)
+
+    def acquire(self, timeout=None):
+        """Return the index of a free slot, waiting until one is released
+
+        Raises:
+          TimeoutError: if no slot is released within *timeout* seconds
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.free, timeout=timeout):
+                raise TimeoutError('No free slot in tile buffer pool')
+            return self.free.popleft()
+
+    def release(self, slot):
+        """Make a slot available for other tiles"""
+        with self.cond:
+            self.free.append(slot)
+            self.cond.notify()
+
+    def buffer(self, slot, shape=None):
+        """Return the :class:`TileBuffer` of a tile of *shape* (defaults to
+        the slot shape) in *slot*"""
+        import numpy as np
+
+        shape = tuple(shape or self.shape)
+        if int(np.prod(shape)) * np.dtype(self.dtype).itemsize > \
+                self.slot_size:
+            raise ValueError('Tile of shape {} does not fit in a slot of '
+                             'shape {}'.format(shape, self.shape))
+        return TileBuffer(name=self.name,
+                          slot=slot,
+                          offset=slot * self.slot_size,
+                          shape=shape,
+                          dtype=self.dtype)
+
+    def array(self, slot, shape=None):
+        """Return a numpy array that maps a tile in *slot*"""
+        import numpy as np
+
+        buf = self.buffer(slot, shape)
+        return np.ndarray(buf.shape,
+                          dtype=buf.dtype,
+                          buffer=self.shm.buf,
+                          offset=buf.offset)
+
+    def put(self, data, timeout=None):
+        """Copy an array into a free slot and return its :class:`TileBuffer`"""
+        slot = self.acquire(timeout=timeout)
+        try:
+            buf = self.buffer(slot, data.shape)
+            self.array(slot, data.shape)[...] = data
+        except BaseException:
+            self.release(slot)
+            raise
+        return buf
+
+    def close(self):
+        """Free the shared memory block
+
+        Arrays returned by :meth:`array` must not be used afterwards. The
+        memory is released once workers detach from the block too.
+        """
+        _close(self.name, self.shm)
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+Statistics, histograms and valid-data footprint accumulated while writing.
+
+A :class:`RasterStats` is fed each block of an image as it is written (see
+:func:`perusatproc.checkpoint.merge_tiles`), so that no extra pass over the
+image is needed to compute them afterwards. At the end:
+
+* Per-band minimum, maximum, mean, standard deviation and valid percent are
+  stored as GDAL ``STATISTICS_*`` metadata of the image, which GDAL and QGIS
+  use as is (e.g. for display stretches).
+* A footprint of valid pixels is built by vectorizing a coarse valid-data
+  mask.
+* Both, along with approximate histograms, are written as a STAC item
+  (with the projection and raster extensions) and a footprint GeoJSON next
+  to the image.
+
+"""
+
+import json
+import logging
+import math
+import os
+
+from perusatproc.workspace import commit, temp_path
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+# Resolution of the valid-data mask used for the footprint, as a fraction of
+# image resolution
+MASK_DECIMATION = 16
+
+# Pixel values are accumulated in HIST_BINS fixed bins over the whole range
+# of the data type, and rebinned to HIST_BUCKETS between min and max at the end
+HIST_BINS = 4096
+HIST_BUCKETS = 256
+
+STAC_VERSION = '1.0.0'
+STAC_EXTENSIONS = [
+    'https://stac-extensions.github.io/projection/v1.1.0/schema.json',
+    'https://stac-extensions.github.io/raster/v1.1.0/schema.json',
+]
+
+STAC_SUFFIX = '.json'
+FOOTPRINT_SUFFIX = '.geojson'
+
+
+def sidecar_paths(path):
+    """Return paths to the STAC item and footprint files of an image"""
+    base, _ = os.path.splitext(path)
+    return [base + STAC_SUFFIX, base + FOOTPRINT_SUFFIX]
+
+
+class RasterStats:
+    """Accumulator of band statistics, histograms and valid-data mask
+
+    Pixels equal to *nodata* are not valid. If the image has no nodata value,
+    0 is used, as it is the fill value of orthorectified images.
+    """
+
+    def __init__(self, *, count, width, height, dtype, transform, crs,
+                 nodata=None, mask_decimation=MASK_DECIMATION):
+        import numpy as np
+
+        self.count = count
+        self.width = width
+        self.height = height
+        self.dtype = np.dtype(dtype)
+        self.transform = transform
+        self.crs = crs
+        self.nodata = 0 if nodata is None else nodata
+        self.decimation = mask_decimation
+
+        self.valid = np.zeros(count, dtype='int64')
+        self.sum = np.zeros(count, dtype='float64')
+        self.sum_sq = np.zeros(count, dtype='float64')
+        self.min = np.full(count, np.inf)
+        self.max = np.full(count, -np.inf)
+
+        # Integer values are binned by dropping their lowest bits
+        self.hist = None
+        if self.dtype.kind in 'ui':
+            bits = self.dtype.itemsize * 8
+            self.hist_shift = max(bits - int(math.log2(HIST_BINS)), 0)
+            self.hist_offset = int(np.iinfo(self.dtype).min)
+            self.hist = np.zeros((count, 2**(bits - self.hist_shift)),
+                                 dtype='int64')
+
+        self.mask = np.zeros((math.ceil(height / mask_decimation),
+                              math.ceil(width / mask_decimation)),
+                             dtype=bool)
+
+    @classmethod
+    def for_dataset(cls, ds, **kwargs):
+        return cls(count=ds.count,
+                   width=ds.width,
+                   height=ds.height,
+                   dtype=ds.dtypes[0],
+                   transform=ds.transform,
+                   crs=ds.crs,
+                   nodata=ds.nodata,
+                   **kwargs)
+
+    def update(self, data, window):
+        """Accumulate a block of data (bands, rows, cols) at *window*"""
+        import numpy as np
+
+        valid = data != self.nodata
+        for i in range(self.count):
+            values = data[i][valid[i]]
+            if not values.size:
+                continue
+            self.valid[i] += values.size
+            values64 = values.astype('float64')
+            self.sum[i] += values64.sum()
+            self.sum_sq[i] += np.square(values64).sum()
+            self.min[i] = min(self.min[i], values.min())
+            self.max[i] = max(self.max[i], values.max())
+            if self.hist is not None:
+                bins = (values.astype('int64') -
+                        self.hist_offset) >> self.hist_shift
+                self.hist[i] += np.bincount(bins,
+                                            minlength=self.hist.shape[1])
+
+        self._update_mask(valid.any(axis=0), window)
+
+    def _update_mask(self, valid, window):
+        import numpy as np
+
+        # Reduce the block to mask cells: a cell is valid if any of its
+        # pixels is valid
+        f = self.decimation
+        rows = (window.row_off + np.arange(valid.shape[0])) // f
+        cols = (window.col_off + np.arange(valid.shape[1])) // f
+        row_starts = np.flatnonzero(np.diff(rows, prepend=-1))
+        col_starts = np.flatnonzero(np.diff(cols, prepend=-1))
+        cells = np.logical_or.reduceat(np.logical_or.reduceat(
+            valid, row_starts, axis=0),
+                                       col_starts,
+                                       axis=1)
+        self.mask[np.ix_(rows[row_starts], cols[col_starts])] |= cells
+
+    def band_statistics(self):
+        stats = []
+        total = self.width * self.height
+        for i in range(self.count):
+            n = int(self.valid[i])
+            if not n:
+                stats.append(None)
+                continue
+            mean = self.sum[i] / n
+            variance = max(self.sum_sq[i] / n - mean**2, 0.0)
+            stats.append(
+                dict(minimum=float(self.min[i]),
+                     maximum=float(self.max[i]),
+                     mean=float(mean),
+                     stddev=math.sqrt(variance),
+                     valid_percent=100.0 * n / total))
+        return stats
+
+    def histograms(self, buckets=HIST_BUCKETS):
+        """Return approximate histograms between min and max of each band"""
+        import numpy as np
+
+        if self.hist is None:
+            return [None] * self.count
+        hists = []
+        for i, stats in enumerate(self.band_statistics()):
+            if stats is None:
+                hists.append(None)
+                continue
+            width = 2**self.hist_shift
+            lo = (int(stats['minimum']) - self.hist_offset) // width
+            hi = (int(stats['maximum']) - self.hist_offset) // width
+            counts = self.hist[i][lo:hi + 1]
+            # Merge groups of fine bins into at most *buckets* buckets of the
+            # same width
+            group = math.ceil(len(counts) / buckets)
+            merged = np.add.reduceat(counts, np.arange(0, len(counts), group))
+            hists.append(
+                dict(count=len(merged),
+                     min=lo * width + self.hist_offset,
+                     max=(lo + len(merged) * group) * width +
+                     self.hist_offset,
+                     buckets=[int(c) for c in merged]))
+        return hists
+
+    def footprint(self):
+        """Return the footprint of valid pixels as a GeoJSON geometry, in the
+        CRS of the image"""
+        from rasterio import features
+        from rasterio.transform import Affine
+
+        # Each shape is a connected region of valid cells, so shapes are
+        # already disjoint and need no union
+        transform = self.transform * Affine.scale(self.decimation)
+        polygons = [
+            geom['coordinates'] for geom, value in features.shapes(
+                self.mask.astype('uint8'), mask=self.mask, transform=transform)
+            if value
+        ]
+        if not polygons:
+            return None
+        if len(polygons) == 1:
+            return dict(type='Polygon', coordinates=polygons[0])
+        return dict(type='MultiPolygon', coordinates=polygons)
+
+    def write_tags(self, ds):
+        """Store band statistics as GDAL metadata of a dataset open for
+        writing"""
+        for i, stats in enumerate(self.band_statistics(), start=1):
+            if stats is None:
+                continue
+            ds.update_tags(i,
+                           STATISTICS_MINIMUM=stats['minimum'],
+                           STATISTICS_MAXIMUM=stats['maximum'],
+                           STATISTICS_MEAN=stats['mean'],
+                           STATISTICS_STDDEV=stats['stddev'],
+                           STATISTICS_VALID_PERCENT=stats['valid_percent'])
+
+    def close(self, ds):
+        self.write_tags(ds)
+
+    def stac_item(self, path, datetime=None, properties=None):
+        """Return a STAC item of an image, with its statistics"""
+        from rasterio.warp import transform_geom
+
+        footprint = self.footprint()
+        geometry = None
+        bbox = None
+        if footprint:
+            geometry = transform_geom(self.crs, 'EPSG:4326', footprint)
+            xs, ys = zip(*_coords(geometry))
+            bbox = [min(xs), min(ys), max(xs), max(ys)]
+
+        bands = []
+        for stats, hist in zip(self.band_statistics(), self.histograms()):
+            band = dict(data_type=self.dtype.name, nodata=self.nodata)
+            if stats:
+                band['statistics'] = stats
+            if hist:
+                band['histogram'] = hist
+            bands.append(band)
+
+        props = dict(datetime=datetime)
+        props.update({
+            'proj:epsg': self.crs.to_epsg() if self.crs else None,
+            'proj:shape': [self.height, self.width],
+            'proj:transform': list(self.transform)[:6],
+        })
+        props.update(properties or {})
+
+        name = os.path.basename(path)
+        return dict(type='Feature',
+                    stac_version=STAC_VERSION,
+                    stac_extensions=STAC_EXTENSIONS,
+                    id=os.path.splitext(name)[0],
+                    geometry=geometry,
+                    bbox=bbox,
+                    properties=props,
+                    links=[],
+                    assets=dict(data={
+                        'href': './{}'.format(name),
+                        'type': 'image/tiff; application=geotiff',
+                        'roles': ['data'],
+                        'raster:bands': bands,
+                    }))
+
+    def write_sidecars(self, path, datetime=None, properties=None):
+        """Write STAC item and footprint GeoJSON files next to *path*"""
+        item = self.stac_item(path, datetime=datetime, properties=properties)
+        stac_path, footprint_path = sidecar_paths(path)
+        _write_json(stac_path, item)
+        _write_json(
+            footprint_path,
+            dict(type='Feature',
+                 geometry=item['geometry'],
+                 properties=dict(id=item['id'], datetime=datetime)))
+        return [stac_path, footprint_path]
+
+
+def _coords(geometry):
+    if geometry['type'] == 'Polygon':
+        return [c for ring in geometry['coordinates'] for c in ring]
+    return [c for poly in geometry['coordinates'] for ring in poly for c in ring]
+
+
+def _write_json(path, obj):
+    tmp_path = temp_path(path)
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    commit(tmp_path, path)
+
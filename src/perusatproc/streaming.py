@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+"""
+Tile-level streaming of the stages of a volume.
+
+Instead of calibrating, orthorectifying and pansharpening whole images one
+after the other, each stage computes tiles, and stages are connected by
+bounded queues (see :mod:`perusatproc.pipeline`):
+
+* Raw MS and P images are calibrated tile by tile.
+* The calibrated tiles of each image are read through a virtual raster with
+  the RPC tags of the image, so no RPC stage is needed.
+* Images are orthorectified into an explicit grid (by default in the UTM
+  zone of the scene), aligned to multispectral pixels, so that MS and P
+  tiles cover the same ground. An output tile is orthorectified as soon as
+  the calibrated tiles that cover its source window are done. Source windows
+  are computed with the RPC model for the whole height range of the model,
+  plus a margin.
+* A pansharpened tile is computed as soon as the MS and P orthorectified
+  tiles around it are done.
+
+Pansharpened tiles are finally merged into the volume image. Each stage
+records its finished tiles in a checkpoint, so an interrupted job resumes
+from the tiles it already computed.
+
+"""
+
+import hashlib
+import json
+import logging
+import math
+import os
+import shutil
+
+from perusatproc import calibration, orthorectification, pansharpening, product, transcode, vfs, vrt
+from perusatproc.checkpoint import CHECKPOINT_SUFFIX, TileCheckpoint, merge_tiles, tile_grid
+from perusatproc.dynamic import PAN_RATIO
+from perusatproc.metadata import extract_projection_metadata, extract_raster_filepath
+from perusatproc.pipeline import DEFAULT_QUEUE_SIZE, Pipeline, TileStage
+from perusatproc.profiles import BLOCK_SIZE, SCRATCH, creation_options, rasterio_options
+from perusatproc.rpc import RPCModel
+from perusatproc.workspace import commit, temp_path
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+# Size of tiles of the panchromatic grid. Tiles of multispectral images are
+# PAN_RATIO times smaller, and cover the same ground.
+DEFAULT_TILE_SIZE = 4096
+
+# Extra source pixels around the window needed by an orthorectified tile,
+# for interpolation and DEM errors
+SOURCE_MARGIN = 128
+
+# Points sampled along each edge of a tile to compute its source window
+EDGE_POINTS = 4
+
+
+def stream_key(paths, **params):
+    """Return a key that identifies a streaming job from its input files
+    (which can be in archives) and parameters"""
+    h = hashlib.sha1()
+    for path in paths:
+        h.update(repr((path, vfs.cache_key(path))).encode())
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def pixel_infos(paths, boxes, count, block_size=BLOCK_SIZE):
+    """Return :class:`perusatproc.vrt.RasterInfo` of tiles of a raw
+    (not georeferenced) image, in pixel coordinates"""
+    from rasterio.transform import Affine
+
+    return [
+        vrt.RasterInfo(path=path,
+                       width=w,
+                       height=h,
+                       count=count,
+                       dtype='uint16',
+                       crs=None,
+                       transform=Affine(1, 0, x, 0, -1, -y),
+                       nodata=None,
+                       block_shape=(block_size, block_size),
+                       colorinterp=None) for path, (x, y, w, h) in zip(
+                           paths, boxes)
+    ]
+
+
+def grid_infos(paths, boxes, count, grid, block_size=BLOCK_SIZE):
+    """Return :class:`perusatproc.vrt.RasterInfo` of tiles of an
+    :class:`perusatproc.orthorectification.OutputGrid`"""
+    from rasterio.crs import CRS
+    from rasterio.transform import Affine
+
+    crs = CRS.from_epsg(grid.epsg).to_wkt()
+    size = grid.pixel_size
+    return [
+        vrt.RasterInfo(path=path,
+                       width=w,
+                       height=h,
+                       count=count,
+                       dtype='uint16',
+                       crs=crs,
+                       transform=Affine(size, 0, grid.ulx + x * size, 0,
+                                        -size, grid.uly - y * size),
+                       nodata=None,
+                       block_shape=(block_size, block_size),
+                       colorinterp=None) for path, (x, y, w, h) in zip(
+                           paths, boxes)
+    ]
+
+
+def source_window(grid, box, rpc, width, height, margin=SOURCE_MARGIN):
+    """Return the (x, y, width, height) window of a raw image of size
+    (*width*, *height*) needed to orthorectify a *box* of *grid*, or None if
+    it is outside the image"""
+    from rasterio.warp import transform
+
+    x, y, w, h = box
+    xs, ys = [], []
+    for k in range(EDGE_POINTS + 1):
+        t = k / EDGE_POINTS
+        for u, v in ((x + w * t, y), (x + w * t, y + h), (x, y + h * t),
+                     (x + w, y + h * t)):
+            xs.append(grid.ulx + u * grid.pixel_size)
+            ys.append(grid.uly - v * grid.pixel_size)
+    lons, lats = transform('EPSG:{}'.format(grid.epsg), 'EPSG:4326', xs, ys)
+
+    p = rpc.params
+    cols, rows = [], []
+    for height_ in (p['height_offset'] - p['height_scale'],
+                    p['height_offset'] + p['height_scale']):
+        c, r = rpc.project(lons, lats, height_)
+        cols.extend(c)
+        rows.extend(r)
+
+    col0 = max(int(math.floor(min(cols))) - margin, 0)
+    row0 = max(int(math.floor(min(rows))) - margin, 0)
+    col1 = min(int(math.ceil(max(cols))) + margin + 1, width)
+    row1 = min(int(math.ceil(max(rows))) + margin + 1, height)
+    if col1 <= col0 or row1 <= row0:
+        return None
+    return col0, row0, col1 - col0, row1 - row0
+
+
+def intersecting(boxes, window):
+    """Return indexes of *boxes* that intersect *window*"""
+    if window is None:
+        return []
+    wx, wy, ww, wh = window
+    return [
+        i for i, (x, y, w, h) in enumerate(boxes)
+        if x < wx + ww and wx < x + w and y < wy + wh and wy < y + h
+    ]
+
+
+def neighbours(i, width, height, tile_size):
+    """Return indexes of the tile *i* of a grid of tiles (see
+    :func:`perusatproc.checkpoint.tile_grid`) of an image and of the tiles
+    around it"""
+    ncols = -(-width // tile_size)
+    nrows = -(-height // tile_size)
+    row, col = divmod(i, ncols)
+    return [
+        r * ncols + c for r in range(max(row - 1, 0), min(row + 2, nrows))
+        for c in range(max(col - 1, 0), min(col + 2, ncols))
+    ]
+
+
+class ImageStages:
+    """Calibration and orthorectification stages of a raw image"""
+
+    def __init__(self,
+                 image_dir,
+                 work_dir,
+                 grid,
+                 tile_size,
+                 key,
+                 dem_path=None,
+                 geoid_path=None,
+                 spacing=None,
+                 create_options=[],
+                 transcode_cache=None,
+                 calibration_engine=calibration.OTB,
+                 workers=1,
+                 queue_size=DEFAULT_QUEUE_SIZE):
+        self.name = os.path.basename(os.path.normpath(image_dir))
+        dim_xml, rpc_xml = product.find_metadata_files(image_dir)
+        src_path = os.path.join(image_dir, extract_raster_filepath(dim_xml))
+        if transcode_cache and transcode.needs_transcode(src_path):
+            src_path = transcode.cached_path(src_path, transcode_cache)
+        proj = extract_projection_metadata(dim_xml)
+        self.count = proj['nbands']
+        self.grid = grid
+        block_size = int(
+            rasterio_options(create_options).get('blockxsize', BLOCK_SIZE))
+
+        # Calibrated tiles, read through a virtual raster with RPC tags
+        calib_dir = os.path.join(work_dir, 'calibration')
+        os.makedirs(calib_dir, exist_ok=True)
+        self.calib_boxes = tile_grid(proj['sizex'], proj['sizey'], tile_size)
+        self.calib_paths = _tile_paths(calib_dir, len(self.calib_boxes))
+        self.calib_vrt = calib_dir + '.vrt'
+        vrt.build_vrt(
+            pixel_infos(self.calib_paths, self.calib_boxes, self.count,
+                        block_size),
+            self.calib_vrt,
+            metadata=dict(RPC=orthorectification.rpc_tags(rpc_xml)))
+
+        def calibrate_tile(i):
+            _write_tile(
+                self.calib_paths[i], lambda path: calibration.calibrate(
+                    src_path=src_path,
+                    dst_path=path,
+                    metadata_path=dim_xml,
+                    create_options=create_options,
+                    box=self.calib_boxes[i],
+                    engine=calibration_engine))
+
+        self.calibration = TileStage(
+            '{}/calibration'.format(self.name),
+            len(self.calib_boxes),
+            calibrate_tile,
+            workers=workers,
+            queue_size=queue_size,
+            checkpoint=TileCheckpoint(calib_dir + CHECKPOINT_SUFFIX, key,
+                                      len(self.calib_boxes)))
+
+        # Orthorectified tiles of the output grid
+        ortho_dir = os.path.join(work_dir, 'orthorectification')
+        os.makedirs(ortho_dir, exist_ok=True)
+        self.ortho_boxes = tile_grid(grid.width, grid.height, tile_size)
+        self.ortho_paths = _tile_paths(ortho_dir, len(self.ortho_boxes))
+        self.ortho_vrt = ortho_dir + '.vrt'
+        vrt.build_vrt(
+            grid_infos(self.ortho_paths, self.ortho_boxes, self.count, grid,
+                       block_size), self.ortho_vrt)
+
+        rpc = RPCModel.from_metadata(rpc_xml)
+
+        def ortho_deps(i):
+            window = source_window(grid, self.ortho_boxes[i], rpc,
+                                   proj['sizex'], proj['sizey'])
+            return [(self.calibration, j)
+                    for j in intersecting(self.calib_boxes, window)]
+
+        def orthorectify_tile(i):
+            _write_tile(
+                self.ortho_paths[i],
+                lambda path: orthorectification.orthorectify(
+                    src_path=self.calib_vrt,
+                    dst_path=path,
+                    dem_path=dem_path,
+                    geoid_path=geoid_path,
+                    spacing=spacing,
+                    create_options=create_options,
+                    grid=grid,
+                    box=self.ortho_boxes[i]))
+
+        self.orthorectification = TileStage(
+            '{}/orthorectification'.format(self.name),
+            len(self.ortho_boxes),
+            orthorectify_tile,
+            deps=ortho_deps,
+            workers=workers,
+            queue_size=queue_size,
+            checkpoint=TileCheckpoint(ortho_dir + CHECKPOINT_SUFFIX, key,
+                                      len(self.ortho_boxes)))
+
+    @property
+    def stages(self):
+        return [self.calibration, self.orthorectification]
+
+
+def _tile_paths(tiles_dir, ntiles):
+    return [
+        os.path.join(tiles_dir, '{:05d}.tif'.format(i)) for i in range(ntiles)
+    ]
+
+
+def _write_tile(path, write):
+    # Tiles are moved into place when complete, as other stages may be
+    # reading finished tiles through a virtual raster
+    tmp_path = temp_path(path)
+    write(tmp_path)
+    commit(tmp_path, path)
+
+
+def stream_volume(volume,
+                  dst_path,
+                  work_dir,
+                  dem_path=None,
+                  geoid_path=None,
+                  spacing=None,
+                  tile_size=DEFAULT_TILE_SIZE,
+                  create_options=[],
+                  scratch_create_options=[],
+                  transcode_cache=None,
+                  calibration_engine=calibration.OTB,
+                  workers=1,
+                  queue_size=DEFAULT_QUEUE_SIZE,
+                  progress=None,
+                  sinks=[],
+                  grid=None,
+                  merge=True):
+    """Calibrate, orthorectify and pansharpen a volume tile by tile, with
+    all stages running at once
+
+    Args:
+      volume (str): path to volume
+      dst_path (str): path to pansharpened image
+      work_dir (str): directory of intermediate tiles, removed when done
+      dem_path, geoid_path, spacing: see
+        :func:`perusatproc.orthorectification.orthorectify`
+      tile_size (int): size of tiles of the pansharpened image (a multiple
+        of PAN_RATIO)
+      create_options ([str]): GDAL creation options of the pansharpened
+        image
+      scratch_create_options ([str]): GDAL creation options of tiles
+      transcode_cache (str): directory of transcoded JPEG2000 sources (see
+        :mod:`perusatproc.transcode`)
+      calibration_engine (str): see :func:`perusatproc.calibration.calibrate`
+      workers (int): worker threads of each stage
+      queue_size (int): maximum tiles ready to be computed by each stage
+      progress (callable): optional function called with overall progress
+      sinks (list): passed to :func:`perusatproc.checkpoint.merge_tiles`
+      grid: :class:`perusatproc.orthorectification.OutputGrid` of the
+        pansharpened image (see
+        :func:`perusatproc.orthorectification.volume_grid` for the default)
+      merge (bool): merge pansharpened tiles into *dst_path*. If False, they
+        are kept in *work_dir*, for the caller to read them (e.g. through a
+        virtual raster), and *sinks* are not used.
+
+    Returns:
+      list: objects created by *sinks*, or paths to pansharpened tiles if
+      *merge* is False
+    """
+    tile_size = max(tile_size // PAN_RATIO, 1) * PAN_RATIO
+    scratch_options = creation_options(SCRATCH, scratch_create_options)
+
+    p_grid = grid or orthorectification.volume_grid(volume)
+    ms_grid = orthorectification.scale_grid(p_grid, PAN_RATIO)
+    _logger.info("Stream %s into a %dx%d grid of %.2f m pixels (EPSG:%d)",
+                 volume, p_grid.width, p_grid.height, p_grid.pixel_size,
+                 p_grid.epsg)
+
+    ms_dir = product.find_image_dir(volume, product.MS)
+    p_dir = product.find_image_dir(volume, product.P)
+    key = stream_key([
+        os.path.join(d, extract_raster_filepath(
+            product.find_metadata_files(d)[0])) for d in (ms_dir, p_dir)
+    ],
+                     grid=p_grid,
+                     tile_size=tile_size,
+                     dem_path=dem_path,
+                     geoid_path=geoid_path,
+                     spacing=spacing,
+                     create_options=scratch_options,
+                     calibration_engine=calibration_engine)
+
+    image_options = dict(key=key,
+                         dem_path=dem_path,
+                         geoid_path=geoid_path,
+                         spacing=spacing,
+                         create_options=scratch_options,
+                         transcode_cache=transcode_cache,
+                         calibration_engine=calibration_engine,
+                         workers=workers,
+                         queue_size=queue_size)
+    ms = ImageStages(ms_dir, os.path.join(work_dir, product.MS), ms_grid,
+                     tile_size // PAN_RATIO, **image_options)
+    p = ImageStages(p_dir, os.path.join(work_dir, product.P), p_grid,
+                    tile_size, **image_options)
+
+    # MS and P tiles have the same index, as they cover the same ground.
+    # Tiles around each one are also needed, for interpolation.
+    pan_dir = os.path.join(work_dir, 'pansharpening')
+    os.makedirs(pan_dir, exist_ok=True)
+    pan_boxes = p.ortho_boxes
+    pan_paths = _tile_paths(pan_dir, len(pan_boxes))
+
+    def pansharpen_deps(i):
+        tiles = neighbours(i, p_grid.width, p_grid.height, tile_size)
+        return ([(p.orthorectification, j) for j in tiles] +
+                [(ms.orthorectification, j) for j in tiles])
+
+    def pansharpen_tile(i):
+        _write_tile(
+            pan_paths[i], lambda path: pansharpening.pansharpen(
+                inp=p.ortho_vrt,
+                inxs=ms.ortho_vrt,
+                out=path,
+                create_options=scratch_options,
+                box=pan_boxes[i]))
+
+    pansharpen_stage = TileStage('pansharpening',
+                                 len(pan_boxes),
+                                 pansharpen_tile,
+                                 deps=pansharpen_deps,
+                                 workers=workers,
+                                 queue_size=queue_size,
+                                 checkpoint=TileCheckpoint(
+                                     pan_dir + CHECKPOINT_SUFFIX, key,
+                                     len(pan_boxes)))
+
+    Pipeline(ms.stages + p.stages + [pansharpen_stage],
+             progress=progress).run()
+
+    if not merge:
+        for kind in (product.MS, product.P):
+            shutil.rmtree(os.path.join(work_dir, kind))
+        return pan_paths
+
+    _logger.info("Merge %d tiles into %s", len(pan_boxes), dst_path)
+    outputs = merge_tiles(pan_paths, pan_boxes, dst_path, p_grid.width,
+                          p_grid.height, create_options, sinks)
+    shutil.rmtree(work_dir)
+    return outputs
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Serializable task graphs and a minimal scheduler over executors.
+
+A task is a module-level function plus keyword arguments, so it can be
+pickled and sent to a process pool or a remote worker. Dependencies are
+declared as a mapping from keyword argument name to the key of another task,
+whose result is passed as that argument once available.
+
+Tasks that fail because memory ran out are submitted again with fewer tasks
+running at once, down to one.
+
+"""
+
+import logging
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from perusatproc.util import is_memory_error
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+Task = namedtuple('Task', ['key', 'func', 'kwargs', 'deps'])
+
+# Times a task is submitted again after running out of memory
+MEMORY_RETRIES = 2
+
+
+def run_tasks(tasks, executor, admission=None, costs=None, on_result=None):
+    """Run a list of tasks on *executor* respecting their dependencies
+
+    *executor* can be any :class:`concurrent.futures.Executor`-like object
+    (i.e. with a ``submit`` method returning futures).
+
+    If *admission* is set (see :class:`perusatproc.planner.Admission`), ready
+    tasks are only submitted when their cost (from *costs*, by key) fits the
+    available resources.
+
+    If *on_result* is set, it is called on this thread with the key and result
+    of each task as soon as it finishes.
+
+    If a task runs out of memory (see :func:`perusatproc.util.is_memory_error`)
+    the number of tasks running at once is halved and it is submitted again,
+    up to :data:`MEMORY_RETRIES` times.
+
+    Returns a dict with the result of each task by key.
+    """
+    pending = {task.key: task for task in tasks}
+    results = {}
+    running = {}
+
+    for task in tasks:
+        for dep in task.deps.values():
+            if dep not in pending:
+                raise ValueError('Task {} depends on unknown task {}'.format(
+                    task.key, dep))
+
+    costs = costs or {}
+    retries = {}
+    max_running = None
+    while pending or running:
+        for key, task in list(pending.items()):
+            if max_running and len(running) >= max_running:
+                break
+            if all(dep in results for dep in task.deps.values()):
+                if admission and not admission.try_acquire(costs.get(key)):
+                    _logger.debug("Task %s waits for resources", key)
+                    continue
+                kwargs = dict(task.kwargs)
+                kwargs.update(
+                    {arg: results[dep]
+                     for arg, dep in task.deps.items()})
+                _logger.debug("Submit task %s", key)
+                running[executor.submit(task.func, **kwargs)] = (key, task)
+                del pending[key]
+
+        if not running:
+            raise RuntimeError('Circular dependencies between tasks: {}'.format(
+                ', '.join(pending)))
+
+        done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+        for future in done:
+            key, task = running.pop(future)
+            if admission:
+                admission.release(costs.get(key))
+            exc = future.exception()
+            if exc is not None and is_memory_error(exc) and retries.get(
+                    key, 0) < MEMORY_RETRIES:
+                retries[key] = retries.get(key, 0) + 1
+                limit = len(running) + 1
+                if max_running:
+                    limit = min(limit, max_running)
+                max_running = max(1, limit // 2)
+                _logger.warning(
+                    "Task %s ran out of memory, retry with up to %d tasks "
+                    "at once", key, max_running)
+                pending[key] = task
+                continue
+            results[key] = future.result()
+            _logger.debug("Task %s finished", key)
+            if on_result:
+                on_result(key, results[key])
+
+    return results
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP server of XYZ web map tiles rendered on demand from a raw product.
+
+Each requested tile is computed from the raw images of the volumes it
+intersects (see :mod:`perusatproc.dynamic`), stretched to 8-bit RGB with
+limits estimated once per product, and encoded as a PNG with transparency.
+Rendered tiles are kept in a bounded in-memory LRU cache, and optionally in
+a directory, bounded in size, that survives restarts.
+
+Tiles are served at ``/{z}/{x}/{y}.png``, and a TileJSON document at ``/``.
+Requests are handled by a fixed pool of threads, each of which keeps the
+raw images open across requests.
+
+"""
+
+import json
+import logging
+import math
+import os
+import re
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from perusatproc import product, visual
+from perusatproc.dynamic import Volume
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+TILE_SIZE = 256
+
+# Whole scenes fit in a tile at zoom 10, and panchromatic pixels are about
+# the size of tile pixels at zoom 18
+DEFAULT_MIN_ZOOM = 10
+DEFAULT_MAX_ZOOM = 20
+
+DEFAULT_CACHE_TILES = 1024
+DEFAULT_DISK_CACHE_SIZE = 1024 * 2**20
+DEFAULT_WORKERS = 8
+
+EARTH_RADIUS = 6378137.0
+ORIGIN_SHIFT = math.pi * EARTH_RADIUS
+
+TILE_PATH_RE = re.compile(r'^/(\d+)/(\d+)/(\d+)\.png$')
+
+
+def tile_bounds(z, x, y):
+    """Return (west, south, east, north) bounds of a web mercator tile, in
+    degrees"""
+    n = 2**z
+
+    def lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return (x / n * 360 - 180, lat(y + 1), (x + 1) / n * 360 - 180, lat(y))
+
+
+def tile_coordinates(z, x, y, size=TILE_SIZE):
+    """Return (lons, lats) arrays of the centers of the pixels of a tile"""
+    import numpy as np
+
+    res = 2 * ORIGIN_SHIFT / (size * 2**z)
+    offsets = (np.arange(size) + 0.5) * res
+    xs = -ORIGIN_SHIFT + x * size * res + offsets
+    ys = ORIGIN_SHIFT - y * size * res - offsets
+    lons = np.degrees(xs / EARTH_RADIUS)
+    lats = np.degrees(np.arctan(np.sinh(ys / EARTH_RADIUS)))
+    return np.meshgrid(lons, lats)
+
+
+def encode_png(rgba):
+    """Encode a (height, width, 4) uint8 array as an RGBA PNG"""
+    import numpy as np
+
+    h, w = rgba.shape[:2]
+    # Each row starts with its filter type (0, no filter)
+    raw = np.concatenate([np.zeros((h, 1), dtype='uint8'),
+                          rgba.reshape(h, w * 4)],
+                         axis=1).tobytes()
+
+    def chunk(tag, data):
+        return (struct.pack('>I', len(data)) + tag + data +
+                struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 6, 0, 0, 0)),
+        chunk(b'IDAT', zlib.compress(raw, 6)),
+        chunk(b'IEND', b''),
+    ])
+
+
+class TileCache:
+    """Thread-safe LRU cache of encoded tiles, in memory and optionally on
+    disk
+
+    Tiles with no data are cached as None.
+    """
+
+    def __init__(self,
+                 max_tiles=DEFAULT_CACHE_TILES,
+                 cache_dir=None,
+                 max_disk_size=DEFAULT_DISK_CACHE_SIZE):
+        self.max_tiles = max_tiles
+        self.cache_dir = cache_dir
+        self.max_disk_size = max_disk_size
+        self.lock = threading.Lock()
+        self.tiles = OrderedDict()
+        # Files in the cache directory and their size, least recently used
+        # first
+        self.files = OrderedDict()
+        self.disk_size = 0
+        if cache_dir:
+            self._load_dir()
+
+    def _load_dir(self):
+        entries = []
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if filename.startswith('.') or not filename.endswith('.png'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                st = os.stat(path)
+                entries.append((st.st_mtime, path, st.st_size))
+        for _, path, size in sorted(entries):
+            self.files[path] = size
+            self.disk_size += size
+        _logger.info("Found %d cached tiles (%d MB) in %s", len(self.files),
+                     self.disk_size // 2**20, self.cache_dir)
+
+    def _path(self, key):
+        z, x, y = key
+        return os.path.join(self.cache_dir, str(z), str(x), '{}.png'.format(y))
+
+    def get(self, key):
+        """Return (found, tile)"""
+        with self.lock:
+            if key in self.tiles:
+                self.tiles.move_to_end(key)
+                return True, self.tiles[key]
+            if not self.cache_dir:
+                return False, None
+            path = self._path(key)
+            if path not in self.files:
+                return False, None
+            self.files.move_to_end(path)
+        # The file may be evicted by another thread meanwhile
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Keep the access order on disk across restarts
+            os.utime(path)
+        except FileNotFoundError:
+            return False, None
+        self._put_memory(key, data)
+        return True, data
+
+    def put(self, key, data):
+        self._put_memory(key, data)
+        if self.cache_dir and data is not None:
+            self._put_disk(key, data)
+
+    def _put_memory(self, key, data):
+        with self.lock:
+            self.tiles[key] = data
+            self.tiles.move_to_end(key)
+            while len(self.tiles) > self.max_tiles:
+                self.tiles.popitem(last=False)
+
+    def _put_disk(self, key, data):
+        from perusatproc.workspace import commit, temp_path
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = temp_path(path)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        commit(tmp_path, path)
+        with self.lock:
+            self.disk_size += len(data) - self.files.pop(path, 0)
+            self.files[path] = len(data)
+            while self.disk_size > self.max_disk_size and len(self.files) > 1:
+                old_path, size = self.files.popitem(last=False)
+                self.disk_size -= size
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+
+
+class ProductTiles:
+    """Renders tiles of a raw product"""
+
+    def __init__(self,
+                 src,
+                 min_zoom=DEFAULT_MIN_ZOOM,
+                 max_zoom=DEFAULT_MAX_ZOOM,
+                 size=TILE_SIZE):
+        self.name = product.product_name(src)
+        self.volumes = [Volume(v) for v in product.find_volumes(src)]
+        if not self.volumes:
+            raise RuntimeError('No volumes found at {}'.format(src))
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.size = size
+        self.bounds = (min(v.bounds[0] for v in self.volumes),
+                       min(v.bounds[1] for v in self.volumes),
+                       max(v.bounds[2] for v in self.volumes),
+                       max(v.bounds[3] for v in self.volumes))
+
+        # Use the same stretch for all volumes, so that there are no seams
+        first = self.volumes[0]
+        self.rgb_bands = first.rgb_bands
+        self.stretch = visual.compute_reflectance_stretch(
+            first.ms.path, first.ms.dim_xml, bands=self.rgb_bands)
+
+    def render(self, z, x, y):
+        """Return a tile as PNG, or None if it has no data"""
+        import numpy as np
+
+        if not self.min_zoom <= z <= self.max_zoom or not (0 <= x < 2**z and
+                                                          0 <= y < 2**z):
+            return None
+        bounds = tile_bounds(z, x, y)
+        volumes = [v for v in self.volumes if v.intersects(bounds)]
+        if not volumes:
+            return None
+
+        lons, lats = tile_coordinates(z, x, y, self.size)
+        values = np.zeros((3, self.size, self.size), dtype='float32')
+        mask = np.zeros((self.size, self.size), dtype=bool)
+        for volume in volumes:
+            result = volume.render(lons, lats, bands=self.rgb_bands)
+            if result is None:
+                continue
+            data, valid = result
+            # Volumes overlap slightly: keep pixels of the first one
+            fill = valid & ~mask
+            values[:, fill] = data[:, fill]
+            mask |= fill
+        if not mask.any():
+            return None
+
+        rgba = np.zeros((self.size, self.size, 4), dtype='uint8')
+        for i, (low, high) in enumerate(self.stretch):
+            scaled = (values[i] - low) * (255 / (high - low))
+            rgba[..., i] = np.clip(scaled, 0, 255)
+        rgba[..., 3] = mask * 255
+        return encode_png(rgba)
+
+    def tilejson(self, url):
+        return dict(tilejson='2.2.0',
+                    name=self.name,
+                    tiles=['{}/{{z}}/{{x}}/{{y}}.png'.format(url)],
+                    minzoom=self.min_zoom,
+                    maxzoom=self.max_zoom,
+                    bounds=list(self.bounds))
+
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        if self.path in ('/', '/tilejson.json'):
+            host = self.headers.get('Host') or '{}:{}'.format(
+                *server.server_address[:2])
+            body = json.dumps(server.tiles.tilejson(
+                'http://{}'.format(host))).encode()
+            return self._send(200, body, 'application/json')
+
+        match = TILE_PATH_RE.match(self.path)
+        if not match:
+            return self._send(404, b'Not found', 'text/plain')
+        key = tuple(int(v) for v in match.groups())
+        found, tile = server.cache.get(key)
+        if not found:
+            try:
+                tile = server.tiles.render(*key)
+            except Exception:
+                _logger.exception("Failed to render tile %s", key)
+                return self._send(500, b'Failed to render tile', 'text/plain')
+            server.cache.put(key, tile)
+        if tile is None:
+            return self._send(404, b'No data', 'text/plain')
+        self._send(200, tile, 'image/png')
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class TileServer(HTTPServer):
+    """HTTP server of the tiles of a product
+
+    Unlike :class:`socketserver.ThreadingMixIn`, which starts a thread per
+    request, requests are handled by a fixed pool of *workers* threads, so
+    that the datasets each thread opens are reused.
+    """
+
+    def __init__(self, address, tiles, cache, workers=DEFAULT_WORKERS):
+        super().__init__(address, TileRequestHandler)
+        self.tiles = tiles
+        self.cache = cache
+        self.pool = ThreadPoolExecutor(max_workers=workers,
+                                       thread_name_prefix='tileserver')
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
+
+def serve(src,
+          host='127.0.0.1',
+          port=8080,
+          min_zoom=DEFAULT_MIN_ZOOM,
+          max_zoom=DEFAULT_MAX_ZOOM,
+          cache_tiles=DEFAULT_CACHE_TILES,
+          cache_dir=None,
+          max_disk_size=DEFAULT_DISK_CACHE_SIZE,
+          workers=DEFAULT_WORKERS):
+    """Serve tiles of a raw product until interrupted"""
+    tiles = ProductTiles(src, min_zoom=min_zoom, max_zoom=max_zoom)
+    if cache_dir:
+        # Tiles of each product are cached in their own directory
+        cache_dir = os.path.join(cache_dir, tiles.name)
+    cache = TileCache(cache_tiles,
+                      cache_dir=cache_dir,
+                      max_disk_size=max_disk_size)
+    server = TileServer((host, port), tiles, cache, workers=workers)
+    _logger.info("Serving tiles of %s at http://%s:%d/{z}/{x}/{y}.png",
+                 tiles.name, host, port)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
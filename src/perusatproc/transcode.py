@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Transcode-once cache of JPEG2000 source rasters.
+
+Decoding JPEG2000 is much slower than reading a tiled GeoTIFF, and raw
+images are read by every run that processes them. When enabled, each
+JPEG2000 raster is decoded once, with all CPUs, into a tiled GeoTIFF with
+fast compression in a cache directory, and stages read that file instead.
+
+Cached files are named after a key computed from the content of the source
+(its size and a hash of its first and last bytes), so the cache is shared by
+different paths to the same file (e.g. a product extracted in several
+places, or read from an uncompressed archive), and is never stale. Files in
+compressed archives are keyed by their checksum instead, so they are not
+decompressed just to compute the key. The least recently
+used files are removed when the cache grows over its maximum size.
+
+"""
+
+import hashlib
+import logging
+import os
+
+from perusatproc import gdal_config, vfs
+from perusatproc.profiles import TRANSCODE, creation_options, rasterio_options
+from perusatproc.workspace import commit, temp_path
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+JPEG2000_EXTENSIONS = ('.jp2', '.j2k', '.jpx')
+
+# Bytes hashed at the start and end of files to compute their key
+HASHED_SIZE = 2**20
+
+DEFAULT_MAX_SIZE = 100 * 2**30
+
+
+def needs_transcode(path):
+    return os.path.splitext(path)[1].lower() in JPEG2000_EXTENSIONS
+
+
+def content_key(path):
+    """Return a key of the content of a file, from its size and its first
+    and last bytes
+
+    Files inside compressed archives, whose last bytes can only be read by
+    decompressing all of them, are keyed by their checksum (or position in
+    the archive) and size instead.
+    """
+    compressed = vfs.compressed_key(path)
+    if compressed:
+        return hashlib.sha1(repr(compressed).encode()).hexdigest()
+    _, size = vfs.cache_key(path)
+    h = hashlib.sha1(str(size).encode())
+    h.update(vfs.read_range(path, 0, HASHED_SIZE))
+    h.update(vfs.read_range(path, max(size - HASHED_SIZE, 0), HASHED_SIZE))
+    return h.hexdigest()
+
+
+def transcode(src_path, dst_path, create_options=[]):
+    """Decode a raster into a GeoTIFF"""
+    import rasterio.shutil
+
+    options = rasterio_options(creation_options(TRANSCODE, create_options))
+    with gdal_config.env('transcode'):
+        rasterio.shutil.copy(vfs.to_gdal_path(src_path),
+                             dst_path,
+                             driver='GTiff',
+                             **options)
+
+
+def cached_path(src_path, cache_dir, create_options=[],
+                max_size=DEFAULT_MAX_SIZE):
+    """Return the path to the transcoded copy of *src_path* in *cache_dir*,
+    transcoding it if it is not cached yet"""
+    key = content_key(src_path)
+    path = os.path.join(cache_dir, '{}.tif'.format(key))
+    if os.path.exists(path):
+        _logger.info("Use cached transcoded %s for %s", path, src_path)
+        # Mark as recently used
+        os.utime(path)
+        return path
+
+    _logger.info("Transcode %s into %s", src_path, path)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = temp_path(path)
+    transcode(src_path, tmp_path, create_options)
+    commit(tmp_path, path)
+    prune(cache_dir, max_size, keep=[path])
+    return path
+
+
+def prune(cache_dir, max_size=DEFAULT_MAX_SIZE, keep=[]):
+    """Remove least recently used files until the cache fits in *max_size*"""
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.startswith('.') or path in keep:
+            continue
+        st = os.stat(path)
+        entries.append((st.st_mtime, path, st.st_size))
+    total = sum(size for _, _, size in entries) + sum(
+        os.path.getsize(path) for path in keep)
+    for _, path, size in sorted(entries):
+        if total <= max_size:
+            break
+        _logger.info("Remove %s from transcode cache", path)
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
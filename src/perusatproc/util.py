@@ -1,23 +1,128 @@
 # -*- coding: utf-8 -*-
 
+import collections
 import logging
 import os
+import re
 import subprocess
 import sys
 
+from perusatproc import gdal_config
+
 __author__ = "Damián Silvani"
 __copyright__ = "Dymaxion Labs"
 __license__ = "mit"
 
 _logger = logging.getLogger(__name__)
 
+# OTB progress bars look like "Writing out.tif...: 42% [********   ]". Other
+# lines with percentages (e.g. warnings) are logged.
+OTB_PROGRESS_RE = re.compile(rb':\s*(\d{1,3})%\s*\[')
+OUTPUT_TAIL_LINES = 50
+
+# Exit codes of processes killed with SIGKILL (e.g. by the OOM killer), either
+# directly or as the child of a shell
+MEMORY_EXIT_CODES = (-9, 128 + 9)
+# Output of OTB, ITK and Python when an allocation fails
+MEMORY_ERROR_RE = re.compile(
+    r'bad_alloc|MemoryError|MemoryAllocationError|'
+    r'Cannot allocate memory|Out of memory|Failed to allocate', re.IGNORECASE)
+
+
+class MemoryExhaustedError(subprocess.CalledProcessError):
+    """A command failed because it ran out of memory"""
+
 
-def run_command(cmd):
+def is_memory_error(exc):
+    """Return whether *exc* was raised because memory ran out"""
+    return isinstance(exc, (MemoryError, MemoryExhaustedError))
+
+
+def run_command(cmd, stage=None):
     _logger.info(cmd)
-    subprocess.run(cmd, shell=True, check=True)
+    subprocess.run(cmd,
+                   shell=True,
+                   check=True,
+                   env=gdal_config.subprocess_env(stage))
+
+
+def otb_output_path(path, create_options=None, box=None):
+    # GDAL creation options are passed to OTB writers as extended filenames.
+    # If box (x, y, width, height) is set, only that region of the output
+    # image is computed and written.
+    opts = ['gdal:co:{}'.format(opt) for opt in create_options or []]
+    if box:
+        opts.append('box={}:{}:{}:{}'.format(*box))
+    if not opts:
+        return path
+    return '{}?&{}'.format(path, '&'.join(opts))
 
 
-def run_otb_command(cmd, cwd=None):
+def _run_with_progress(cmd, cwd=None, progress=None, env=None):
+    # Read output in chunks and split on both newlines and carriage returns,
+    # as progress bars are redrawn in place.
+    tail = collections.deque(maxlen=OUTPUT_TAIL_LINES)
+    proc = subprocess.Popen(cmd,
+                            shell=True,
+                            cwd=cwd,
+                            env=env,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    buf = b''
+    for chunk in iter(lambda: proc.stdout.read1(4096), b''):
+        buf += chunk
+        *lines, buf = re.split(rb'[\r\n]', buf)
+        for line in lines:
+            _handle_output_line(line, tail, progress)
+    _handle_output_line(buf, tail, progress)
+    returncode = proc.wait()
+    if returncode != 0:
+        output = '\n'.join(tail)
+        error = subprocess.CalledProcessError
+        if returncode in MEMORY_EXIT_CODES or MEMORY_ERROR_RE.search(output):
+            error = MemoryExhaustedError
+        raise error(returncode, cmd, output=output)
+
+
+def _handle_output_line(line, tail, progress):
+    line = line.strip()
+    if not line:
+        return
+    match = None
+    for match in OTB_PROGRESS_RE.finditer(line):
+        pass
+    if match:
+        if progress:
+            progress(int(match.group(1)) / 100)
+    else:
+        text = line.decode(errors='replace')
+        tail.append(text)
+        _logger.info(text)
+
+
+def run_otb_command(cmd, cwd=None, progress=None, stage=None, pixels=None):
+    """Run an OTB command line application
+
+    If the application runs out of memory, it is run again with half the RAM
+    budget (``OTB_MAX_RAM_HINT``), down to the minimum budget, and the
+    budget that worked is remembered for this stage and raster size (see
+    :mod:`perusatproc.otb_ram`).
+
+    Args:
+      cmd (str): command line
+      cwd (str): working directory
+      progress (callable): optional function called with the progress of
+        the application (a fraction between 0 and 1), parsed from its output
+      stage (str): name of the stage, whose GDAL options are set in the
+        environment of the command (see :mod:`perusatproc.gdal_config`)
+      pixels (int): number of pixels of the raster processed, to remember
+        the RAM budget by raster size
+
+    Raises:
+      MemoryExhaustedError: if it runs out of memory with the minimum budget
+    """
+    from perusatproc import otb_ram
+
     _logger.info("Run command: %s", cmd)
     otb_profile_path = os.getenv("OTB_PROFILE_PATH")
     if otb_profile_path:
@@ -27,4 +132,23 @@ def run_otb_command(cmd, cwd=None):
         else:
             # On Linux/OSX, profile path must be sourced, not executed
             cmd = f"/bin/bash -c 'source {otb_profile_path}; {cmd}'"
-    subprocess.run(cmd, shell=True, check=True, cwd=cwd)
+
+    ram = otb_ram.initial_ram(stage, pixels)
+    retried = False
+    while True:
+        env = gdal_config.subprocess_env(stage)
+        env['OTB_MAX_RAM_HINT'] = str(ram)
+        try:
+            _run_with_progress(cmd, cwd=cwd, progress=progress, env=env)
+            break
+        except MemoryExhaustedError:
+            smaller = otb_ram.next_ram(ram)
+            if smaller is None:
+                raise
+            _logger.warning(
+                "Command ran out of memory with %d MB of OTB RAM, "
+                "retry with %d MB", ram, smaller)
+            ram = smaller
+            retried = True
+    if retried and stage:
+        otb_ram.remember(stage, pixels, ram)
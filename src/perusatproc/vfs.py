@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal virtual filesystem over local paths, archives and S3 storage.
+
+Paths inside ZIP and TAR archives are expressed as GDAL virtual paths
+(``/vsizip/path/to/archive.zip/member`` or ``/vsitar/...``), so that rasters
+can be passed as is to GDAL and OTB, which read them in place. Globbing,
+listing and reading small files (e.g. metadata XML) inside archives is done
+with :mod:`zipfile` and :mod:`tarfile`, without extracting the archive.
+
+Objects in S3-compatible storage (``s3://bucket/key``) are handled the same
+way, as ``/vsis3/`` paths (see :mod:`perusatproc.s3`). Archives stored on S3
+are read with ranged requests, e.g. ``/vsizip//vsis3/bucket/product.zip``.
+
+"""
+
+import fnmatch
+import functools
+import glob as glob_
+import gzip
+import io
+import os
+import re
+import tarfile
+import zipfile
+from collections import namedtuple
+
+from perusatproc import s3
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+ZIP = 'zip'
+TAR = 'tar'
+
+VSI_PREFIXES = {ZIP: '/vsizip/', TAR: '/vsitar/'}
+
+MAGIC_RE = re.compile(r'[*?[]')
+
+# Members of compressed TAR archives up to this size (e.g. metadata files)
+# are kept in memory when the archive is indexed, as reading a member later
+# means decompressing the archive from its start
+CACHED_MEMBER_SIZE = 2**20
+
+ArchiveIndex = namedtuple('ArchiveIndex',
+                          ['members', 'offsets', 'contents', 'checksums'])
+ArchiveIndex.__doc__ = """Index of an archive, read once
+
+*members* maps member paths to sizes, including implicit directories (with
+size None). For TAR archives, *offsets* maps files to the offset of their
+data in the (uncompressed) archive, and *contents* holds small files of
+compressed archives. *checksums* maps compressed files of ZIP archives to
+their CRC-32.
+"""
+
+ARCHIVE_EXTENSIONS = [
+    ('.zip', ZIP),
+    ('.tar', TAR),
+    ('.tar.gz', TAR),
+    ('.tgz', TAR),
+]
+
+
+def archive_kind(path):
+    lower = path.lower()
+    for ext, kind in ARCHIVE_EXTENSIONS:
+        if lower.endswith(ext):
+            return kind
+    return None
+
+
+def to_gdal_path(path):
+    """Return a path that GDAL can open (e.g. ``/vsis3/`` for S3 URIs)
+
+    Paths inside archives stored on S3, like
+    ``s3://bucket/product.zip/PRODUCT/DIM_P.XML``, are prefixed with the
+    virtual filesystem of the archive (``/vsizip//vsis3/...``).
+    """
+    if not s3.is_s3(path):
+        return path
+    path = s3.to_vsi(path)
+    # Keys of archives are followed by a member path
+    parts = path[len(s3.VSI_PREFIX):].split('/')
+    for i in range(1, len(parts) - 1):
+        kind = archive_kind(parts[i])
+        if kind:
+            return VSI_PREFIXES[kind] + path
+    return path
+
+
+def _isfile(path):
+    if s3.is_s3(path):
+        return s3.exists(path)
+    return os.path.isfile(path)
+
+
+def _stat(path):
+    if s3.is_s3(path):
+        return s3.stat(path)
+    st = os.stat(path)
+    return st.st_mtime, st.st_size
+
+
+def _open(path):
+    if s3.is_s3(path):
+        return s3.open(path)
+    return io.open(path, 'rb')
+
+
+def is_archive(path):
+    return archive_kind(path) is not None and _isfile(to_gdal_path(path))
+
+
+def strip_archive_extension(path):
+    lower = path.lower()
+    for ext, _ in sorted(ARCHIVE_EXTENSIONS, key=lambda e: -len(e[0])):
+        if lower.endswith(ext):
+            return path[:-len(ext)]
+    return path
+
+
+def archive_path(path):
+    """Return the GDAL virtual path to the root of an archive"""
+    if s3.is_s3(path):
+        return VSI_PREFIXES[archive_kind(path)] + s3.to_vsi(path)
+    return VSI_PREFIXES[archive_kind(path)] + os.path.abspath(path)
+
+
+def split_path(path):
+    """Split a GDAL archive path into (kind, archive path, member path)
+
+    Returns None if *path* is not a path inside an archive.
+    """
+    for kind, prefix in VSI_PREFIXES.items():
+        if path.startswith(prefix):
+            rest = path[len(prefix):]
+            parts = rest.split('/')
+            for i in range(1, len(parts) + 1):
+                archive = '/'.join(parts[:i])
+                if archive and archive_kind(archive) and _isfile(archive):
+                    return kind, archive, '/'.join(p for p in parts[i:] if p)
+            raise FileNotFoundError('No archive found in path {}'.format(path))
+    return None
+
+
+def _compressed_tar(archive):
+    return archive.lower().endswith(('.tar.gz', '.tgz'))
+
+
+@functools.lru_cache(maxsize=16)
+def _archive_index(kind, archive, mtime):
+    """Return the :class:`ArchiveIndex` of an archive"""
+    members, offsets, contents, checksums = {}, {}, {}, {}
+    with _open(archive) as f:
+        if kind == ZIP:
+            with zipfile.ZipFile(f) as zf:
+                for info in zf.infolist():
+                    name = info.filename.rstrip('/')
+                    members[name] = None if info.is_dir() else info.file_size
+                    if info.compress_type != zipfile.ZIP_STORED:
+                        checksums[name] = info.CRC
+        else:
+            compressed = _compressed_tar(archive)
+            with tarfile.open(fileobj=f) as tf:
+                for info in tf:
+                    name = os.path.normpath(info.name).lstrip('/')
+                    members[name] = None if info.isdir() else info.size
+                    if not info.isfile():
+                        continue
+                    offsets[name] = info.offset_data
+                    if compressed and info.size <= CACHED_MEMBER_SIZE:
+                        contents[name] = tf.extractfile(info).read()
+    return ArchiveIndex(_with_parents(members), offsets, contents,
+                        checksums)
+
+
+def _with_parents(members):
+    for name in list(members):
+        parts = name.split('/')
+        for i in range(1, len(parts)):
+            members.setdefault('/'.join(parts[:i]), None)
+    return members
+
+
+def _index(kind, archive):
+    return _archive_index(kind, archive, _stat(archive)[0])
+
+
+def _members(kind, archive):
+    return _index(kind, archive).members
+
+
+def _read_tar(archive, offset, length):
+    # Plain TAR archives are read in place (with ranged requests on S3).
+    # Compressed ones must be decompressed up to offset.
+    with _open(archive) as f:
+        if _compressed_tar(archive):
+            with gzip.GzipFile(fileobj=f) as gz:
+                gz.seek(offset)
+                return gz.read(length)
+        f.seek(offset)
+        return f.read(length)
+
+
+def _s3_members(bucket, prefix):
+    """Return a dict of key -> size of objects whose key starts with
+    *prefix*, including implicit directories"""
+    return _with_parents(
+        dict(s3.list_objects('{}{}/{}'.format(s3.VSI_PREFIX, bucket,
+                                              prefix))))
+
+
+def _resolve(path, static=None):
+    """Return (root, member path, members) of a path inside an archive or on
+    S3, or None for local paths
+
+    On S3, only objects under *static* (by default, the member path itself)
+    are listed.
+    """
+    split = split_path(path)
+    if split:
+        kind, archive, member = split
+        return VSI_PREFIXES[kind] + archive, member, _members(kind, archive)
+    if s3.is_s3(path):
+        bucket, key = s3.split(path)
+        member = key.strip('/')
+        static = member if static is None else static
+        return (s3.VSI_PREFIX + bucket, member,
+                _s3_members(bucket, static + '/' if static else ''))
+    return None
+
+
+def archive_files(path):
+    """Return GDAL virtual paths to all files inside an archive"""
+    kind = archive_kind(path)
+    path = to_gdal_path(path) if s3.is_s3(path) else os.path.abspath(path)
+    return sorted('{}{}/{}'.format(VSI_PREFIXES[kind], path, name)
+                  for name, size in _members(kind, path).items()
+                  if size is not None)
+
+
+def glob(pattern):
+    pattern = to_gdal_path(pattern)
+    static = None
+    if s3.is_s3(pattern):
+        # List only objects under the part of the pattern without wildcards
+        parts = s3.split(pattern)[1].strip('/').split('/')
+        n = next((i for i, p in enumerate(parts) if MAGIC_RE.search(p)),
+                 len(parts))
+        static = '/'.join(parts[:n])
+    resolved = _resolve(pattern, static)
+    if not resolved:
+        return glob_.glob(pattern)
+    root, member_pattern, members = resolved
+    parts = member_pattern.split('/')
+    return sorted('{}/{}'.format(root, name) for name in members
+                  if len(name.split('/')) == len(parts) and all(
+                      fnmatch.fnmatchcase(n, p)
+                      for n, p in zip(name.split('/'), parts)))
+
+
+def listdir(path):
+    resolved = _resolve(to_gdal_path(path))
+    if not resolved:
+        return os.listdir(path)
+    _, member, members = resolved
+    depth = len(member.split('/')) if member else 0
+    prefix = member + '/' if member else ''
+    return sorted(
+        name.split('/')[-1] for name in members
+        if name.startswith(prefix) and len(name.split('/')) == depth + 1)
+
+
+def isdir(path):
+    resolved = _resolve(to_gdal_path(path))
+    if not resolved:
+        return os.path.isdir(path)
+    _, member, members = resolved
+    return not member or (member in members and members[member] is None)
+
+
+def cache_key(path):
+    """Return a (mtime, size) tuple that changes when the file changes"""
+    path = to_gdal_path(path)
+    split = split_path(path)
+    if not split:
+        return _stat(path)
+    kind, archive, member = split
+    return _stat(archive)[0], _members(kind, archive)[member]
+
+
+def open(path):
+    """Open a file for reading in binary mode
+
+    Files inside archives are read fully in memory, so this is only meant
+    for small files like metadata. Objects on S3 are read with ranged
+    requests.
+    """
+    path = to_gdal_path(path)
+    split = split_path(path)
+    if not split:
+        return _open(path)
+    kind, archive, member = split
+    if kind == ZIP:
+        with _open(archive) as f, zipfile.ZipFile(f) as zf:
+            return io.BytesIO(zf.read(member))
+    index = _index(kind, archive)
+    if member in index.contents:
+        return io.BytesIO(index.contents[member])
+    if member not in index.offsets:
+        raise FileNotFoundError(path)
+    return io.BytesIO(
+        _read_tar(archive, index.offsets[member], index.members[member]))
+
+
+def compressed_key(path):
+    """Return a key of a file inside a compressed archive, or None if the
+    file can be read in place
+
+    The key is made of the CRC-32 and size of members of ZIP archives, and
+    of the archive (mtime, size) and the member path and size in compressed
+    TAR archives, so it can be computed without decompressing the file.
+    """
+    path = to_gdal_path(path)
+    split = split_path(path)
+    if not split:
+        return None
+    kind, archive, member = split
+    index = _index(kind, archive)
+    if member in index.checksums:
+        return index.checksums[member], index.members[member]
+    if kind == TAR and _compressed_tar(archive):
+        return _stat(archive) + (member, index.members[member])
+    return None
+
+
+def read_range(path, offset, length):
+    """Read up to *length* bytes at *offset* of a file, without reading the
+    rest of it
+
+    This holds for local files, objects on S3 and members of plain TAR and
+    stored (uncompressed) ZIP members. Compressed members are decompressed
+    from their start up to *offset*, except small files of compressed TAR
+    archives, which are kept in memory (see :func:`compressed_key` to
+    identify such files without reading them).
+    """
+    path = to_gdal_path(path)
+    split = split_path(path)
+    if not split:
+        with _open(path) as f:
+            f.seek(offset)
+            return f.read(length)
+    kind, archive, member = split
+    if kind == ZIP:
+        with _open(archive) as f, zipfile.ZipFile(f) as zf, \
+                zf.open(member) as mf:
+            mf.seek(offset)
+            return mf.read(length)
+    index = _index(kind, archive)
+    if member not in index.offsets:
+        raise FileNotFoundError(path)
+    length = max(min(length, index.members[member] - offset), 0)
+    if member in index.contents:
+        return index.contents[member][offset:offset + length]
+    return _read_tar(archive, index.offsets[member] + offset, length)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+8-bit visual RGB output, written in the same pass as the analytic image.
+
+Stretch limits of each band are estimated once from percentiles of a sample
+of windows of the multispectral image, which is much smaller than the
+pansharpened image. Then a :class:`VisualWriter` is fed each block of the
+analytic image as it is written (see
+:func:`perusatproc.checkpoint.merge_tiles`), and writes the stretched RGB
+bands as a JPEG-compressed GeoTIFF with an internal nodata mask.
+
+"""
+
+import logging
+import os
+
+from perusatproc.profiles import VISUAL, creation_options, rasterio_options
+from perusatproc.workspace import commit, temp_path
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+VISUAL_SUFFIX = '_visual.tif'
+
+# Bands shown as RGB if they cannot be read from metadata: PeruSat-1 bands
+# are stored as blue, green, red and near infrared
+DEFAULT_RGB_BANDS = (3, 2, 1)
+
+DEFAULT_PERCENTILES = (2, 98)
+
+# The pre-scan reads PRESCAN_GRID x PRESCAN_GRID windows of PRESCAN_SIZE
+# pixels, evenly spread over the image
+PRESCAN_GRID = 8
+PRESCAN_SIZE = 256
+
+
+def visual_path(path):
+    """Return path to the visual image of an analytic image"""
+    base, _ = os.path.splitext(path)
+    return base + VISUAL_SUFFIX
+
+
+def compute_stretch(path,
+                    bands=DEFAULT_RGB_BANDS,
+                    percentiles=DEFAULT_PERCENTILES,
+                    grid=PRESCAN_GRID,
+                    size=PRESCAN_SIZE):
+    """Estimate (low, high) stretch limits of each band from percentiles of
+    valid pixels, on a sample of windows of the image"""
+    import numpy as np
+    import rasterio
+    from rasterio.windows import Window
+
+    samples = []
+    with rasterio.open(path) as ds:
+        nodata = 0 if ds.nodata is None else ds.nodata
+        for i in range(grid):
+            for j in range(grid):
+                col = int((ds.width - size) * j / max(grid - 1, 1))
+                row = int((ds.height - size) * i / max(grid - 1, 1))
+                window = Window(max(col, 0), max(row, 0),
+                                min(size, ds.width), min(size, ds.height))
+                samples.append(
+                    ds.read(list(bands), window=window).reshape(
+                        len(bands), -1))
+    data = np.concatenate(samples, axis=1)
+
+    stretch = []
+    for band in data:
+        values = band[band != nodata]
+        if not values.size:
+            stretch.append((0.0, 1.0))
+            continue
+        low, high = np.percentile(values, percentiles)
+        stretch.append((float(low), float(max(high, low + 1))))
+    _logger.info("Visual stretch of %s: %s", path, stretch)
+    return stretch
+
+
+def compute_reflectance_stretch(path,
+                                metadata_path,
+                                bands=DEFAULT_RGB_BANDS,
+                                **kwargs):
+    """Estimate stretch limits of the top of atmosphere reflectance (in
+    thousandths, as written by calibration) of a raw image, from its digital
+    numbers
+
+    Calibration is linear, so percentiles of reflectance are the calibrated
+    percentiles of digital numbers. Other arguments are passed to
+    :func:`compute_stretch`.
+    """
+    import numpy as np
+
+    from perusatproc.calibration import toa_reflectance
+    from perusatproc.metadata import extract_calibration_metadata
+
+    stretch = np.array(compute_stretch(path, bands=bands, **kwargs))
+    calib = extract_calibration_metadata(metadata_path)
+    for key in ('gains', 'biases', 'solar_irradiances'):
+        calib[key] = [calib[key][b - 1] for b in bands]
+    return toa_reflectance(stretch, calib).tolist()
+
+
+class VisualWriter:
+    """Writes stretched RGB bands of blocks of an image as an 8-bit image
+
+    Pixels where all bands are nodata (or 0, if the image has no nodata
+    value) are masked out.
+    """
+
+    def __init__(self, ds, dst_path, bands, stretch, create_options=[]):
+        import rasterio
+
+        self.dst_path = dst_path
+        self.tmp_path = temp_path(dst_path)
+        self.bands = [b - 1 for b in bands]
+        self.stretch = stretch
+        self.nodata = 0 if ds.nodata is None else ds.nodata
+
+        profile = dict(driver='GTiff',
+                       width=ds.width,
+                       height=ds.height,
+                       count=3,
+                       dtype='uint8',
+                       crs=ds.crs,
+                       transform=ds.transform)
+        profile.update(rasterio_options(creation_options(VISUAL,
+                                                         create_options)))
+        self.ds = rasterio.open(self.tmp_path, 'w', **profile)
+
+    @classmethod
+    def factory(cls, dst_path, bands, stretch, create_options=[]):
+        """Return a sink for :func:`perusatproc.checkpoint.merge_tiles`"""
+        return lambda ds: cls(ds, dst_path, bands, stretch, create_options)
+
+    def update(self, data, window):
+        import numpy as np
+        import rasterio
+
+        rgb = np.empty((3, ) + data.shape[1:], dtype='uint8')
+        for i, (band, (low, high)) in enumerate(zip(self.bands,
+                                                    self.stretch)):
+            scaled = (data[band].astype('float32') - low) * (255 /
+                                                             (high - low))
+            rgb[i] = np.clip(scaled, 0, 255)
+        valid = (data != self.nodata).any(axis=0)
+        self.ds.write(rgb, window=window)
+        # Store the mask inside the image instead of a .msk sidecar
+        with rasterio.Env(GDAL_TIFF_INTERNAL_MASK=True):
+            self.ds.write_mask(valid.astype('uint8') * 255, window=window)
+
+    def close(self, ds=None):
+        self.ds.close()
+        commit(self.tmp_path, self.dst_path)
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Native writer of GDAL virtual rasters (VRT) mosaics.
+
+Equivalent to ``gdalbuildvrt`` for the mosaics built by the pipeline (images
+with the same CRS, bands and data type), but the VRT XML is generated
+directly from the size and geotransform of each input. These can be passed
+as :class:`RasterInfo` when already known, or are read from the inputs in
+parallel. No command line is built, so there is no limit on the number of
+inputs.
+
+"""
+
+import logging
+import os
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+
+from perusatproc import gdal_config
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+# Opening files is mostly I/O bound, so use more threads than CPUs
+DEFAULT_READ_JOBS = 16
+
+GDAL_DATA_TYPES = {
+    'uint8': 'Byte',
+    'int8': 'Int8',
+    'uint16': 'UInt16',
+    'int16': 'Int16',
+    'uint32': 'UInt32',
+    'int32': 'Int32',
+    'float32': 'Float32',
+    'float64': 'Float64',
+}
+
+RasterInfo = namedtuple('RasterInfo', [
+    'path', 'width', 'height', 'count', 'dtype', 'crs', 'transform', 'nodata',
+    'block_shape', 'colorinterp'
+])
+RasterInfo.__doc__ = """Size, georeference and band layout of a raster
+
+*crs* is a WKT string, *transform* an affine transform, *block_shape* a
+(rows, cols) tuple and *colorinterp* a list of GDAL color interpretation
+names (e.g. ``Gray``), one per band.
+"""
+
+
+def read_info(path):
+    """Return the :class:`RasterInfo` of a raster"""
+    import rasterio
+
+    # Options are set per thread
+    with gdal_config.env('vrt'), rasterio.open(path) as ds:
+        return RasterInfo(path=path,
+                          width=ds.width,
+                          height=ds.height,
+                          count=ds.count,
+                          dtype=ds.dtypes[0],
+                          crs=ds.crs.to_wkt() if ds.crs else None,
+                          transform=ds.transform,
+                          nodata=ds.nodata,
+                          block_shape=ds.block_shapes[0],
+                          colorinterp=[
+                              ci.name.capitalize() for ci in ds.colorinterp
+                          ])
+
+
+def read_infos(paths, jobs=DEFAULT_READ_JOBS):
+    """Return the :class:`RasterInfo` of many rasters, read in parallel"""
+    if len(paths) <= 1 or jobs == 1:
+        return [read_info(path) for path in paths]
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(read_info, paths))
+
+
+def _source_filename(path, vrt_dir):
+    # Paths are stored relative to the VRT when possible, as gdalbuildvrt
+    # does, so that a directory of results can be moved as a whole
+    if path.startswith('/vsi') or '://' in path:
+        return path, '0'
+    path = os.path.abspath(path)
+    if os.path.splitdrive(path)[0] != os.path.splitdrive(vrt_dir)[0]:
+        return path, '0'
+    return os.path.relpath(path, vrt_dir), '1'
+
+
+def _fmt(value):
+    # Round off floating point error of offsets computed from coordinates
+    value = round(float(value), 8)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def build_vrt(inputs, dst, jobs=DEFAULT_READ_JOBS, metadata=None):
+    """Write a virtual raster with a mosaic of *inputs*
+
+    The resolution of the mosaic is the average resolution of the inputs
+    (as in ``gdalbuildvrt``). Inputs that overlap are drawn in order, so the
+    last one is on top.
+
+    Args:
+      inputs (list): paths or :class:`RasterInfo` of input rasters. Paths
+        are read in parallel
+      dst (str): path to output VRT
+      jobs (int): number of threads used to read inputs
+      metadata (dict): optional metadata items of the VRT, as a dict of
+        items by domain (e.g. ``{'RPC': {...}}``)
+
+    Returns:
+      str: path to output VRT
+    """
+    if not inputs:
+        raise RuntimeError("No inputs to build virtual raster {}".format(dst))
+    paths = [i for i in inputs if not isinstance(i, RasterInfo)]
+    read = iter(read_infos(paths, jobs=jobs))
+    infos = [i if isinstance(i, RasterInfo) else next(read) for i in inputs]
+
+    first = infos[0]
+    for info in infos[1:]:
+        if info.count != first.count or info.dtype != first.dtype:
+            raise RuntimeError(
+                "{} has {} bands of {}, expected {} bands of {}".format(
+                    info.path, info.count, info.dtype, first.count,
+                    first.dtype))
+        if info.crs != first.crs:
+            raise RuntimeError("{} has a different CRS than {}".format(
+                info.path, first.path))
+
+    res_x = sum(i.transform.a for i in infos) / len(infos)
+    res_y = sum(-i.transform.e for i in infos) / len(infos)
+    bounds = [(i.transform.c, i.transform.f - i.height * -i.transform.e,
+               i.transform.c + i.width * i.transform.a, i.transform.f)
+              for i in infos]
+    min_x = min(b[0] for b in bounds)
+    min_y = min(b[1] for b in bounds)
+    max_x = max(b[2] for b in bounds)
+    max_y = max(b[3] for b in bounds)
+    width = int(round((max_x - min_x) / res_x))
+    height = int(round((max_y - min_y) / res_y))
+
+    root = ET.Element('VRTDataset',
+                      rasterXSize=str(width),
+                      rasterYSize=str(height))
+    if first.crs:
+        ET.SubElement(root, 'SRS').text = first.crs
+    ET.SubElement(root, 'GeoTransform').text = ', '.join(
+        repr(float(v)) for v in (min_x, res_x, 0, max_y, 0, -res_y))
+    for domain, items in (metadata or {}).items():
+        md_el = ET.SubElement(root, 'Metadata', domain=domain)
+        for key, value in items.items():
+            ET.SubElement(md_el, 'MDI', key=key).text = str(value)
+
+    vrt_dir = os.path.dirname(os.path.abspath(dst))
+    data_type = GDAL_DATA_TYPES[first.dtype]
+    for band in range(1, first.count + 1):
+        band_el = ET.SubElement(root,
+                                'VRTRasterBand',
+                                dataType=data_type,
+                                band=str(band))
+        if first.nodata is not None:
+            ET.SubElement(band_el, 'NoDataValue').text = _fmt(first.nodata)
+        if first.colorinterp:
+            ET.SubElement(band_el, 'ColorInterp').text = \
+                first.colorinterp[band - 1]
+        for info, (x0, _, _, y1) in zip(infos, bounds):
+            # Sources with nodata are complex sources, so that nodata pixels
+            # don't hide pixels of sources below
+            source = ET.SubElement(
+                band_el,
+                'ComplexSource' if info.nodata is not None else 'SimpleSource')
+            filename, relative = _source_filename(info.path, vrt_dir)
+            ET.SubElement(source, 'SourceFilename',
+                          relativeToVRT=relative).text = filename
+            ET.SubElement(source, 'SourceBand').text = str(band)
+            ET.SubElement(source,
+                          'SourceProperties',
+                          RasterXSize=str(info.width),
+                          RasterYSize=str(info.height),
+                          DataType=data_type,
+                          BlockXSize=str(info.block_shape[1]),
+                          BlockYSize=str(info.block_shape[0]))
+            ET.SubElement(source,
+                          'SrcRect',
+                          xOff='0',
+                          yOff='0',
+                          xSize=str(info.width),
+                          ySize=str(info.height))
+            ET.SubElement(source,
+                          'DstRect',
+                          xOff=_fmt((x0 - min_x) / res_x),
+                          yOff=_fmt((max_y - y1) / res_y),
+                          xSize=_fmt(info.width * info.transform.a / res_x),
+                          ySize=_fmt(info.height * -info.transform.e /
+                                     res_y))
+            if info.nodata is not None:
+                ET.SubElement(source, 'NODATA').text = _fmt(info.nodata)
+
+    _logger.info("Write virtual raster %s of %d inputs", dst, len(infos))
+    ET.ElementTree(root).write(dst, encoding='utf-8')
+    return dst
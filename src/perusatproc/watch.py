@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Detection of complete volumes of products delivered into a drop folder.
+
+Products (directories or ZIP/TAR archives) are expected directly inside the
+drop folder. A volume is ready when the DIMAP and RPC metadata files and the
+raster file of both its MS and P images are present, the DIMAP files can be
+parsed, and none of those files changed in size or modification time for a
+settle period. Volumes are reported as soon as they are ready, so that they
+can be processed while the rest of the product is still being delivered.
+
+The size and modification time of the files of each processed volume are
+recorded next to its output, so that a volume that is delivered again with
+different files is processed again, even after a restart.
+
+The drop folder is rescanned periodically. If the optional ``inotify_simple``
+package is installed (Linux only), file system events wake up the watcher
+between scans, so that new files are noticed without delay.
+
+"""
+
+import json
+import logging
+import os
+import tarfile
+import time
+import zipfile
+from xml.parsers.expat import ExpatError
+
+from perusatproc import product, vfs
+from perusatproc.metadata import extract_raster_filepath
+from perusatproc.workspace import commit, temp_path
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+# Seconds between scans of the drop folder
+DEFAULT_INTERVAL = 30
+
+# Seconds files of a volume must stay unchanged to consider it complete
+DEFAULT_SETTLE = 60
+
+# Suffix of the file next to the output of a volume, where the snapshot of
+# its source files is recorded
+SOURCE_SUFFIX = '.source.json'
+
+# Errors raised while a volume or archive is only partially delivered
+INCOMPLETE_ERRORS = (OSError, RuntimeError, KeyError, TypeError, ExpatError,
+                     zipfile.BadZipFile, tarfile.TarError)
+
+
+def volume_files(volume):
+    """Return paths to the files needed to process a volume
+
+    Raises:
+      RuntimeError, OSError, ...: if a file is missing or a metadata file
+        cannot be parsed (see :data:`INCOMPLETE_ERRORS`)
+    """
+    paths = []
+    for kind in (product.MS, product.P):
+        image_dir = product.find_image_dir(volume, kind)
+        dim_xml, rpc_xml = product.find_metadata_files(image_dir)
+        paths.extend([
+            dim_xml, rpc_xml,
+            os.path.join(image_dir, extract_raster_filepath(dim_xml))
+        ])
+    return paths
+
+
+def snapshot(paths):
+    """Return the size and modification time of files, or None if any of
+    them is missing"""
+    try:
+        return tuple(vfs.cache_key(path) for path in paths)
+    except INCOMPLETE_ERRORS:
+        return None
+
+
+def read_source(output_path):
+    """Return the snapshot of the source files recorded for an output, or
+    None if there is none"""
+    try:
+        with open(output_path + SOURCE_SUFFIX) as f:
+            return tuple(tuple(key) for key in json.load(f))
+    except (OSError, ValueError, TypeError):
+        return None
+
+
+def write_source(output_path, state):
+    """Record the snapshot of the source files of an output"""
+    path = output_path + SOURCE_SUFFIX
+    tmp_path = temp_path(path)
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    commit(tmp_path, path)
+
+
+def needs_processing(output_path, state):
+    """Return whether a volume whose files have snapshot *state* must be
+    processed into *output_path*
+
+    It must if there is no output yet, or if it was processed from other
+    files. Outputs with no recorded snapshot (e.g. processed by
+    perusat_process) are assumed current, and *state* is recorded for them.
+    """
+    if not os.path.exists(output_path):
+        return True
+    recorded = read_source(output_path)
+    if recorded is None:
+        write_source(output_path, state)
+        return False
+    return recorded != tuple(tuple(key) for key in state)
+
+
+def _inotify():
+    try:
+        from inotify_simple import INotify
+    except ImportError:
+        return None
+    return INotify()
+
+
+class VolumeWatcher:
+    """Reports volumes of products in *src* as soon as they are complete
+
+    Args:
+      src (str): path to drop folder
+      settle (float): seconds files must stay unchanged
+      interval (float): seconds between scans
+      use_inotify (bool): wake up on file system events, if available
+    """
+
+    def __init__(self,
+                 src,
+                 settle=DEFAULT_SETTLE,
+                 interval=DEFAULT_INTERVAL,
+                 use_inotify=True):
+        self.src = src
+        self.settle = settle
+        self.interval = interval
+        # Last snapshot of pending volumes, and when it was first seen
+        self.pending = {}
+        # Snapshot of volumes already reported. A volume is reported again
+        # only if its files change (e.g. it is delivered again).
+        self.reported = {}
+
+        self.inotify = _inotify() if use_inotify else None
+        self.watched = set()
+        if use_inotify and not self.inotify:
+            _logger.info("inotify_simple is not installed, poll %s every "
+                         "%s seconds", src, interval)
+
+    def products(self):
+        """Return paths to products in the drop folder"""
+        paths = []
+        for name in sorted(os.listdir(self.src)):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.src, name)
+            if os.path.isdir(path) or vfs.is_archive(path):
+                paths.append(path)
+        return paths
+
+    def scan(self):
+        """Scan the drop folder and return (product, volume) pairs of volumes
+        that became ready since the last scan"""
+        now = time.monotonic()
+        ready = []
+        seen = set()
+        for product_path in self.products():
+            try:
+                volumes = product.find_volumes(product_path)
+            except INCOMPLETE_ERRORS as err:
+                _logger.debug("Skip %s: %s", product_path, err)
+                continue
+            for volume in volumes:
+                seen.add(volume)
+                try:
+                    state = snapshot(volume_files(volume))
+                except INCOMPLETE_ERRORS as err:
+                    _logger.debug("Volume %s is incomplete: %s", volume, err)
+                    state = None
+                if state is None or self.reported.get(volume) == state:
+                    self.pending.pop(volume, None)
+                    continue
+                prev = self.pending.get(volume)
+                if not prev or prev[0] != state:
+                    self.pending[volume] = (state, now)
+                elif now - prev[1] >= self.settle:
+                    del self.pending[volume]
+                    self.reported[volume] = state
+                    _logger.info("Volume %s is ready", volume)
+                    ready.append((product_path, volume))
+
+        for volume in set(self.pending) - seen:
+            del self.pending[volume]
+        if self.inotify:
+            self._add_watches()
+        return ready
+
+    def timeout(self):
+        """Return seconds until the next scan is due"""
+        # Pending volumes are checked again as soon as they may have settled
+        if self.pending:
+            return min(self.interval, self.settle)
+        return self.interval
+
+    def wait(self):
+        """Sleep until the next scan is due, or until files change"""
+        timeout = self.timeout()
+        if not self.inotify:
+            time.sleep(timeout)
+            return
+        if self.inotify.read(timeout=int(timeout * 1000)):
+            # Let a burst of events (e.g. an extraction) finish
+            time.sleep(1)
+            self.inotify.read(timeout=0)
+
+    def _add_watches(self):
+        from inotify_simple import flags
+
+        mask = flags.CREATE | flags.CLOSE_WRITE | flags.MOVED_TO | \
+            flags.DELETE
+        for dirpath, dirnames, _ in os.walk(self.src):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            if dirpath in self.watched:
+                continue
+            try:
+                self.inotify.add_watch(dirpath, mask)
+                self.watched.add(dirpath)
+            except OSError as err:
+                _logger.warning("Cannot watch %s: %s", dirpath, err)
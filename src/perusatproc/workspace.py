@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Per-job isolated workspaces.
+
+Each job writes its intermediate and final results inside its own uniquely
+named directory in the destination directory. Final results are then moved
+into place with an atomic rename, so that many jobs can run concurrently on
+the same destination without removing each other's files, and readers never
+see partially written outputs.
+
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+WORKSPACE_PREFIX = '.job-'
+
+
+def temp_path(path):
+    """Return a unique temporary path on the same directory as *path*
+
+    The extension is kept, so that GDAL drivers can be guessed from it.
+    """
+    dirname, basename = os.path.split(path)
+    return os.path.join(dirname, '.tmp-{}-{}'.format(uuid.uuid4().hex[:8],
+                                                     basename))
+
+
+def commit(src_path, dst_path):
+    """Atomically move *src_path* into *dst_path*, replacing it if it exists
+
+    Both paths must be on the same filesystem.
+    """
+    dirname = os.path.dirname(dst_path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    os.replace(src_path, dst_path)
+    return dst_path
+
+
+class Workspace:
+    """Unique working directory for a job, inside *dst*
+
+    When used as a context manager, the workspace is removed when the block
+    finishes successfully, and kept for inspection if an exception is raised.
+
+    If *name* is set, the workspace is not unique but named after it, and an
+    existing workspace with the same name (e.g. of an interrupted job) is
+    reused, so that the job can resume from its intermediate results.
+    """
+
+    def __init__(self, dst, prefix=WORKSPACE_PREFIX, name=None):
+        os.makedirs(dst, exist_ok=True)
+        self.dst = dst
+        if name:
+            self.path = os.path.join(dst, prefix + name)
+            if os.path.isdir(self.path):
+                _logger.info("Reuse workspace %s", self.path)
+                return
+            os.makedirs(self.path)
+        else:
+            self.path = tempfile.mkdtemp(prefix=prefix, dir=dst)
+        _logger.info("Created workspace %s", self.path)
+
+    def join(self, *parts):
+        """Return a path inside the workspace, creating parent directories"""
+        path = os.path.join(self.path, *parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def subdir(self, *parts):
+        """Create a directory inside the workspace and return its path"""
+        path = os.path.join(self.path, *parts)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def commit(self, src_path, dst_path=None):
+        """Move a result from the workspace into the destination
+
+        If *dst_path* is not set, the file is moved to the destination
+        directory with the same name. If *src_path* is a directory, each file
+        is moved to the same relative path inside *dst_path*.
+        """
+        if dst_path is None:
+            dst_path = os.path.join(self.dst, os.path.basename(src_path))
+        if os.path.isdir(src_path):
+            for dirpath, _, filenames in os.walk(src_path):
+                rel_dir = os.path.relpath(dirpath, src_path)
+                for filename in filenames:
+                    commit(os.path.join(dirpath, filename),
+                           os.path.normpath(
+                               os.path.join(dst_path, rel_dir, filename)))
+            return dst_path
+        return commit(src_path, dst_path)
+
+    def cleanup(self):
+        _logger.info("Clean up workspace %s", self.path)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.cleanup()
+        else:
+            _logger.warning("Keeping workspace %s for inspection", self.path)
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Chunked Zarr output of the pansharpened mosaic.
+
+The mosaic (usually the product virtual raster) is written into a Zarr group
+with a ``(band, y, x)`` array, compressed per chunk, plus ``x``/``y``
+coordinates and a ``spatial_ref`` variable with the CRS and geotransform
+(following the CF/GDAL conventions used by xarray and rioxarray).
+
+Windows are aligned to the chunk grid, so that parallel workers never write
+the same chunk and need no locking.
+
+"""
+
+import logging
+import os
+
+from perusatproc import gdal_config
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 1024
+DEFAULT_COMPRESSOR = 'zstd'
+DEFAULT_COMPRESSION_LEVEL = 3
+ARRAY_NAME = 'pansharpened'
+
+# Rows of chunks written by each task
+CHUNK_ROWS_PER_TASK = 1
+
+
+def _compressor(name=DEFAULT_COMPRESSOR, level=DEFAULT_COMPRESSION_LEVEL):
+    from numcodecs import Blosc
+
+    return Blosc(cname=name, clevel=level, shuffle=Blosc.BITSHUFFLE)
+
+
+def create_store(dst,
+                 *,
+                 count,
+                 height,
+                 width,
+                 dtype,
+                 crs,
+                 transform,
+                 nodata=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE,
+                 compressor=DEFAULT_COMPRESSOR):
+    """Create an empty Zarr group with a georeferenced ``(band, y, x)`` array"""
+    import numpy as np
+    import zarr
+
+    root = zarr.open_group(dst, mode='w')
+    arr = root.create_dataset(ARRAY_NAME,
+                              shape=(count, height, width),
+                              chunks=(count, chunk_size, chunk_size),
+                              dtype=dtype,
+                              compressor=_compressor(compressor),
+                              fill_value=nodata if nodata is not None else 0,
+                              write_empty_chunks=False)
+    arr.attrs.update(_ARRAY_DIMENSIONS=['band', 'y', 'x'],
+                     grid_mapping='spatial_ref')
+
+    # Pixel center coordinates
+    xs = transform.c + transform.a * (np.arange(width) + 0.5)
+    ys = transform.f + transform.e * (np.arange(height) + 0.5)
+    for name, values in (('x', xs), ('y', ys)):
+        coord = root.create_dataset(name, data=values, chunks=len(values))
+        coord.attrs['_ARRAY_DIMENSIONS'] = [name]
+    band = root.create_dataset('band', data=np.arange(1, count + 1))
+    band.attrs['_ARRAY_DIMENSIONS'] = ['band']
+
+    spatial_ref = root.create_dataset('spatial_ref', shape=(), dtype='i4')
+    wkt = crs.to_wkt() if crs else ''
+    spatial_ref.attrs.update(_ARRAY_DIMENSIONS=[],
+                             crs_wkt=wkt,
+                             spatial_ref=wkt,
+                             GeoTransform=' '.join(
+                                 str(v) for v in transform.to_gdal()))
+
+    zarr.consolidate_metadata(dst)
+    return arr
+
+
+def chunk_windows(height, width, chunk_size=DEFAULT_CHUNK_SIZE,
+                  rows=CHUNK_ROWS_PER_TASK):
+    """Yield (row_off, col_off, row_count, col_count) windows aligned to the
+    chunk grid, each covering *rows* rows of chunks"""
+    step = chunk_size * rows
+    for row_off in range(0, height, step):
+        yield (row_off, 0, min(step, height - row_off), width)
+
+
+def write_window(src_path, dst, window, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Copy a chunk-aligned window of *src_path* into the Zarr store"""
+    import rasterio
+    import zarr
+    from rasterio.windows import Window
+
+    arr = zarr.open_array(os.path.join(dst, ARRAY_NAME), mode='r+')
+    row_off, col_off, height, width = window
+    with gdal_config.env('zarr'), rasterio.open(src_path) as src:
+        for col in range(col_off, col_off + width, chunk_size):
+            w = Window(col, row_off, min(chunk_size, col_off + width - col),
+                       height)
+            data = src.read(window=w)
+            if src.nodata is not None and (data == src.nodata).all():
+                # Chunks with no data are left unwritten
+                continue
+            arr[:, row_off:row_off + height, col:col + w.width] = data
+    return window
+
+
+def write_zarr(src_path,
+               dst,
+               chunk_size=DEFAULT_CHUNK_SIZE,
+               compressor=DEFAULT_COMPRESSOR,
+               jobs=None,
+               progress=None):
+    """Write a raster (e.g. the product virtual raster) as a Zarr store
+
+    Args:
+      src_path (str): path to input raster
+      dst (str): path to output Zarr store (a directory)
+      chunk_size (int): size of spatial chunks (all bands go in each chunk)
+      compressor (str): Blosc compressor name
+      jobs (int): number of processes writing chunks in parallel
+      progress (callable): optional function called with the fraction of
+        rows written
+
+    Returns:
+      str: path to the Zarr store
+    """
+    import rasterio
+
+    with rasterio.open(src_path) as src:
+        profile = dict(count=src.count,
+                       height=src.height,
+                       width=src.width,
+                       dtype=src.dtypes[0],
+                       crs=src.crs,
+                       transform=src.transform,
+                       nodata=src.nodata)
+    _logger.info("Write %s as Zarr store %s (%dx%dx%d, chunks of %d)",
+                 src_path, dst, profile['count'], profile['height'],
+                 profile['width'], chunk_size)
+    create_store(dst, chunk_size=chunk_size, compressor=compressor, **profile)
+
+    windows = list(chunk_windows(profile['height'], profile['width'],
+                                 chunk_size))
+    done = 0
+
+    def report(window):
+        nonlocal done
+        done += window[2]
+        if progress:
+            progress(done / profile['height'])
+
+    if jobs == 1 or len(windows) <= 1:
+        for window in windows:
+            report(write_window(src_path, dst, window, chunk_size))
+        return dst
+
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(write_window, src_path, dst, window, chunk_size)
+            for window in windows
+        ]
+        for future in as_completed(futures):
+            report(future.result())
+    return dst
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from perusatproc import calibration
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+np = pytest.importorskip('numpy')
+
+# Parameters of a typical multispectral scene
+CALIB = dict(gains=[9.2, 8.9, 9.6, 11.3],
+             biases=[0.0, 0.0, 0.0, 0.0],
+             solar_irradiances=[1982.0, 1826.0, 1540.0, 1094.0],
+             year=2020,
+             month=3,
+             day=14,
+             sun_elev=63.2)
+
+
+def calibrate_numpy(data, calib=CALIB):
+    refl = np.rint(calibration.toa_reflectance(data, calib))
+    out = np.clip(refl, 0, calibration.MAX_REFLECTANCE).astype('uint16')
+    out[data == 0] = 0
+    return out
+
+
+def test_lut_matches_reflectance():
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 4096, size=(4, 64, 64), dtype='uint16')
+    data[:, 0, :] = 0
+    lut = calibration.calibration_lut(CALIB)
+    assert lut.shape == (4, calibration.LUT_SIZE)
+    assert lut.dtype == np.uint16
+
+    out = calibration.apply_lut(lut, data)
+    assert (out == calibrate_numpy(data)).all()
+    assert (out[:, 0, :] == 0).all()
+
+    buf = np.empty_like(data)
+    assert calibration.apply_lut(lut, data, out=buf) is buf
+    assert (buf == out).all()
+
+
+def test_lut_is_clamped_and_keeps_nodata():
+    lut = calibration.calibration_lut(CALIB)
+    assert (lut[:, 0] == 0).all()
+    assert lut.max() == calibration.MAX_REFLECTANCE
+    # Reflectance grows with digital numbers until it is clamped
+    assert (np.diff(lut[:, 1:].astype('int32')) >= 0).all()
+    dn = np.full((4, 1), calibration.LUT_SIZE - 1, dtype='uint16')
+    assert (calibration.apply_lut(lut, dn) == calibration.MAX_REFLECTANCE).all()
+
+
+@pytest.fixture
+def scene(tmp_path, monkeypatch):
+    rasterio = pytest.importorskip('rasterio')
+    from rasterio.transform import from_origin
+
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 4096, size=(4, 300, 200), dtype='uint16')
+    path = str(tmp_path / 'IMG_MS.TIF')
+    with rasterio.open(path,
+                       'w',
+                       driver='GTiff',
+                       width=200,
+                       height=300,
+                       count=4,
+                       dtype='uint16',
+                       crs='EPSG:32718',
+                       transform=from_origin(300000, 8600000, 2, 2)) as dst:
+        dst.write(data)
+    # Metadata is not parsed: the table is computed from CALIB
+    monkeypatch.setattr(calibration, '_scene_lut',
+                        lambda _: calibration.calibration_lut(CALIB))
+    return path, data
+
+
+def test_calibrate_lut(scene, tmp_path):
+    import rasterio
+
+    src_path, data = scene
+    dst_path = str(tmp_path / 'calib.tif')
+    progress = []
+    calibration.calibrate(src_path=src_path,
+                          dst_path=dst_path,
+                          metadata_path='DIM_MS.XML',
+                          create_options=['TILED=YES', 'BLOCKXSIZE=128',
+                                          'BLOCKYSIZE=128'],
+                          progress=progress.append,
+                          engine=calibration.LUT)
+    with rasterio.open(dst_path) as src:
+        assert src.crs.to_epsg() == 32718
+        assert (src.read() == calibrate_numpy(data)).all()
+    assert progress[-1] == 1
+
+
+def test_calibrate_lut_box(scene, tmp_path):
+    import rasterio
+
+    src_path, data = scene
+    dst_path = str(tmp_path / 'calib.tif')
+    calibration.calibrate_lut(src_path=src_path,
+                              dst_path=dst_path,
+                              metadata_path='DIM_MS.XML',
+                              box=(50, 100, 120, 80))
+    with rasterio.open(dst_path) as src:
+        assert (src.width, src.height) == (120, 80)
+        assert src.transform.c == 300000 + 50 * 2
+        assert src.transform.f == 8600000 - 100 * 2
+        assert (src.read() == calibrate_numpy(data[:, 100:180,
+                                                   50:170])).all()
+
+
+def test_calibrate_lut_checks_input(scene, tmp_path, monkeypatch):
+    import rasterio
+
+    src_path, _ = scene
+    float_path = str(tmp_path / 'float.tif')
+    with rasterio.open(float_path, 'w', driver='GTiff', width=8, height=8,
+                       count=4, dtype='float32') as dst:
+        dst.write(np.zeros((4, 8, 8), dtype='float32'))
+    with pytest.raises(RuntimeError, match='unsigned'):
+        calibration.calibrate_lut(src_path=float_path,
+                                  dst_path=str(tmp_path / 'out.tif'),
+                                  metadata_path='DIM_MS.XML')
+
+    monkeypatch.setattr(calibration, '_scene_lut',
+                        lambda _: calibration.calibration_lut(
+                            dict(CALIB,
+                                 gains=CALIB['gains'][:3],
+                                 biases=CALIB['biases'][:3],
+                                 solar_irradiances=CALIB[
+                                     'solar_irradiances'][:3])))
+    with pytest.raises(RuntimeError, match='bands'):
+        calibration.calibrate_lut(src_path=src_path,
+                                  dst_path=str(tmp_path / 'out.tif'),
+                                  metadata_path='DIM_MS.XML')
+
+
+def test_calibrate_rejects_unknown_engine(tmp_path):
+    with pytest.raises(ValueError):
+        calibration.calibrate(src_path='IMG.TIF',
+                              dst_path=str(tmp_path / 'out.tif'),
+                              metadata_path='DIM.XML',
+                              engine='gpu')
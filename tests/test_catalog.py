@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+import os
+import zipfile
+
+import pytest
+
+from perusatproc import catalog
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+pytest.importorskip('xmltodict')
+
+DIM_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<Dimap_Document>
+  <Dataset_Sources>
+    <Source_Identification>
+      <Strip_Source>
+        <IMAGING_DATE>2020-03-14</IMAGING_DATE>
+        <IMAGING_TIME>{time}</IMAGING_TIME>
+      </Strip_Source>
+    </Source_Identification>
+  </Dataset_Sources>
+  <Dataset_Content>
+    <Dataset_Extent>
+      <Vertex><LON>-77.1</LON><LAT>-12.0</LAT></Vertex>
+      <Vertex><LON>-77.0</LON><LAT>-12.0</LAT></Vertex>
+      <Vertex><LON>-77.0</LON><LAT>-12.1</LAT></Vertex>
+      <Vertex><LON>-77.1</LON><LAT>-12.1</LAT></Vertex>
+    </Dataset_Extent>
+  </Dataset_Content>
+  <Raster_Data>
+    <Data_Access>
+      <Data_Files>
+        <Data_File><DATA_FILE_PATH href="IMG_P.JP2"/></Data_File>
+      </Data_Files>
+    </Data_Access>
+    <Raster_Dimensions>
+      <NCOLS>1000</NCOLS>
+      <NROWS>800</NROWS>
+      <NBANDS>1</NBANDS>
+    </Raster_Dimensions>
+  </Raster_Data>
+  <Geometric_Data>
+    <Use_Area>
+      <Located_Geometric_Values>
+        <Solar_Incidences>
+          <SUN_ELEVATION>63.2</SUN_ELEVATION>
+          <SUN_AZIMUTH>80.5</SUN_AZIMUTH>
+        </Solar_Incidences>
+        <Acquisition_Angles>
+          <VIEWING_ANGLE>10.1</VIEWING_ANGLE>
+          <AZIMUTH_ANGLE>100.2</AZIMUTH_ANGLE>
+        </Acquisition_Angles>
+      </Located_Geometric_Values>
+    </Use_Area>
+  </Geometric_Data>
+  <Radiometric_Data>
+    <Radiometric_Calibration>
+      <Instrument_Calibration>
+        <Band_Measurement_List>
+          <Band_Radiance>
+            <BAND_ID>P</BAND_ID><GAIN>9.2</GAIN><BIAS>0</BIAS>
+          </Band_Radiance>
+          <Band_Solar_Irradiance>
+            <BAND_ID>P</BAND_ID><VALUE>1700</VALUE>
+          </Band_Solar_Irradiance>
+        </Band_Measurement_List>
+      </Instrument_Calibration>
+    </Radiometric_Calibration>
+  </Radiometric_Data>
+</Dimap_Document>
+"""
+
+
+def write_scene(image_dir, time='15:23:42'):
+    os.makedirs(image_dir, exist_ok=True)
+    path = os.path.join(image_dir, 'DIM_P.XML')
+    with open(path, 'w') as f:
+        f.write(DIM_XML.format(time=time))
+    with open(os.path.join(image_dir, 'RPC_P.XML'), 'w') as f:
+        f.write('<Rpc_Document/>')
+    return path
+
+
+def test_update_catalog_and_search(tmp_path):
+    root = tmp_path / 'products'
+    # Scenes with fractional seconds in IMAGING_TIME are ingested too
+    first = write_scene(str(root / 'A' / 'VOL_1'), time='15:23:42.123456')
+    second = write_scene(str(root / 'B' / 'VOL_1'))
+    db_path = str(tmp_path / 'catalog.db')
+
+    stats = catalog.update_catalog(db_path, [str(root)])
+    assert stats == dict(updated=2, unchanged=0, removed=0)
+
+    scenes = catalog.search(db_path, bbox=(-77.05, -12.05, -76.9, -11.9))
+    assert sorted(s['metadata_path'] for s in scenes) == [first, second]
+    scene = scenes[0]
+    assert scene['acquired'] == '2020-03-14T15:23:42'
+    assert scene['sun_elev'] == 63.2
+    assert (scene['sizex'], scene['sizey']) == (1000, 800)
+    assert scene['raster_path'].endswith(os.path.join('VOL_1', 'IMG_P.JP2'))
+    assert scene['rpc_path'].endswith(os.path.join('VOL_1', 'RPC_P.XML'))
+    assert scene['footprint']['coordinates'][0][0] == [-77.1, -12.0]
+
+    assert catalog.search(db_path, bbox=(-70, -10, -69, -9)) == []
+    assert len(catalog.search(db_path, start='2020-03-14',
+                              end='2020-03-14')) == 2
+    assert catalog.search(db_path, start='2020-03-15') == []
+
+    os.remove(second)
+    stats = catalog.update_catalog(db_path, [str(root)])
+    assert stats == dict(updated=0, unchanged=1, removed=1)
+
+
+def test_update_catalog_reads_archives(tmp_path):
+    root = tmp_path / 'products'
+    root.mkdir()
+    with zipfile.ZipFile(str(root / 'product.zip'), 'w') as zf:
+        zf.writestr('PRODUCT/VOL_1/DIM_P.XML',
+                    DIM_XML.format(time='15:23:42.5'))
+    db_path = str(tmp_path / 'catalog.db')
+
+    assert catalog.update_catalog(db_path, [str(root)])['updated'] == 1
+    scene, = catalog.search(db_path)
+    assert scene['metadata_path'].startswith('/vsizip/')
+    assert scene['acquired'] == '2020-03-14T15:23:42'
+    assert scene['rpc_path'] is None
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+from perusatproc.checkpoint import TileCheckpoint, input_key
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+
+def test_input_key_depends_on_inputs_and_parameters(tmp_path):
+    src = tmp_path / 'IMG_P.TIF'
+    src.write_bytes(b'pixels')
+    paths = [str(src)]
+
+    key = input_key(paths, tile_size=1024, create_options=['TILED=YES'])
+    assert key == input_key(paths,
+                            create_options=['TILED=YES'],
+                            tile_size=1024)
+    assert key != input_key(paths,
+                            tile_size=2048,
+                            create_options=['TILED=YES'])
+    assert key != input_key(paths,
+                            tile_size=1024,
+                            create_options=['COMPRESS=DEFLATE'])
+
+    src.write_bytes(b'other pixels')
+    assert key != input_key(paths,
+                            tile_size=1024,
+                            create_options=['TILED=YES'])
+
+
+def test_tile_checkpoint_resumes_only_with_same_key(tmp_path):
+    path = str(tmp_path / 'out.tif.checkpoint')
+    checkpoint = TileCheckpoint(path, 'a', 10)
+    checkpoint.mark_done(3)
+    checkpoint.mark_done(9)
+
+    assert TileCheckpoint(path, 'a', 10).missing() == [
+        0, 1, 2, 4, 5, 6, 7, 8
+    ]
+    assert len(TileCheckpoint(path, 'b', 10).missing()) == 10
+    assert len(TileCheckpoint(path, 'a', 12).missing()) == 12
+
+    checkpoint.remove()
+    assert len(TileCheckpoint(path, 'a', 10).missing()) == 10
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+import math
+
+import pytest
+
+from perusatproc import orthorectification, product
+from perusatproc.dynamic import PAN_RATIO
+from perusatproc.orthorectification import (OutputGrid, scale_grid, utm_epsg,
+                                            volume_grid)
+from perusatproc.rpc import RPCModel
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+EPSG = 32718
+PIXEL_SIZE = 0.7
+
+# Footprint bounds (in EPSG) of the images of two overlapping volumes of a
+# product, at arbitrary positions with respect to any grid
+FOOTPRINTS = {
+    'VOL_1': (279123.37, 8670011.91, 288456.02, 8681234.55),
+    'VOL_2': (287001.13, 8661500.42, 296532.87, 8671007.77),
+}
+
+
+def is_multiple(value, step):
+    steps = value / step
+    return abs(steps - round(steps)) < 1e-6
+
+
+@pytest.fixture(autouse=True)
+def volumes(monkeypatch):
+    # Each volume has a P image with a DIMAP and RPC file named after it
+    monkeypatch.setattr(product, 'find_image_dir',
+                        lambda volume, kind: volume + '/IMG_' + kind)
+    monkeypatch.setattr(
+        product, 'find_metadata_files', lambda image_dir:
+        (image_dir + '/DIM.XML', image_dir + '/RPC.XML'))
+    monkeypatch.setattr(
+        orthorectification, 'footprint_bounds',
+        lambda dim_xml, epsg: FOOTPRINTS[dim_xml.split('/')[0]])
+    monkeypatch.setattr(
+        RPCModel, 'from_metadata', classmethod(lambda cls, path: cls(
+            lon_offset=-77.03, lat_offset=-12.05, height_offset=150.0)))
+
+
+def test_utm_epsg():
+    assert utm_epsg(-77.03, -12.05) == 32718
+    assert utm_epsg(2.35, 48.85) == 32631
+    assert utm_epsg(-180.0, 10.0) == 32601
+    assert utm_epsg(179.9, -10.0) == 32760
+
+
+def test_volumes_share_a_lattice():
+    grids = [
+        volume_grid(volume, epsg=EPSG, pixel_size=PIXEL_SIZE)
+        for volume in FOOTPRINTS
+    ]
+    ms_size = PIXEL_SIZE * PAN_RATIO
+    for grid, bounds in zip(grids, FOOTPRINTS.values()):
+        assert grid.epsg == EPSG
+        assert grid.pixel_size == PIXEL_SIZE
+        # Bounds are aligned to multispectral pixels, and cover the footprint
+        assert is_multiple(grid.ulx, ms_size)
+        assert is_multiple(grid.uly, ms_size)
+        assert grid.width % PAN_RATIO == 0
+        assert grid.height % PAN_RATIO == 0
+        assert grid.ulx <= bounds[0]
+        assert grid.uly >= bounds[3]
+        assert grid.ulx + grid.width * PIXEL_SIZE >= bounds[2]
+        assert grid.uly - grid.height * PIXEL_SIZE <= bounds[1]
+
+    # Pixels of both grids coincide where they overlap
+    first, second = grids
+    assert is_multiple(second.ulx - first.ulx, PIXEL_SIZE)
+    assert is_multiple(second.uly - first.uly, PIXEL_SIZE)
+
+
+def test_volume_grid_defaults_to_utm_zone():
+    grid = volume_grid('VOL_1', pixel_size=PIXEL_SIZE)
+    assert grid.epsg == EPSG
+
+
+def test_volume_grid_align():
+    align = PIXEL_SIZE * PAN_RATIO * 10
+    grid = volume_grid('VOL_1', epsg=EPSG, pixel_size=PIXEL_SIZE, align=align)
+    assert is_multiple(grid.ulx, align)
+    assert is_multiple(grid.uly, align)
+    assert is_multiple(grid.width * PIXEL_SIZE, align)
+
+    for align in (PIXEL_SIZE, PIXEL_SIZE * PAN_RATIO * 2.5):
+        with pytest.raises(ValueError):
+            volume_grid('VOL_1', epsg=EPSG, pixel_size=PIXEL_SIZE, align=align)
+
+
+def test_ms_grid_matches_p_grid():
+    grid = volume_grid('VOL_2', epsg=EPSG, pixel_size=PIXEL_SIZE)
+    ms_grid = scale_grid(grid, PAN_RATIO)
+    assert (ms_grid.epsg, ms_grid.ulx, ms_grid.uly) == (grid.epsg, grid.ulx,
+                                                        grid.uly)
+    assert ms_grid.pixel_size == pytest.approx(PIXEL_SIZE * PAN_RATIO)
+    assert ms_grid.width * PAN_RATIO == grid.width
+    assert ms_grid.height * PAN_RATIO == grid.height
+    assert math.isclose(ms_grid.width * ms_grid.pixel_size,
+                        grid.width * grid.pixel_size)
+
+
+def test_scale_grid():
+    grid = OutputGrid(epsg=EPSG,
+                      ulx=280000.0,
+                      uly=8680000.0,
+                      width=400,
+                      height=200,
+                      pixel_size=0.5)
+    assert scale_grid(grid, 4) == grid._replace(width=100,
+                                                height=50,
+                                                pixel_size=2.0)
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import random
+import threading
+import time
+
+import pytest
+
+from perusatproc.pipeline import Pipeline, TileStage
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+# Seconds to wait for a pipeline before considering it hung
+TIMEOUT = 30
+
+
+class MemoryCheckpoint:
+    def __init__(self, done=()):
+        self.done = set(done)
+
+    def is_done(self, i):
+        return i in self.done
+
+    def mark_done(self, i):
+        self.done.add(i)
+
+
+class Recorder:
+    """Records computed tiles, and checks that their dependencies were
+    computed before them"""
+
+    def __init__(self, delay=0):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.order = []
+        self.delay = delay
+        self.rng = random.Random(0)
+
+    def compute(self, name, deps=lambda i: []):
+        def compute_tile(i):
+            with self.lock:
+                for dep in deps(i):
+                    assert self.counts[dep] == 1, '{} before {}'.format(
+                        (name, i), dep)
+                delay = self.rng.uniform(0, self.delay)
+            time.sleep(delay)
+            with self.lock:
+                self.counts[(name, i)] += 1
+                self.order.append((name, i))
+
+        return compute_tile
+
+
+def run_pipeline(pipeline):
+    errors = []
+
+    def run():
+        try:
+            pipeline.run()
+        except BaseException as err:
+            errors.append(err)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(TIMEOUT)
+    assert not thread.is_alive(), 'pipeline did not finish'
+    if errors:
+        raise errors[0]
+
+
+def test_pipeline_computes_tiles_once_in_dependency_order():
+    rec = Recorder(delay=0.005)
+    first = TileStage('first', 20, rec.compute('first'), workers=3,
+                      queue_size=2)
+
+    # Even tiles depend on two tiles of the first stage, odd tiles on none,
+    # like orthorectified tiles outside the footprint of an image
+    def second_deps(i):
+        if i % 2:
+            return []
+        return [(first, i), (first, (i + 1) % first.ntiles)]
+
+    second = TileStage('second',
+                       20,
+                       rec.compute(
+                           'second', lambda i: [('first', j)
+                                                for _, j in second_deps(i)]),
+                       deps=second_deps,
+                       workers=2,
+                       queue_size=1)
+    third = TileStage('third',
+                      20,
+                      rec.compute('third', lambda i: [('second', i)]),
+                      deps=lambda i: [(second, i)],
+                      workers=2,
+                      queue_size=1)
+
+    progress = []
+    run_pipeline(Pipeline([first, second, third], progress=progress.append))
+
+    for name in ('first', 'second', 'third'):
+        for i in range(20):
+            assert rec.counts[(name, i)] == 1
+    assert progress[-1] == 1
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_pipeline_does_not_hang_with_full_queues(seed):
+    rec = Recorder(delay=0.002)
+    rec.rng.seed(seed)
+    first = TileStage('first', 8, rec.compute('first'), queue_size=1)
+    second = TileStage('second',
+                       40,
+                       rec.compute('second'),
+                       deps=lambda i: [(first, i)] if i < 8 else [],
+                       workers=2,
+                       queue_size=1)
+    run_pipeline(Pipeline([first, second]))
+    assert sum(rec.counts.values()) == 48
+    assert set(rec.counts.values()) == {1}
+
+
+def test_pipeline_queues_tiles_once_when_feeder_is_blocked():
+    # The feeder of the second stage blocks on its full queue with tiles
+    # that depend on nothing, while the first stage finishes the tiles that
+    # the rest of the second stage waits for
+    rec = Recorder()
+    first = TileStage('first', 4, lambda i: time.sleep(0.05), queue_size=4)
+    record = rec.compute('second')
+
+    def compute_second(i):
+        time.sleep(0.02)
+        record(i)
+
+    second = TileStage('second',
+                       12,
+                       compute_second,
+                       deps=lambda i: [(first, i - 8)] if i >= 8 else [],
+                       queue_size=1)
+    run_pipeline(Pipeline([first, second]))
+    assert [rec.counts[('second', i)] for i in range(12)] == [1] * 12
+
+
+def test_pipeline_skips_checkpointed_tiles():
+    rec = Recorder()
+    checkpoint = MemoryCheckpoint(done=range(5))
+    first = TileStage('first', 5, rec.compute('first'), checkpoint=checkpoint)
+    second = TileStage('second',
+                       5,
+                       rec.compute('second'),
+                       deps=lambda i: [(first, i)],
+                       checkpoint=MemoryCheckpoint())
+    pipeline = Pipeline([first, second])
+    run_pipeline(pipeline)
+    assert not any(name == 'first' for name, _ in rec.order)
+    assert sorted(i for _, i in rec.order) == list(range(5))
+    assert second.checkpoint.done == set(range(5))
+
+
+def test_pipeline_raises_first_error():
+    rec = Recorder()
+
+    def fail(i):
+        if i == 3:
+            raise RuntimeError('tile 3 failed')
+
+    first = TileStage('first', 10, fail, workers=2, queue_size=1)
+    second = TileStage('second',
+                       10,
+                       rec.compute('second'),
+                       deps=lambda i: [(first, i)])
+    with pytest.raises(RuntimeError, match='tile 3 failed'):
+        run_pipeline(Pipeline([first, second]))
+    assert ('second', 3) not in rec.counts
+
+
+def test_pipeline_rejects_dependencies_on_later_stages():
+    first = TileStage('first', 1, lambda i: None)
+    second = TileStage('second', 1, lambda i: None)
+    first.deps = lambda i: [(second, 0)]
+    with pytest.raises(ValueError):
+        Pipeline([first, second])
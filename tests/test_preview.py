@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+from perusatproc.preview import dem_candidates, srtm_tile_name
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+
+def test_srtm_tile_name():
+    assert srtm_tile_name(-76.5, -12.1) == 'S13W077'
+    assert srtm_tile_name(-77.0, -13.0) == 'S13W077'
+    assert srtm_tile_name(6.2, 0.5) == 'N00E006'
+    assert srtm_tile_name(-0.5, -0.5) == 'S01W001'
+
+
+def test_dem_candidates_selects_srtm_tiles_by_name():
+    paths = [
+        'dem/S12W077.hgt', 'dem/S13W077.hgt', 'dem/s13w078.hgt',
+        'dem/S14W077.hgt', 'dem/N13W077.hgt', 'dem/S13W076.tif',
+        'dem/lima.tif'
+    ]
+    # A grid across the border of two tiles
+    bounds = (-77.2, -12.3, -76.8, -12.1)
+    assert dem_candidates(paths, bounds) == [
+        'dem/S13W077.hgt', 'dem/s13w078.hgt', 'dem/lima.tif'
+    ]
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of S3 access. Tests that need object storage run against the server
+of AWS_S3_ENDPOINT (e.g. a local MinIO, see :mod:`perusatproc.s3`), and are
+skipped if it is not set.
+"""
+
+import io
+import os
+import uuid
+import zipfile
+
+import pytest
+
+from perusatproc import s3, vfs
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+
+def test_paths():
+    assert s3.is_s3('s3://bucket/key')
+    assert s3.is_s3('/vsis3/bucket/key')
+    assert not s3.is_s3('/data/bucket/key')
+    assert s3.to_vsi('s3://bucket/a/b.tif') == '/vsis3/bucket/a/b.tif'
+    assert s3.split('s3://bucket/a/b.tif') == ('bucket', 'a/b.tif')
+    assert s3.split('/vsis3/bucket/a/b.tif') == ('bucket', 'a/b.tif')
+    assert s3.join('s3://bucket/a/', '/b/', 'c.tif') == 's3://bucket/a/b/c.tif'
+
+
+@pytest.fixture
+def bucket():
+    if not os.getenv('AWS_S3_ENDPOINT'):
+        pytest.skip('AWS_S3_ENDPOINT is not set')
+    pytest.importorskip('boto3')
+
+    name = 'perusatproc-test-{}'.format(uuid.uuid4().hex[:12])
+    client = s3.client()
+    client.create_bucket(Bucket=name)
+    yield 's3://{}'.format(name)
+    for key, _ in s3.list_objects('s3://{}/'.format(name)):
+        client.delete_object(Bucket=name, Key=key)
+    client.delete_bucket(Bucket=name)
+
+
+def test_upload_and_read(bucket, tmp_path):
+    data = bytes(range(256)) * 4096
+    src = tmp_path / 'data.bin'
+    src.write_bytes(data)
+
+    with s3.Uploader() as uploader:
+        uploader.submit(str(src), s3.join(bucket, 'dir', 'data.bin'))
+
+    uri = s3.join(bucket, 'dir', 'data.bin')
+    assert s3.exists(uri)
+    assert not s3.exists(s3.join(bucket, 'dir', 'missing.bin'))
+    assert s3.stat(uri)[1] == len(data)
+    assert list(s3.list_objects(s3.join(bucket, 'dir'))) == [
+        ('dir/data.bin', len(data))
+    ]
+
+    reader = s3.RangeReader(uri)
+    reader.seek(1000)
+    buf = bytearray(24)
+    assert reader.readinto(buf) == 24
+    assert bytes(buf) == data[1000:1024]
+    reader.seek(-10, io.SEEK_END)
+    assert reader.readall() == data[-10:]
+    assert reader.readall() == b''
+
+    with s3.open(uri) as f:
+        f.seek(300000)
+        assert f.read(5000) == data[300000:305000]
+    assert vfs.read_range(uri, 12345, 100) == data[12345:12445]
+
+
+def test_upload_tree_and_background_jobs(bucket, tmp_path):
+    tree = tmp_path / 'tree'
+    (tree / 'sub').mkdir(parents=True)
+    (tree / 'a.txt').write_text('a')
+    (tree / 'sub' / 'b.txt').write_text('b')
+
+    def finish(uploader):
+        # Files are written in the background, then uploaded
+        (tmp_path / 'c.txt').write_text('c')
+        uploader.submit(str(tmp_path / 'c.txt'), s3.join(bucket, 'c.txt'))
+
+    with s3.Uploader() as uploader:
+        uploader.submit_tree(str(tree), s3.join(bucket, 'tree'))
+        uploader.run(finish, uploader)
+
+    keys = sorted(key for key, _ in s3.list_objects(bucket + '/'))
+    assert keys == ['c.txt', 'tree/a.txt', 'tree/sub/b.txt']
+
+
+def test_upload_errors_are_raised(bucket, tmp_path):
+    with pytest.raises(OSError):
+        with s3.Uploader() as uploader:
+            uploader.submit(str(tmp_path / 'missing.bin'),
+                            s3.join(bucket, 'missing.bin'))
+
+
+def test_read_archive_members(bucket, tmp_path):
+    archive = tmp_path / 'product.zip'
+    with zipfile.ZipFile(str(archive), 'w') as zf:
+        zf.writestr('PRODUCT/DIM_P.XML', '<Dimap_Document/>')
+    uri = s3.join(bucket, 'product.zip')
+    s3.upload(str(archive), uri)
+
+    with vfs.open(uri + '/PRODUCT/DIM_P.XML') as f:
+        assert f.read() == b'<Dimap_Document/>'
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from perusatproc import shm
+from perusatproc.shm import TileBufferPool, buffer_array
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+np = pytest.importorskip('numpy')
+shared_memory = pytest.importorskip('multiprocessing.shared_memory')
+
+
+# Worker functions are module-level, so they can be pickled for process pools
+
+
+def increment(buf):
+    data = buffer_array(buf)
+    data += 1
+    return os.getpid()
+
+
+def attached_blocks(buf):
+    buffer_array(buf)
+    return list(shm._attached)
+
+
+def test_workers_write_tiles_in_place():
+    tile = np.arange(2 * 8 * 8, dtype='uint16').reshape(2, 8, 8)
+    with TileBufferPool(2, tile.shape) as pool, \
+            ProcessPoolExecutor(max_workers=2) as executor:
+        bufs = [pool.put(tile), pool.put(tile[:, :4, :6] * 2)]
+        assert [buf.slot for buf in bufs] == [0, 1]
+        list(executor.map(increment, bufs))
+
+        assert (pool.array(0) == tile + 1).all()
+        assert (pool.array(1, (2, 4, 6)) == tile[:, :4, :6] * 2 + 1).all()
+
+
+def test_acquire_times_out_when_slots_are_in_use():
+    with TileBufferPool(1, (1, 4, 4)) as pool:
+        slot = pool.acquire()
+        with pytest.raises(TimeoutError):
+            pool.acquire(timeout=0.01)
+        pool.release(slot)
+        assert pool.acquire(timeout=0.01) == slot
+
+
+def test_oversized_tiles_are_rejected():
+    with TileBufferPool(2, (1, 4, 4)) as pool:
+        with pytest.raises(ValueError):
+            pool.buffer(0, (1, 4, 5))
+        with pytest.raises(ValueError):
+            pool.put(np.zeros((2, 4, 4), dtype='uint16'))
+        # The slot is released on failure
+        assert len(pool.free) == 2
+
+
+def test_close_unlinks_block():
+    pool = TileBufferPool(1, (1, 4, 4))
+    pool.close()
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=pool.name)
+
+
+def test_workers_detach_from_old_blocks():
+    pools = [TileBufferPool(1, (1, 4, 4)) for _ in range(shm.MAX_ATTACHED + 1)]
+    try:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            for pool in pools:
+                attached = executor.submit(attached_blocks,
+                                           pool.buffer(0)).result()
+        assert attached == [pool.name for pool in pools[1:]]
+    finally:
+        for pool in pools:
+            pool.close()
+
+    with TileBufferPool(1, (1, 4, 4)) as pool:
+        buffer_array(pool.buffer(0))
+        assert pool.name in shm._attached
+        shm.detach(pool.name)
+        assert pool.name not in shm._attached
+        # Detaching twice is harmless
+        shm.detach(pool.name)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from perusatproc import tasks
+from perusatproc.executors import ClientExecutor, LocalExecutor
+from perusatproc.tasks import Task, run_tasks
+from perusatproc.util import MemoryExhaustedError
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+
+# Task functions are module-level, so they can be pickled for process pools
+
+
+def add(a, b=0):
+    return a + b
+
+
+def join(*, left, right):
+    return '{}+{}'.format(left, right)
+
+
+def fail(message):
+    raise RuntimeError(message)
+
+
+def fail_once_out_of_memory(marker, value):
+    # Fail the first time, leaving a marker file for the next attempt
+    if not os.path.exists(marker):
+        open(marker, 'w').close()
+        raise MemoryExhaustedError(-9, 'otbcli_Fake')
+    return value
+
+
+def always_out_of_memory(marker):
+    with open(marker, 'a') as f:
+        f.write('x')
+    raise MemoryExhaustedError(-9, 'otbcli_Fake')
+
+
+def diamond():
+    return [
+        Task(key='join',
+             func=join,
+             kwargs={},
+             deps=dict(left='left', right='right')),
+        Task(key='left', func=add, kwargs=dict(a=1, b=2), deps={}),
+        Task(key='right', func=add, kwargs=dict(b=10), deps=dict(a='left')),
+    ]
+
+
+@pytest.fixture(params=['local', 'serialize', 'process'])
+def executor(request):
+    if request.param == 'process':
+        with ProcessPoolExecutor(max_workers=2) as pool:
+            yield pool
+    else:
+        with LocalExecutor(serialize=request.param == 'serialize') as pool:
+            yield pool
+
+
+def test_run_tasks_passes_results_of_dependencies(executor):
+    finished = []
+    results = run_tasks(diamond(),
+                        executor,
+                        on_result=lambda key, _: finished.append(key))
+    assert results == dict(left=3, right=13, join='3+13')
+    assert finished.index('left') < finished.index('right')
+    assert finished[-1] == 'join'
+
+
+def test_run_tasks_propagates_failures(executor):
+    task_list = diamond()
+    task_list[1] = Task(key='left',
+                        func=fail,
+                        kwargs=dict(message='left failed'),
+                        deps={})
+    with pytest.raises(RuntimeError, match='left failed'):
+        run_tasks(task_list, executor)
+
+
+def test_run_tasks_rejects_unknown_dependencies():
+    task_list = [Task(key='a', func=add, kwargs={}, deps=dict(a='missing'))]
+    with pytest.raises(ValueError):
+        run_tasks(task_list, LocalExecutor())
+
+
+def test_run_tasks_detects_circular_dependencies():
+    task_list = [
+        Task(key='a', func=add, kwargs={}, deps=dict(a='b')),
+        Task(key='b', func=add, kwargs={}, deps=dict(a='a')),
+    ]
+    with pytest.raises(RuntimeError, match='Circular'):
+        run_tasks(task_list, LocalExecutor())
+
+
+def test_run_tasks_retries_tasks_out_of_memory(executor, tmp_path):
+    task_list = [
+        Task(key=str(i),
+             func=fail_once_out_of_memory,
+             kwargs=dict(marker=str(tmp_path / str(i)), value=i),
+             deps={}) for i in range(4)
+    ]
+    results = run_tasks(task_list, executor)
+    assert results == {str(i): i for i in range(4)}
+
+
+def test_run_tasks_gives_up_after_memory_retries(executor, tmp_path):
+    marker = tmp_path / 'attempts'
+    task_list = [
+        Task(key='a',
+             func=always_out_of_memory,
+             kwargs=dict(marker=str(marker)),
+             deps={})
+    ]
+    with pytest.raises(MemoryExhaustedError):
+        run_tasks(task_list, executor)
+    assert len(marker.read_text()) == tasks.MEMORY_RETRIES + 1
+
+
+class StandInClient:
+    """Stand-in of a Dask client, running tasks synchronously"""
+
+    def __init__(self):
+        self.closed = False
+
+    def get_executor(self):
+        return LocalExecutor(serialize=True)
+
+    def close(self):
+        self.closed = True
+
+
+def test_client_executor_closes_client():
+    client = StandInClient()
+    with ClientExecutor(client) as pool:
+        results = run_tasks(diamond(), pool)
+    assert results['join'] == '3+13'
+    assert client.closed
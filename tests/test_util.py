@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import subprocess
+
+import pytest
+
+from perusatproc.util import (MemoryExhaustedError, _handle_output_line,
+                              _run_with_progress)
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+
+def handle(line):
+    tail, progress = collections.deque(), []
+    _handle_output_line(line, tail, progress.append)
+    return list(tail), progress
+
+
+def test_otb_progress_bars_are_parsed():
+    assert handle(b'Writing out.tif...: 42% [********       ] (3s)') == ([],
+                                                                      [0.42])
+    assert handle(b'Processing...: 100% [**************************]') == (
+        [], [1.0])
+
+
+def test_other_lines_are_kept():
+    for line in (b'WARNING: 15% of pixels are no data',
+                 b'Estimated memory for full processing: 98% of RAM',
+                 b'Cannot allocate memory'):
+        assert handle(line) == ([line.decode()], [])
+    assert handle(b'   ') == ([], [])
+
+
+def test_run_with_progress():
+    progress = []
+    _run_with_progress(
+        r"printf 'Start\nWriting: 10%% [*   ]\rWriting: 50%% [**  ]\r"
+        r"Writing: 100%% [****]\nDone\n'", progress=progress.append)
+    assert progress == [0.1, 0.5, 1.0]
+
+
+def test_run_with_progress_raises_with_output_tail():
+    with pytest.raises(subprocess.CalledProcessError) as excinfo:
+        _run_with_progress("echo 'Failed at 30% of tiles'; exit 3")
+    assert excinfo.value.returncode == 3
+    assert 'Failed at 30% of tiles' in excinfo.value.output
+
+    with pytest.raises(MemoryExhaustedError):
+        _run_with_progress("echo 'std::bad_alloc'; exit 1")
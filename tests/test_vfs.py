@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import tarfile
+import zipfile
+import zlib
+
+import pytest
+
+from perusatproc import vfs
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+FILES = {
+    'PRODUCT/VOL_1/DIM_P.XML': b'<Dimap_Document/>',
+    'PRODUCT/VOL_1/IMG_P.JP2': bytes(range(256)) * 8192,
+}
+
+
+def write_archive(path):
+    if path.endswith('.zip'):
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for name, data in FILES.items():
+                zf.writestr(name, data)
+        return
+    mode = 'w:gz' if path.endswith(('.tar.gz', '.tgz')) else 'w'
+    with tarfile.open(path, mode) as tf:
+        for name, data in FILES.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+
+
+@pytest.fixture(params=['product.zip', 'product.tar', 'product.tar.gz'])
+def archive(request, tmp_path):
+    path = str(tmp_path / request.param)
+    write_archive(path)
+    return path
+
+
+def test_archive_listing(archive):
+    root = vfs.archive_path(archive)
+    assert vfs.is_archive(archive)
+    assert vfs.listdir(root) == ['PRODUCT']
+    assert vfs.listdir(root + '/PRODUCT/VOL_1') == ['DIM_P.XML', 'IMG_P.JP2']
+    assert vfs.isdir(root + '/PRODUCT/VOL_1')
+    assert vfs.glob(root + '/PRODUCT/*/DIM_*.XML') == [
+        root + '/PRODUCT/VOL_1/DIM_P.XML'
+    ]
+    assert vfs.archive_files(archive) == sorted(root + '/' + name
+                                                for name in FILES)
+
+
+def test_archive_reads(archive):
+    root = vfs.archive_path(archive)
+    for name, data in FILES.items():
+        with vfs.open(root + '/' + name) as f:
+            assert f.read() == data
+        assert vfs.read_range(root + '/' + name, 1000, 50) == data[1000:1050]
+        assert vfs.read_range(root + '/' + name, len(data) - 10,
+                              100) == data[-10:]
+        assert vfs.cache_key(root + '/' + name)[1] == len(data)
+    with pytest.raises((FileNotFoundError, KeyError)):
+        vfs.open(root + '/PRODUCT/missing.xml')
+
+
+def test_tar_archives_are_indexed_once(tmp_path, monkeypatch):
+    path = str(tmp_path / 'product.tar.gz')
+    write_archive(path)
+    root = vfs.archive_path(path)
+    vfs.listdir(root)
+
+    opened = []
+    open_ = vfs._open
+
+    def counting_open(p):
+        opened.append(p)
+        return open_(p)
+
+    monkeypatch.setattr(vfs, '_open', counting_open)
+    with vfs.open(root + '/PRODUCT/VOL_1/DIM_P.XML') as f:
+        assert f.read() == FILES['PRODUCT/VOL_1/DIM_P.XML']
+    vfs.glob(root + '/PRODUCT/*/*.XML')
+    # Small members of compressed archives are read from the index
+    assert opened == []
+
+    # Indexes are rebuilt when the archive changes
+    os.utime(path, ns=(0, 0))
+    assert vfs.listdir(root) == ['PRODUCT']
+    assert opened == [path]
+
+
+def test_compressed_key(tmp_path):
+    for name in ('product.zip', 'product.tar.gz', 'product.tar'):
+        write_archive(str(tmp_path / name))
+    member = '/PRODUCT/VOL_1/IMG_P.JP2'
+    zip_root = vfs.archive_path(str(tmp_path / 'product.zip'))
+    tgz_root = vfs.archive_path(str(tmp_path / 'product.tar.gz'))
+    tar_root = vfs.archive_path(str(tmp_path / 'product.tar'))
+    data = FILES[member[1:]]
+
+    assert vfs.compressed_key(zip_root + member) == (zlib.crc32(data),
+                                                     len(data))
+    assert vfs.compressed_key(tgz_root + member)[-1] == len(data)
+    assert vfs.compressed_key(tar_root + member) is None
+    assert vfs.compressed_key(str(tmp_path / 'product.zip')) is None
+
+
+def test_to_gdal_path():
+    assert vfs.to_gdal_path('/data/product.zip') == '/data/product.zip'
+    assert vfs.to_gdal_path('s3://bucket/product.zip') == (
+        '/vsis3/bucket/product.zip')
+    assert vfs.to_gdal_path('s3://bucket/product.zip/PRODUCT/DIM_P.XML') == (
+        '/vsizip//vsis3/bucket/product.zip/PRODUCT/DIM_P.XML')
+    assert vfs.to_gdal_path('/vsis3/bucket/a/product.tar.gz/PRODUCT') == (
+        '/vsitar//vsis3/bucket/a/product.tar.gz/PRODUCT')
+    assert vfs.to_gdal_path('s3://product.zip/key.tif') == (
+        '/vsis3/product.zip/key.tif')
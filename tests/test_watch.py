@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from perusatproc import watch
+from perusatproc.watch import VolumeWatcher, needs_processing, read_source
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+pytest.importorskip('xmltodict')
+
+DIM_XML = """<Dimap_Document><Raster_Data><Data_Access><Data_Files>
+<Data_File><DATA_FILE_PATH href="IMG.JP2"/></Data_File>
+</Data_Files></Data_Access></Raster_Data></Dimap_Document>"""
+
+
+def write_image(volume, kind, raster=b'pixels'):
+    image_dir = os.path.join(volume, 'IMG_PER1_20200314_{}_001'.format(kind))
+    os.makedirs(image_dir, exist_ok=True)
+    with open(os.path.join(image_dir, 'DIM_{}.XML'.format(kind)), 'w') as f:
+        f.write(DIM_XML)
+    with open(os.path.join(image_dir, 'RPC_{}.XML'.format(kind)), 'w') as f:
+        f.write('<Rpc_Document/>')
+    if raster is not None:
+        with open(os.path.join(image_dir, 'IMG.JP2'), 'wb') as f:
+            f.write(raster)
+    return image_dir
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(watch.time, 'monotonic', lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def drop(tmp_path):
+    path = tmp_path / 'drop'
+    path.mkdir()
+    return path
+
+
+def test_volumes_are_reported_once_settled(drop, clock):
+    volume = str(drop / 'PRODUCT' / 'VOL_1')
+    write_image(volume, 'MS')
+    write_image(volume, 'P', raster=None)
+    watcher = VolumeWatcher(str(drop), settle=60, use_inotify=False)
+
+    # Incomplete volumes are not reported
+    assert watcher.scan() == []
+    assert watcher.pending == {}
+
+    write_image(volume, 'P')
+    assert watcher.scan() == []
+    assert volume in watcher.pending
+    assert watcher.timeout() == 30
+
+    # Changes during the settle period restart it
+    clock[0] += 50
+    write_image(volume, 'P', raster=b'more pixels')
+    assert watcher.scan() == []
+    clock[0] += 50
+    assert watcher.scan() == []
+    clock[0] += 10
+    assert watcher.scan() == [(str(drop / 'PRODUCT'), volume)]
+    assert watcher.pending == {}
+
+    # Reported volumes are not reported again while unchanged
+    clock[0] += 100
+    assert watcher.scan() == []
+    assert watcher.scan() == []
+
+
+def test_redelivered_volumes_are_reported_again(drop, clock):
+    volume = str(drop / 'PRODUCT' / 'VOL_1')
+    write_image(volume, 'MS')
+    write_image(volume, 'P')
+    watcher = VolumeWatcher(str(drop), settle=0, use_inotify=False)
+    watcher.scan()
+    assert len(watcher.scan()) == 1
+    first = watcher.reported[volume]
+
+    write_image(volume, 'P', raster=b'corrected pixels')
+    assert watcher.scan() == []
+    assert watcher.scan() == [(str(drop / 'PRODUCT'), volume)]
+    assert watcher.reported[volume] != first
+
+
+def test_removed_volumes_are_forgotten(drop, clock):
+    volume = str(drop / 'PRODUCT' / 'VOL_1')
+    write_image(volume, 'MS')
+    write_image(volume, 'P')
+    watcher = VolumeWatcher(str(drop), settle=60, use_inotify=False)
+    watcher.scan()
+    assert volume in watcher.pending
+    os.rename(str(drop / 'PRODUCT'), str(drop / '.PRODUCT'))
+    assert watcher.scan() == []
+    assert watcher.pending == {}
+
+
+def test_needs_processing(tmp_path):
+    output = str(tmp_path / 'VOL_1.tif')
+    state = ((1584200000.5, 100), (1584200001.0, 2000))
+    assert needs_processing(output, state)
+
+    # Outputs with no recorded source are assumed current
+    open(output, 'w').close()
+    assert not needs_processing(output, state)
+    assert read_source(output) == state
+
+    assert not needs_processing(output, state)
+    assert needs_processing(output, ((1584200000.5, 100), (1584300000.0, 2100)))